@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# add a directory of XDI files to an XAS Spectral Library DB,
+# parsing files in parallel.  Run with no directory to load the
+# example data into a database made with create_empty_db.py, as
+# init_db.py did: the files in data/ other than the 'nonxafs' and
+# 'upload' test files, submitted by an example person whose login
+# password is 'xafsdb'
+#
+
+from __future__ import print_function
+import os
+import sys
+import time
+from argparse import ArgumentParser
+import xasdb
+
+parser = ArgumentParser(description='add XDI files to an XAS Data Library')
+parser.add_argument('dbname', nargs='?', default='example.db',
+                    help='database file [example.db]')
+parser.add_argument('directory', nargs='?', default=None,
+                    help='directory of XDI files [example data]')
+parser.add_argument('-w', '--workers', type=int, default=None,
+                    help='number of parsing processes [number of cpus]')
+parser.add_argument('-b', '--batch-size', type=int, default=100,
+                    help='files written per transaction [100]')
+parser.add_argument('-p', '--pattern', default='*.xdi',
+                    help='file name pattern [*.xdi]')
+parser.add_argument('-e', '--email', default='newville@cars.uchicago.edu',
+                    help='email of person submitting the spectra')
+parser.add_argument('-n', '--name', default='Matt Newville',
+                    help='name of person, if they must be added')
+parser.add_argument('-a', '--affiliation', default=None,
+                    help='affiliation of person, if they must be added')
+parser.add_argument('--password', default=None,
+                    help='set password for person')
+parser.add_argument('--no-sample', action='store_true',
+                    help='do not create sample entries')
+args = parser.parse_args()
+
+exclude = None
+if args.directory is None:
+    # the example data, as loaded by init_db.py
+    args.directory = 'data'
+    exclude = ('nonxafs', 'upload')
+    if args.affiliation is None:
+        args.affiliation = 'CARS, UChicago'
+    if args.password is None:
+        args.password = 'xafsdb'
+
+if not os.path.exists(args.dbname):
+    print("Error:  database file '%s' does not exist" % args.dbname)
+    print("Use create_empty_db.py to create database")
+    sys.exit()
+
+db = xasdb.connect_xasdb(args.dbname)
+if db.get_person(args.email) is None:
+    db.add_person(args.name, args.email,
+                  affiliation=args.affiliation or '')
+if args.password is not None:
+    db.set_person_password(args.email, str.encode(args.password))
+
+t0 = time.time()
+results = db.ingest_directory(args.directory, person=args.email,
+                              workers=args.workers, pattern=args.pattern,
+                              batch_size=args.batch_size,
+                              create_sample=not args.no_sample,
+                              exclude=exclude)
+nerr = 0
+for result in results:
+    if result.error is not None:
+        nerr += 1
+        print("could not add '%s': %s" % (result.filename, result.error))
+
+print('added %i of %i files from %s in %.2f sec' % (len(results)-nerr,
+                                                   len(results),
+                                                   args.directory,
+                                                   time.time()-t0))
+db.close()
@@ -1,13 +1,15 @@
-
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
 CREATE TABLE info (
 	"key" TEXT NOT NULL,
 	value TEXT,
 	PRIMARY KEY ("key"),
 	UNIQUE ("key")
 );
-INSERT INTO "info" VALUES('version','1.1.0');
-INSERT INTO "info" VALUES('create_date','2015-08-25T09:09:36.785775');
-INSERT INTO "info" VALUES('modify_date','2015-08-25T09:09:36.785775');
+INSERT INTO info VALUES('version','1.10.0');
+INSERT INTO info VALUES('create_date','2026-10-16T20:28:46.873744');
+INSERT INTO info VALUES('modify_date','2026-10-16T20:28:46.873744');
+INSERT INTO info VALUES('array_format','json');
 CREATE TABLE ligand (
 	id INTEGER NOT NULL,
 	name TEXT NOT NULL,
@@ -15,41 +17,43 @@ CREATE TABLE ligand (
 	PRIMARY KEY (id),
 	UNIQUE (name)
 );
-CREATE TABLE facility (
+CREATE TABLE mode (
 	id INTEGER NOT NULL,
 	name TEXT NOT NULL,
 	notes TEXT,
-	fullname TEXT,
-	laboratory TEXT,
-	city TEXT,
-	region TEXT,
-	country TEXT NOT NULL,
 	PRIMARY KEY (id),
 	UNIQUE (name)
 );
-INSERT INTO "facility" VALUES(1,'SSRL',NULL,'Stanford Synchrotron Radiation Laboratory','SLAC','Palo Alto','CA','US');
-INSERT INTO "facility" VALUES(2,'SRS',NULL,'Synchrotron Radiation Source','Daresbury Laboratory','Cheshire','','UK');
-INSERT INTO "facility" VALUES(3,'NSLS',NULL,'National Synchrotron Light Source','BNL','Upton','NY','US');
-INSERT INTO "facility" VALUES(4,'PF',NULL,'Photon Factory','KEK','Tsukuba','','Japan');
-INSERT INTO "facility" VALUES(5,'ESRF',NULL,'European Synchrotron Radiation Facility','','Grenoble','','France');
-INSERT INTO "facility" VALUES(6,'APS',NULL,'Advanced Photon Source','ANL','Argonne','IL','US');
-INSERT INTO "facility" VALUES(7,'ALS',NULL,'Advanced Light Source','LBNL','Berkeley','CA','US');
-INSERT INTO "facility" VALUES(8,'DLS',NULL,'Diamond Light Source','','Didcot','','UK');
-INSERT INTO "facility" VALUES(9,'SOLEIL',NULL,'Synchrotron SOLEIL','','GIF-sur-YVETTE','','France');
-CREATE TABLE citation (
+INSERT INTO mode VALUES(1,'transmission','transmission intensity through sample');
+INSERT INTO mode VALUES(2,'fluorescence','X-ray fluorescence, no further details');
+INSERT INTO mode VALUES(3,'fluorescence, total yield','X-ray fluorescence, no energy analysis');
+INSERT INTO mode VALUES(4,'fluorescence, energy analyzed','X-ray fluorescence with an energy dispersive detector');
+INSERT INTO mode VALUES(5,'xeol','visible or uv light emission');
+INSERT INTO mode VALUES(6,'electron emission','emitted electrons from sample');
+INSERT INTO mode VALUES(7,'fluorescence, unitstep','X-ray fluorescence, normalized');
+CREATE TABLE facility (
 	id INTEGER NOT NULL,
 	name TEXT NOT NULL,
 	notes TEXT,
-	journal TEXT,
-	authors TEXT,
-	title TEXT,
-	volume TEXT,
-	pages TEXT,
-	year TEXT,
-	doi TEXT,
+	fullname TEXT,
+	laboratory TEXT,
+	city TEXT,
+	region TEXT,
+	country TEXT NOT NULL,
 	PRIMARY KEY (id),
 	UNIQUE (name)
 );
+INSERT INTO facility VALUES(1,'SSRL',NULL,'Stanford Synchrotron Radiation Laboratory','SLAC','Palo Alto','CA','US');
+INSERT INTO facility VALUES(2,'SRS',NULL,'Synchrotron Radiation Source','Daresbury Laboratory','Cheshire','','UK');
+INSERT INTO facility VALUES(3,'NSLS',NULL,'National Synchrotron Light Source','BNL','Upton','NY','US');
+INSERT INTO facility VALUES(4,'PF',NULL,'Photon Factory','KEK','Tsukuba','','Japan');
+INSERT INTO facility VALUES(5,'ESRF',NULL,'European Synchrotron Radiation Facility','','Grenoble','','France');
+INSERT INTO facility VALUES(6,'APS',NULL,'Advanced Photon Source','ANL','Argonne','IL','US');
+INSERT INTO facility VALUES(7,'ALS',NULL,'Advanced Light Source','LBNL','Berkeley','CA','US');
+INSERT INTO facility VALUES(8,'DLS',NULL,'Diamond Light Source','','Didcot','','UK');
+INSERT INTO facility VALUES(9,'SOLEIL',NULL,'Synchrotron SOLEIL','','GIF-sur-YVETTE','','France');
+INSERT INTO facility VALUES(10,'NSLS-II',NULL,'National Synchrotron Light Source II','BNL','Upton','NY','US');
+INSERT INTO facility VALUES(11,'SLRI',NULL,'Synchrotron Light Research Institute','Siam Photon','Nakhon Ratchasima','','Thailand');
 CREATE TABLE element (
 	z INTEGER NOT NULL,
 	name TEXT NOT NULL,
@@ -58,128 +62,118 @@ CREATE TABLE element (
 	UNIQUE (name),
 	UNIQUE (symbol)
 );
-INSERT INTO "element" VALUES(1,'hydrogen','H');
-INSERT INTO "element" VALUES(2,'helium','He');
-INSERT INTO "element" VALUES(3,'lithium','Li');
-INSERT INTO "element" VALUES(4,'beryllium','Be');
-INSERT INTO "element" VALUES(5,'boron','B');
-INSERT INTO "element" VALUES(6,'carbon','C');
-INSERT INTO "element" VALUES(7,'nitrogen','N');
-INSERT INTO "element" VALUES(8,'oxygen','O');
-INSERT INTO "element" VALUES(9,'fluorine','F');
-INSERT INTO "element" VALUES(10,'neon','Ne');
-INSERT INTO "element" VALUES(11,'sodium','Na');
-INSERT INTO "element" VALUES(12,'magnesium','Mg');
-INSERT INTO "element" VALUES(13,'aluminum','Al');
-INSERT INTO "element" VALUES(14,'silicon','Si');
-INSERT INTO "element" VALUES(15,'phosphorus','P');
-INSERT INTO "element" VALUES(16,'sulfur','S');
-INSERT INTO "element" VALUES(17,'chlorine','Cl');
-INSERT INTO "element" VALUES(18,'argon','Ar');
-INSERT INTO "element" VALUES(19,'potassium','K');
-INSERT INTO "element" VALUES(20,'calcium','Ca');
-INSERT INTO "element" VALUES(21,'scandium','Sc');
-INSERT INTO "element" VALUES(22,'titanium','Ti');
-INSERT INTO "element" VALUES(23,'vanadium','V');
-INSERT INTO "element" VALUES(24,'chromium','Cr');
-INSERT INTO "element" VALUES(25,'manganese','Mn');
-INSERT INTO "element" VALUES(26,'iron','Fe');
-INSERT INTO "element" VALUES(27,'cobalt','Co');
-INSERT INTO "element" VALUES(28,'nickel','Ni');
-INSERT INTO "element" VALUES(29,'copper','Cu');
-INSERT INTO "element" VALUES(30,'zinc','Zn');
-INSERT INTO "element" VALUES(31,'gallium','Ga');
-INSERT INTO "element" VALUES(32,'germanium','Ge');
-INSERT INTO "element" VALUES(33,'arsenic','As');
-INSERT INTO "element" VALUES(34,'selenium','Se');
-INSERT INTO "element" VALUES(35,'bromine','Br');
-INSERT INTO "element" VALUES(36,'krypton','Kr');
-INSERT INTO "element" VALUES(37,'rubidium','Rb');
-INSERT INTO "element" VALUES(38,'strontium','Sr');
-INSERT INTO "element" VALUES(39,'yttrium','Y');
-INSERT INTO "element" VALUES(40,'zirconium','Zr');
-INSERT INTO "element" VALUES(41,'niobium','Nb');
-INSERT INTO "element" VALUES(42,'molybdenum','Mo');
-INSERT INTO "element" VALUES(43,'technetium','Tc');
-INSERT INTO "element" VALUES(44,'ruthenium','Ru');
-INSERT INTO "element" VALUES(45,'rhodium','Rh');
-INSERT INTO "element" VALUES(46,'palladium','Pd');
-INSERT INTO "element" VALUES(47,'silver','Ag');
-INSERT INTO "element" VALUES(48,'cadmium','Cd');
-INSERT INTO "element" VALUES(49,'indium','In');
-INSERT INTO "element" VALUES(50,'tin','Sn');
-INSERT INTO "element" VALUES(51,'antimony','Sb');
-INSERT INTO "element" VALUES(52,'tellurium','Te');
-INSERT INTO "element" VALUES(53,'iodine','I');
-INSERT INTO "element" VALUES(54,'xenon','Xe');
-INSERT INTO "element" VALUES(55,'cesium','Cs');
-INSERT INTO "element" VALUES(56,'barium','Ba');
-INSERT INTO "element" VALUES(57,'lanthanum','La');
-INSERT INTO "element" VALUES(58,'cerium','Ce');
-INSERT INTO "element" VALUES(59,'praseodymium','Pr');
-INSERT INTO "element" VALUES(60,'neodymium','Nd');
-INSERT INTO "element" VALUES(61,'promethium','Pm');
-INSERT INTO "element" VALUES(62,'samarium','Sm');
-INSERT INTO "element" VALUES(63,'europium','Eu');
-INSERT INTO "element" VALUES(64,'gadolinium','Gd');
-INSERT INTO "element" VALUES(65,'terbium','Tb');
-INSERT INTO "element" VALUES(66,'dysprosium','Dy');
-INSERT INTO "element" VALUES(67,'holmium','Ho');
-INSERT INTO "element" VALUES(68,'erbium','Er');
-INSERT INTO "element" VALUES(69,'thulium','Tm');
-INSERT INTO "element" VALUES(70,'ytterbium','Yb');
-INSERT INTO "element" VALUES(71,'lutetium','Lu');
-INSERT INTO "element" VALUES(72,'hafnium','Hf');
-INSERT INTO "element" VALUES(73,'tantalum','Ta');
-INSERT INTO "element" VALUES(74,'tungsten','W');
-INSERT INTO "element" VALUES(75,'rhenium','Re');
-INSERT INTO "element" VALUES(76,'osmium','Os');
-INSERT INTO "element" VALUES(77,'iridium','Ir');
-INSERT INTO "element" VALUES(78,'platinum','Pt');
-INSERT INTO "element" VALUES(79,'gold','Au');
-INSERT INTO "element" VALUES(80,'mercury','Hg');
-INSERT INTO "element" VALUES(81,'thallium','Tl');
-INSERT INTO "element" VALUES(82,'lead','Pb');
-INSERT INTO "element" VALUES(83,'bismuth','Bi');
-INSERT INTO "element" VALUES(84,'polonium','Po');
-INSERT INTO "element" VALUES(85,'astatine','At');
-INSERT INTO "element" VALUES(86,'radon','Rn');
-INSERT INTO "element" VALUES(87,'francium','Fr');
-INSERT INTO "element" VALUES(88,'radium','Ra');
-INSERT INTO "element" VALUES(89,'actinium','Ac');
-INSERT INTO "element" VALUES(90,'thorium','Th');
-INSERT INTO "element" VALUES(91,'protactinium','Pa');
-INSERT INTO "element" VALUES(92,'uranium','U');
-INSERT INTO "element" VALUES(93,'neptunium','Np');
-INSERT INTO "element" VALUES(94,'plutonium','Pu');
-INSERT INTO "element" VALUES(95,'americium','Am');
-INSERT INTO "element" VALUES(96,'curium','Cm');
-INSERT INTO "element" VALUES(97,'berkelium','Bk');
-INSERT INTO "element" VALUES(98,'californium','Cf');
-INSERT INTO "element" VALUES(99,'einsteinium','Es');
-INSERT INTO "element" VALUES(100,'fermium','Fm');
-INSERT INTO "element" VALUES(101,'mendelevium','Md');
-INSERT INTO "element" VALUES(102,'nobelium','No');
-INSERT INTO "element" VALUES(103,'lawerencium','Lw');
-INSERT INTO "element" VALUES(104,'rutherfordium','Rf');
-INSERT INTO "element" VALUES(105,'dubnium','Ha');
-INSERT INTO "element" VALUES(106,'seaborgium','Sg');
-INSERT INTO "element" VALUES(107,'bohrium','Bh');
-INSERT INTO "element" VALUES(108,'hassium','Hs');
-INSERT INTO "element" VALUES(109,'meitnerium','Mt');
-INSERT INTO "element" VALUES(110,'darmstadtium','Ds');
-INSERT INTO "element" VALUES(111,'roentgenium','Rg');
-INSERT INTO "element" VALUES(112,'copernicium','Cn');
-CREATE TABLE person (
-	id INTEGER NOT NULL,
-	email TEXT NOT NULL,
-	notes TEXT,
-	name TEXT NOT NULL,
-	password TEXT,
-	affiliation TEXT,
-	PRIMARY KEY (id),
-	UNIQUE (email)
-);
+INSERT INTO element VALUES(1,'hydrogen','H');
+INSERT INTO element VALUES(2,'helium','He');
+INSERT INTO element VALUES(3,'lithium','Li');
+INSERT INTO element VALUES(4,'beryllium','Be');
+INSERT INTO element VALUES(5,'boron','B');
+INSERT INTO element VALUES(6,'carbon','C');
+INSERT INTO element VALUES(7,'nitrogen','N');
+INSERT INTO element VALUES(8,'oxygen','O');
+INSERT INTO element VALUES(9,'fluorine','F');
+INSERT INTO element VALUES(10,'neon','Ne');
+INSERT INTO element VALUES(11,'sodium','Na');
+INSERT INTO element VALUES(12,'magnesium','Mg');
+INSERT INTO element VALUES(13,'aluminum','Al');
+INSERT INTO element VALUES(14,'silicon','Si');
+INSERT INTO element VALUES(15,'phosphorus','P');
+INSERT INTO element VALUES(16,'sulfur','S');
+INSERT INTO element VALUES(17,'chlorine','Cl');
+INSERT INTO element VALUES(18,'argon','Ar');
+INSERT INTO element VALUES(19,'potassium','K');
+INSERT INTO element VALUES(20,'calcium','Ca');
+INSERT INTO element VALUES(21,'scandium','Sc');
+INSERT INTO element VALUES(22,'titanium','Ti');
+INSERT INTO element VALUES(23,'vanadium','V');
+INSERT INTO element VALUES(24,'chromium','Cr');
+INSERT INTO element VALUES(25,'manganese','Mn');
+INSERT INTO element VALUES(26,'iron','Fe');
+INSERT INTO element VALUES(27,'cobalt','Co');
+INSERT INTO element VALUES(28,'nickel','Ni');
+INSERT INTO element VALUES(29,'copper','Cu');
+INSERT INTO element VALUES(30,'zinc','Zn');
+INSERT INTO element VALUES(31,'gallium','Ga');
+INSERT INTO element VALUES(32,'germanium','Ge');
+INSERT INTO element VALUES(33,'arsenic','As');
+INSERT INTO element VALUES(34,'selenium','Se');
+INSERT INTO element VALUES(35,'bromine','Br');
+INSERT INTO element VALUES(36,'krypton','Kr');
+INSERT INTO element VALUES(37,'rubidium','Rb');
+INSERT INTO element VALUES(38,'strontium','Sr');
+INSERT INTO element VALUES(39,'yttrium','Y');
+INSERT INTO element VALUES(40,'zirconium','Zr');
+INSERT INTO element VALUES(41,'niobium','Nb');
+INSERT INTO element VALUES(42,'molybdenum','Mo');
+INSERT INTO element VALUES(43,'technetium','Tc');
+INSERT INTO element VALUES(44,'ruthenium','Ru');
+INSERT INTO element VALUES(45,'rhodium','Rh');
+INSERT INTO element VALUES(46,'palladium','Pd');
+INSERT INTO element VALUES(47,'silver','Ag');
+INSERT INTO element VALUES(48,'cadmium','Cd');
+INSERT INTO element VALUES(49,'indium','In');
+INSERT INTO element VALUES(50,'tin','Sn');
+INSERT INTO element VALUES(51,'antimony','Sb');
+INSERT INTO element VALUES(52,'tellurium','Te');
+INSERT INTO element VALUES(53,'iodine','I');
+INSERT INTO element VALUES(54,'xenon','Xe');
+INSERT INTO element VALUES(55,'cesium','Cs');
+INSERT INTO element VALUES(56,'barium','Ba');
+INSERT INTO element VALUES(57,'lanthanum','La');
+INSERT INTO element VALUES(58,'cerium','Ce');
+INSERT INTO element VALUES(59,'praseodymium','Pr');
+INSERT INTO element VALUES(60,'neodymium','Nd');
+INSERT INTO element VALUES(61,'promethium','Pm');
+INSERT INTO element VALUES(62,'samarium','Sm');
+INSERT INTO element VALUES(63,'europium','Eu');
+INSERT INTO element VALUES(64,'gadolinium','Gd');
+INSERT INTO element VALUES(65,'terbium','Tb');
+INSERT INTO element VALUES(66,'dysprosium','Dy');
+INSERT INTO element VALUES(67,'holmium','Ho');
+INSERT INTO element VALUES(68,'erbium','Er');
+INSERT INTO element VALUES(69,'thulium','Tm');
+INSERT INTO element VALUES(70,'ytterbium','Yb');
+INSERT INTO element VALUES(71,'lutetium','Lu');
+INSERT INTO element VALUES(72,'hafnium','Hf');
+INSERT INTO element VALUES(73,'tantalum','Ta');
+INSERT INTO element VALUES(74,'tungsten','W');
+INSERT INTO element VALUES(75,'rhenium','Re');
+INSERT INTO element VALUES(76,'osmium','Os');
+INSERT INTO element VALUES(77,'iridium','Ir');
+INSERT INTO element VALUES(78,'platinum','Pt');
+INSERT INTO element VALUES(79,'gold','Au');
+INSERT INTO element VALUES(80,'mercury','Hg');
+INSERT INTO element VALUES(81,'thallium','Tl');
+INSERT INTO element VALUES(82,'lead','Pb');
+INSERT INTO element VALUES(83,'bismuth','Bi');
+INSERT INTO element VALUES(84,'polonium','Po');
+INSERT INTO element VALUES(85,'astatine','At');
+INSERT INTO element VALUES(86,'radon','Rn');
+INSERT INTO element VALUES(87,'francium','Fr');
+INSERT INTO element VALUES(88,'radium','Ra');
+INSERT INTO element VALUES(89,'actinium','Ac');
+INSERT INTO element VALUES(90,'thorium','Th');
+INSERT INTO element VALUES(91,'protactinium','Pa');
+INSERT INTO element VALUES(92,'uranium','U');
+INSERT INTO element VALUES(93,'neptunium','Np');
+INSERT INTO element VALUES(94,'plutonium','Pu');
+INSERT INTO element VALUES(95,'americium','Am');
+INSERT INTO element VALUES(96,'curium','Cm');
+INSERT INTO element VALUES(97,'berkelium','Bk');
+INSERT INTO element VALUES(98,'californium','Cf');
+INSERT INTO element VALUES(99,'einsteinium','Es');
+INSERT INTO element VALUES(100,'fermium','Fm');
+INSERT INTO element VALUES(101,'mendelevium','Md');
+INSERT INTO element VALUES(102,'nobelium','No');
+INSERT INTO element VALUES(103,'lawerencium','Lw');
+INSERT INTO element VALUES(104,'rutherfordium','Rf');
+INSERT INTO element VALUES(105,'dubnium','Ha');
+INSERT INTO element VALUES(106,'seaborgium','Sg');
+INSERT INTO element VALUES(107,'bohrium','Bh');
+INSERT INTO element VALUES(108,'hassium','Hs');
+INSERT INTO element VALUES(109,'meitnerium','Mt');
+INSERT INTO element VALUES(110,'darmstadtium','Ds');
+INSERT INTO element VALUES(111,'roentgenium','Rg');
+INSERT INTO element VALUES(112,'copernicium','Cn');
 CREATE TABLE edge (
 	id INTEGER NOT NULL,
 	name TEXT NOT NULL,
@@ -188,11 +182,11 @@ CREATE TABLE edge (
 	UNIQUE (name),
 	UNIQUE (level)
 );
-INSERT INTO "edge" VALUES(1,'K','1s');
-INSERT INTO "edge" VALUES(2,'L3','2p3/2');
-INSERT INTO "edge" VALUES(3,'L2','2p1/2');
-INSERT INTO "edge" VALUES(4,'L1','2s');
-INSERT INTO "edge" VALUES(5,'M4,5','3d3/2,5/2');
+INSERT INTO edge VALUES(1,'K','1s');
+INSERT INTO edge VALUES(2,'L3','2p3/2');
+INSERT INTO edge VALUES(3,'L2','2p1/2');
+INSERT INTO edge VALUES(4,'L1','2s');
+INSERT INTO edge VALUES(5,'M4,5','3d3/2,5/2');
 CREATE TABLE energy_units (
 	id INTEGER NOT NULL,
 	units TEXT NOT NULL,
@@ -200,28 +194,40 @@ CREATE TABLE energy_units (
 	PRIMARY KEY (id),
 	UNIQUE (units)
 );
-INSERT INTO "energy_units" VALUES(1,'eV','electronVolts');
-INSERT INTO "energy_units" VALUES(2,'keV','kiloelectronVolts');
-INSERT INTO "energy_units" VALUES(3,'degrees','angle in degrees for Bragg monochromator.  Needs mono d_spacing');
-CREATE TABLE mode (
+INSERT INTO energy_units VALUES(1,'eV','electronVolts');
+INSERT INTO energy_units VALUES(2,'keV','kiloelectronVolts');
+INSERT INTO energy_units VALUES(3,'degrees','angle in degrees for Bragg monochromator.  Needs mono d_spacing');
+CREATE TABLE crystal_structure (
 	id INTEGER NOT NULL,
 	name TEXT NOT NULL,
 	notes TEXT,
+	format TEXT,
+	data TEXT,
 	PRIMARY KEY (id),
 	UNIQUE (name)
 );
-INSERT INTO "mode" VALUES(1,'transmission','transmission intensity through sample');
-INSERT INTO "mode" VALUES(2,'fluorescence','X-ray fluorescence, no further details');
-INSERT INTO "mode" VALUES(3,'fluorescence, total yield','X-ray fluorescence, no energy analysis');
-INSERT INTO "mode" VALUES(4,'fluorescence, energy analyzed','X-ray fluorescence with an energy dispersive detector');
-INSERT INTO "mode" VALUES(5,'xeol','visible or uv light emission');
-INSERT INTO "mode" VALUES(6,'electron emission','emitted electrons from sample');
-CREATE TABLE crystal_structure (
+CREATE TABLE person (
+	id INTEGER NOT NULL,
+	email TEXT NOT NULL,
+	notes TEXT,
+	name TEXT NOT NULL,
+	password TEXT,
+	affiliation TEXT,
+	confirmed TEXT,
+	PRIMARY KEY (id),
+	UNIQUE (email)
+);
+CREATE TABLE citation (
 	id INTEGER NOT NULL,
 	name TEXT NOT NULL,
 	notes TEXT,
-	format TEXT,
-	data TEXT,
+	journal TEXT,
+	authors TEXT,
+	title TEXT,
+	volume TEXT,
+	pages TEXT,
+	year TEXT,
+	doi TEXT,
 	PRIMARY KEY (id),
 	UNIQUE (name)
 );
@@ -238,71 +244,66 @@ CREATE TABLE sample (
 	FOREIGN KEY(person_id) REFERENCES person (id),
 	FOREIGN KEY(crystal_structure_id) REFERENCES crystal_structure (id)
 );
-CREATE TABLE beamline (
-	id INTEGER NOT NULL,
-	name TEXT NOT NULL,
-	notes TEXT,
-	xray_source TEXT,
-	facility_id INTEGER,
-	PRIMARY KEY (id),
-	UNIQUE (name),
-	FOREIGN KEY(facility_id) REFERENCES facility (id)
-);
-INSERT INTO "beamline" VALUES(1,'13ID','GSECARS 13-ID','APS Undulator A',6);
-INSERT INTO "beamline" VALUES(2,'13BM','GSECARS 13-BM','APS bending magnet',6);
-INSERT INTO "beamline" VALUES(3,'10ID','MR-CAT  10-ID','APS Undulator A',6);
-INSERT INTO "beamline" VALUES(4,'10BM','MR-CAT  10-BM','APS Bending Magnet',6);
-INSERT INTO "beamline" VALUES(5,'20ID','PNC/XOR 20-ID','APS Undulator A',6);
-INSERT INTO "beamline" VALUES(6,'20BM','PNC/XOR 20-BM','APS Bending Magnet',6);
-INSERT INTO "beamline" VALUES(7,'X11A','NSLS X11-A','NSLS bending magnet',3);
-INSERT INTO "beamline" VALUES(8,'2-3','SSRL, 2-3','',1);
-INSERT INTO "beamline" VALUES(9,'4-3','SSRL, 4-3','',1);
-INSERT INTO "beamline" VALUES(10,'4-1','SSRL, 4-1','',1);
 CREATE TABLE suite (
 	id INTEGER NOT NULL,
 	name TEXT NOT NULL,
 	notes TEXT,
 	person_id INTEGER,
+	rating_summary TEXT,
+	rating_avg FLOAT,
+	rating_count INTEGER,
+	rating_sum INTEGER,
 	PRIMARY KEY (id),
 	UNIQUE (name),
 	FOREIGN KEY(person_id) REFERENCES person (id)
 );
-CREATE TABLE suite_rating (
+CREATE TABLE beamline (
 	id INTEGER NOT NULL,
-	score INTEGER,
-	datetime DATETIME,
-	comments TEXT,
-	person_id INTEGER,
-	suite_id INTEGER,
+	name TEXT NOT NULL,
+	notes TEXT,
+	xray_source TEXT,
+	facility_id INTEGER,
 	PRIMARY KEY (id),
-	FOREIGN KEY(person_id) REFERENCES person (id),
-	FOREIGN KEY(suite_id) REFERENCES suite (id)
+	UNIQUE (name),
+	FOREIGN KEY(facility_id) REFERENCES facility (id)
 );
+INSERT INTO beamline VALUES(1,'13ID','GSECARS 13-ID','APS Undulator A',6);
+INSERT INTO beamline VALUES(2,'13BM','GSECARS 13-BM','APS bending magnet',6);
+INSERT INTO beamline VALUES(3,'10ID','MR-CAT  10-ID','APS Undulator A',6);
+INSERT INTO beamline VALUES(4,'10BM','MR-CAT  10-BM','APS Bending Magnet',6);
+INSERT INTO beamline VALUES(5,'20ID','PNC/XOR 20-ID','APS Undulator A',6);
+INSERT INTO beamline VALUES(6,'20BM','PNC/XOR 20-BM','APS Bending Magnet',6);
+INSERT INTO beamline VALUES(7,'X11A','NSLS X11-A','NSLS bending magnet',3);
+INSERT INTO beamline VALUES(8,'X23A2','NSLS X23-A2','NSLS bending magnet',3);
+INSERT INTO beamline VALUES(9,'6BM','NSLS-II BMM','NSLS-II 3-pole wiggle',10);
+INSERT INTO beamline VALUES(10,'7BM','NSLS-II QAS','NSLS-II 3-pole wiggle',10);
+INSERT INTO beamline VALUES(11,'8BM','NSLS-II TES','NSLS-II 3-pole wiggle',10);
+INSERT INTO beamline VALUES(12,'8ID','NSLS-II ISS','NSLS-II damping wiggle',10);
+INSERT INTO beamline VALUES(13,'23ID-2','NSLS-II IOS','NSLS-II undulator',10);
+INSERT INTO beamline VALUES(14,'BL8','SLRI Beamline 8','bend magnet',11);
+INSERT INTO beamline VALUES(15,'BL 2-3','SSRL, 2-3','SSRL Bending Magnet',1);
+INSERT INTO beamline VALUES(16,'BL 4-3','SSRL, 4-3','SSRL Wiggler',1);
+INSERT INTO beamline VALUES(17,'BL 10-2','SSRL, 10-2','SSRL Wiggler',1);
+INSERT INTO beamline VALUES(18,'BL 11-2','SSRL, 11-2','SSRL Wiggler',1);
+INSERT INTO beamline VALUES(19,'BL 14-3','SSRL, 14-3','SSRL Bending Magnet',1);
+INSERT INTO beamline VALUES(20,'BL 7-3','SSRL, 7-3','SSRL Wiggler',1);
+INSERT INTO beamline VALUES(21,'BL 9-3','SSRL, 9-3','SSRL Wiggler',1);
+INSERT INTO beamline VALUES(22,'BL 4-1','SSRL, 4-1','SSRL Wiggler',1);
 CREATE TABLE spectrum (
 	id INTEGER NOT NULL,
 	name TEXT NOT NULL,
 	notes TEXT,
-	energy TEXT,
-	i0 TEXT,
-	itrans TEXT,
-	ifluor TEXT,
-	irefer TEXT,
-	energy_stderr TEXT,
-	i0_stderr TEXT,
-	itrans_stderr TEXT,
-	ifluor_stderr TEXT,
-	irefer_stderr TEXT,
 	energy_notes TEXT,
 	i0_notes TEXT,
 	itrans_notes TEXT,
 	ifluor_notes TEXT,
 	irefer_notes TEXT,
 	temperature TEXT,
-	filetext TEXT,
 	comments TEXT,
 	d_spacing FLOAT,
 	submission_date DATETIME,
 	collection_date DATETIME,
+	modify_date DATETIME,
 	reference_used INTEGER,
 	energy_units_id INTEGER,
 	person_id INTEGER,
@@ -313,6 +314,17 @@ CREATE TABLE spectrum (
 	citation_id INTEGER,
 	reference_mode_id INTEGER,
 	reference_id INTEGER,
+	rating_summary TEXT,
+	rating_avg FLOAT,
+	rating_count INTEGER,
+	rating_sum INTEGER,
+	npts INTEGER,
+	emin FLOAT,
+	emax FLOAT,
+	estep FLOAT,
+	e0 FLOAT,
+	edge_step FLOAT,
+	has_reference INTEGER,
 	PRIMARY KEY (id),
 	FOREIGN KEY(energy_units_id) REFERENCES energy_units (id),
 	FOREIGN KEY(person_id) REFERENCES person (id),
@@ -324,20 +336,51 @@ CREATE TABLE spectrum (
 	FOREIGN KEY(reference_mode_id) REFERENCES mode (id),
 	FOREIGN KEY(reference_id) REFERENCES sample (id)
 );
-CREATE TABLE spectrum_suite (
+CREATE TABLE suite_rating (
 	id INTEGER NOT NULL,
+	score INTEGER,
+	datetime DATETIME,
+	comments TEXT,
+	person_id INTEGER,
 	suite_id INTEGER,
-	spectrum_id INTEGER,
 	PRIMARY KEY (id),
-	FOREIGN KEY(suite_id) REFERENCES suite (id),
+	FOREIGN KEY(person_id) REFERENCES person (id),
+	FOREIGN KEY(suite_id) REFERENCES suite (id)
+);
+CREATE TABLE spectrum_data (
+	spectrum_id INTEGER NOT NULL,
+	energy TEXT,
+	i0 TEXT,
+	itrans TEXT,
+	ifluor TEXT,
+	irefer TEXT,
+	energy_stderr TEXT,
+	i0_stderr TEXT,
+	itrans_stderr TEXT,
+	ifluor_stderr TEXT,
+	irefer_stderr TEXT,
+	filetext TEXT,
+	PRIMARY KEY (spectrum_id),
 	FOREIGN KEY(spectrum_id) REFERENCES spectrum (id)
 );
-CREATE TABLE spectrum_mode (
-	id INTEGER NOT NULL,
-	mode_id INTEGER,
-	spectrum_id INTEGER,
-	PRIMARY KEY (id),
-	FOREIGN KEY(mode_id) REFERENCES mode (id),
+CREATE TABLE spectrum_derived (
+	spectrum_id INTEGER NOT NULL,
+	channel VARCHAR(16) NOT NULL,
+	version VARCHAR(16),
+	params TEXT,
+	e0 FLOAT,
+	edge_step FLOAT,
+	pre_coefs TEXT,
+	norm_coefs TEXT,
+	norm TEXT,
+	PRIMARY KEY (spectrum_id, channel),
+	FOREIGN KEY(spectrum_id) REFERENCES spectrum (id)
+);
+CREATE TABLE spectrum_xanes (
+	spectrum_id INTEGER NOT NULL,
+	grid VARCHAR(32),
+	xanes BLOB,
+	PRIMARY KEY (spectrum_id),
 	FOREIGN KEY(spectrum_id) REFERENCES spectrum (id)
 );
 CREATE TABLE spectrum_rating (
@@ -351,6 +394,22 @@ CREATE TABLE spectrum_rating (
 	FOREIGN KEY(person_id) REFERENCES person (id),
 	FOREIGN KEY(spectrum_id) REFERENCES spectrum (id)
 );
+CREATE TABLE spectrum_suite (
+	id INTEGER NOT NULL,
+	suite_id INTEGER,
+	spectrum_id INTEGER,
+	PRIMARY KEY (id),
+	FOREIGN KEY(suite_id) REFERENCES suite (id),
+	FOREIGN KEY(spectrum_id) REFERENCES spectrum (id)
+);
+CREATE TABLE spectrum_mode (
+	id INTEGER NOT NULL,
+	mode_id INTEGER,
+	spectrum_id INTEGER,
+	PRIMARY KEY (id),
+	FOREIGN KEY(mode_id) REFERENCES mode (id),
+	FOREIGN KEY(spectrum_id) REFERENCES spectrum (id)
+);
 CREATE TABLE spectrum_ligand (
 	id INTEGER NOT NULL,
 	ligand_id INTEGER,
@@ -359,4 +418,34 @@ CREATE TABLE spectrum_ligand (
 	FOREIGN KEY(ligand_id) REFERENCES ligand (id),
 	FOREIGN KEY(spectrum_id) REFERENCES spectrum (id)
 );
+CREATE INDEX ix_sample_name ON sample (name);
+CREATE INDEX ix_beamline_facility_id ON beamline (facility_id);
+CREATE INDEX ix_spectrum_element_z ON spectrum (element_z);
+CREATE INDEX ix_spectrum_beamline_id ON spectrum (beamline_id);
+CREATE INDEX ix_spectrum_emin ON spectrum (emin);
+CREATE INDEX ix_spectrum_person_id ON spectrum (person_id);
+CREATE INDEX ix_spectrum_element_z_name ON spectrum (element_z, name);
+CREATE INDEX ix_spectrum_element_z_rating_avg ON spectrum (element_z, rating_avg);
+CREATE INDEX ix_spectrum_npts ON spectrum (npts);
+CREATE INDEX ix_spectrum_edge_step ON spectrum (edge_step);
+CREATE INDEX ix_spectrum_name ON spectrum (name);
+CREATE INDEX ix_spectrum_rating_avg ON spectrum (rating_avg);
+CREATE INDEX ix_spectrum_element_z_beamline_id ON spectrum (element_z, beamline_id);
+CREATE INDEX ix_spectrum_estep ON spectrum (estep);
+CREATE INDEX ix_spectrum_e0 ON spectrum (e0);
+CREATE INDEX ix_spectrum_citation_id ON spectrum (citation_id);
+CREATE INDEX ix_spectrum_element_z_edge_id ON spectrum (element_z, edge_id);
+CREATE INDEX ix_spectrum_emax ON spectrum (emax);
+CREATE INDEX ix_spectrum_sample_id ON spectrum (sample_id);
+CREATE INDEX ix_spectrum_edge_id ON spectrum (edge_id);
+CREATE INDEX ix_suite_rating_suite_id ON suite_rating (suite_id);
+CREATE UNIQUE INDEX ix_suite_rating_person_id_suite_id ON suite_rating (person_id, suite_id);
+CREATE INDEX ix_spectrum_rating_spectrum_id ON spectrum_rating (spectrum_id);
+CREATE UNIQUE INDEX ix_spectrum_rating_person_id_spectrum_id ON spectrum_rating (person_id, spectrum_id);
+CREATE INDEX ix_spectrum_suite_spectrum_id ON spectrum_suite (spectrum_id);
+CREATE INDEX ix_spectrum_suite_suite_id ON spectrum_suite (suite_id);
+CREATE INDEX ix_spectrum_mode_spectrum_id ON spectrum_mode (spectrum_id);
+CREATE INDEX ix_spectrum_mode_mode_id ON spectrum_mode (mode_id);
+CREATE INDEX ix_spectrum_ligand_spectrum_id ON spectrum_ligand (spectrum_id);
+CREATE INDEX ix_spectrum_ligand_ligand_id ON spectrum_ligand (ligand_id);
 COMMIT;
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+time e0 detection, remove_dups(), remove_nans2() and preedge() in
+xasdb.xafs_preedge against version 1.0 of them (xafs_preedge_1_0.py),
+on synthetic spectra of 500 to 20,000 points.  test_preedge.py checks
+that the results agree.
+
+usage:  python bench_preedge.py
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import xafs_preedge_1_0 as v10
+from test_preedge import synthetic_spectrum, add_nans
+
+from xasdb.xafs_preedge import find_e0, remove_dups, remove_nans2, preedge
+
+def find_e0_1_0(energy, mu):
+    "e0 detection of preedge() 1.0, copied out of it for timing"
+    dmu = np.gradient(mu)/np.gradient(energy)
+    # find points of high derivative
+    high_deriv_pts = np.where(dmu >  max(dmu)*0.05)[0]
+    idmu_max, dmu_max = 0, 0
+    for i in high_deriv_pts:
+        if (dmu[i] > dmu_max and
+            (i+1 in high_deriv_pts) and
+            (i-1 in high_deriv_pts)):
+            idmu_max, dmu_max = i, dmu[i]
+
+    return energy[idmu_max]
+
+def timeit(func, *args, **kws):
+    "best time in msec of several calls of func(*args)"
+    nrep = kws.get('nrep', 5)
+    best = None
+    for i in range(nrep):
+        t0 = time.time()
+        func(*args)
+        dt = 1000.0*(time.time() - t0)
+        if best is None or dt < best:
+            best = dt
+    return best
+
+def main():
+    print('%8s %22s %22s %22s %22s' % ('npts', 'e0 (1.0/new ms)',
+                                       'remove_dups', 'remove_nans2',
+                                       'preedge'))
+    for npts in (500, 1000, 2000, 5000, 10000, 20000):
+        energy, mu = synthetic_spectrum(npts)
+        en = remove_dups(energy)
+        mu_nan, idx = add_nans(en, mu, en[0], en[-1])
+        times = []
+        for old, new, args in ((find_e0_1_0, find_e0, (en, mu)),
+                               (v10.remove_dups, remove_dups, (energy,)),
+                               (v10.remove_nans2, remove_nans2,
+                                (en, mu_nan)),
+                               (v10.preedge, preedge, (energy, mu))):
+            told, tnew = timeit(old, *args), timeit(new, *args)
+            times.append('%8.3f/%6.3f (x%4.0f)' % (told, tnew, told/tnew))
+        print('%8i %s' % (npts, ' '.join(times)))
+
+if __name__ == '__main__':
+    main()
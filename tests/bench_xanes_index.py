@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+recall@k and query time of the approximate XANES index (xanes_index.py)
+against exact search (similarity.rank_similar), for synthetic groups
+of 10,000 to 200,000 normalized XANES vectors, the time of
+XASDataLibrary.find_similar() on libraries holding such groups, with
+the in-process caches warm and after another process has written to
+the library, and optionally recall for the spectra of a library.
+
+The synthetic spectra are those of test_similar.py.
+
+usage:  python bench_xanes_index.py [library_file]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from test_similar import synthetic_xanes, make_library
+
+from xasdb.similarity import rank_similar
+from xasdb.xanes_index import XANESIndex
+
+NQUERY = 100
+K = 10
+CONFIGS = ((8, 12, 0), (8, 12, 1), (16, 12, 1), (8, 16, 1),
+           (8, 16, 2), (16, 16, 2), (8, 20, 2))
+
+def bench_synthetic():
+    print('%8s %8s %6s %7s %10s %12s %12s %9s' % (
+        'spectra', 'ntables', 'nbits', 'probes', 'build(s)',
+        'candidates', 'recall@%i' % K, 'msec'))
+    for nspectra in (10000, 50000, 200000):
+        allvecs = synthetic_xanes(nspectra + NQUERY, seed=nspectra)
+        ids = np.arange(nspectra)
+        matrix, queries = allvecs[:nspectra], allvecs[nspectra:]
+        t0 = time.time()
+        exact = [rank_similar(matrix, q, k=K)[0] for q in queries]
+        texact = 1000.0*(time.time() - t0)/NQUERY
+        print('%8i %35s %12s %12.3f %9.2f' % (nspectra, 'exact', '',
+                                               1.0, texact))
+        for ntables, nbits, probes in CONFIGS:
+            index = XANESIndex(ntables=ntables, nbits=nbits)
+            t0 = time.time()
+            index.build(ids, matrix)
+            tbuild = time.time() - t0
+            recall, ncand = 0.0, 0
+            t0 = time.time()
+            for q, best in zip(queries, exact):
+                found, scores = index.search(q, ids, matrix, k=K,
+                                             probes=probes)
+                recall += len(np.intersect1d(found, best))/float(K)
+            tquery = 1000.0*(time.time() - t0)/NQUERY
+            for q in queries:
+                ncand += len(index.candidates(q, probes=probes))
+            print('%8i %8i %6i %7i %10.2f %12i %12.3f %9.2f' % (
+                nspectra, ntables, nbits, probes, tbuild, ncand//NQUERY,
+                recall/NQUERY, tquery))
+
+def bench_find_similar():
+    """msec per find_similar() query, with caches warm and after a
+    write by another process (which drops the in-process caches)"""
+    print('%8s %14s %14s %14s %14s' % ('spectra', 'exact', 'exact/write',
+                                       'approx', 'approx/write'))
+    for nspectra in (10000, 50000):
+        folder = tempfile.mkdtemp()
+        try:
+            db = make_library(os.path.join(folder, 'bench.db'), nspectra)
+            db.get_xanes_index(29, 1)
+            queries = np.random.RandomState(0).randint(1, nspectra+1,
+                                                       NQUERY//4)
+            times = []
+            for approximate in (False, True):
+                for write in (False, True):
+                    t0 = time.time()
+                    for spectrum_id in queries:
+                        if write:
+                            db.set_mod_time()
+                            db.refresh_cache()
+                        db.find_similar(int(spectrum_id), k=K,
+                                        approximate=approximate)
+                    times.append(1000.0*(time.time() - t0)/len(queries))
+            print('%8i %14.2f %14.2f %14.2f %14.2f' % tuple([nspectra] +
+                                                            times))
+            db.close()
+        finally:
+            shutil.rmtree(folder)
+
+def bench_library(fname):
+    "exact and approximate find_similar() for each spectrum of a library"
+    from xasdb import connect_xasdb
+    db = connect_xasdb(fname)
+    recall, nquery, texact, tapprox = 0.0, 0, 0.0, 0.0
+    for row in db.get_spectra():
+        t0 = time.time()
+        try:
+            exact = db.find_similar(row.id, k=K, approximate=False)
+        except Exception:
+            continue
+        t1 = time.time()
+        approx = db.find_similar(row.id, k=K, approximate=True)
+        t2 = time.time()
+        texact, tapprox = texact + t1 - t0, tapprox + t2 - t1
+        nquery += 1
+        if len(exact) > 0:
+            best = set([spid for spid, score in exact])
+            found = set([spid for spid, score in approx])
+            recall += len(best & found)/float(len(best))
+        else:
+            recall += 1
+    if nquery > 0:
+        print('%s: %i spectra, recall@%i %.3f, exact %.2f msec, '
+              'approximate %.2f msec' % (fname, nquery, K, recall/nquery,
+                                         1000*texact/nquery,
+                                         1000*tapprox/nquery))
+
+if __name__ == '__main__':
+    bench_synthetic()
+    bench_find_similar()
+    if len(sys.argv) > 1:
+        bench_library(sys.argv[1])
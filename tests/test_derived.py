@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+check that the normalization parameters given to recompute_derived()
+are kept as those of the library: reading normalized spectra, and
+adding spectra, use them rather than the defaults of preedge().
+
+usage:  pytest test_derived.py
+"""
+import os
+import glob
+import json
+
+import xasdb
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+PARAMS = {'pre2': -40, 'nnorm': 2}
+
+def make_library(dbname, exclude='cu_metal'):
+    "new library holding the example spectra, except those named exclude"
+    xasdb.create_xasdb(dbname)
+    db = xasdb.connect_xasdb(dbname)
+    db.add_person('person', 'person@example.com')
+    db.add_beamline('13-BM-D', facility_id=6)
+    db.add_beamline('13-ID-C', facility_id=6)
+    for fname in sorted(glob.glob(os.path.join(DATA, '*.xdi'))):
+        if 'upload' not in fname and exclude not in fname:
+            db.add_xdifile(fname, person='person@example.com')
+    return db
+
+def stored_params(db):
+    "{spectrum_id: params} for the stored normalized spectra"
+    tab = db.tables['spectrum_derived']
+    out = {}
+    for row in tab.select().execute().fetchall():
+        out.setdefault(row.spectrum_id, []).append(json.loads(row.params))
+    return out
+
+def test_default_params(tmp_path):
+    db = make_library(str(tmp_path / 'derived.db'))
+    assert db.get_normalize_params() == {}
+    nnorm = 0
+    for row in db.get_spectra():
+        for channel in db.get_derived(row.id).values():
+            assert channel['params'] == {}
+            nnorm += 1
+    assert nnorm > 0
+    db.close()
+
+def test_recompute_params(tmp_path):
+    dbname = str(tmp_path / 'derived.db')
+    db = make_library(dbname)
+    spectra = db.get_spectra()
+    assert db.recompute_derived(params=PARAMS) == len(spectra)
+    assert db.get_normalize_params() == PARAMS
+    before = stored_params(db)
+
+    for row in spectra:
+        derived = db.get_derived(row.id)
+        for channel in derived.values():
+            assert channel['params'] == PARAMS
+    assert stored_params(db) == before
+
+    spectrum_id = db.add_xdifile(os.path.join(DATA, 'cu_metal_rt.xdi'),
+                                 person='person@example.com')
+    derived = db.get_derived(spectrum_id)
+    assert derived['sample']['params'] == PARAMS
+    assert all([params == PARAMS
+                for params in stored_params(db)[spectrum_id]])
+    db.close()
+
+    db = xasdb.connect_xasdb(dbname)
+    assert db.get_normalize_params() == PARAMS
+    assert db.get_derived(spectrum_id)['sample']['params'] == PARAMS
+    db.close()
+
+def make_stale(db):
+    "mark the stored normalized spectra as made by an older preedge()"
+    tab = db.tables['spectrum_derived']
+    tab.update().execute(version='0.9')
+
+def count_stale(db):
+    tab = db.tables['spectrum_derived']
+    return len(tab.select(tab.c.version=='0.9').execute().fetchall())
+
+def test_claim_job(tmp_path):
+    db = make_library(str(tmp_path / 'derived.db'))
+    claim = db.claim_job('test')
+    assert claim is not None
+    assert db.claim_job('test') is None
+    renewed = db.claim_job('test', claim=claim)
+    assert renewed is not None
+    assert db.claim_job('test', claim=claim) is None
+    assert db.claim_job('test', timeout=0) is not None
+    db.release_job('test', renewed)
+    assert db.claim_job('test') is None
+    db.close()
+
+def test_recompute_claimed(tmp_path):
+    """only one process runs the background recompute: it does not
+    start while another holds the claim"""
+    dbname = str(tmp_path / 'derived.db')
+    db = make_library(dbname)
+    other = xasdb.connect_xasdb(dbname)
+    claim = other.claim_job('recompute_derived')
+    make_stale(db)
+    nstale = count_stale(db)
+    assert nstale > 0
+    db.start_recompute_derived()
+    db._derived_thread.join()
+    assert count_stale(db) == nstale
+
+    other.release_job('recompute_derived', claim)
+    db.start_recompute_derived()
+    db._derived_thread.join()
+    assert count_stale(db) == 0
+    assert db.get_info('job recompute_derived') == ''
+    other.close()
+    db.close()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+check that a library made with schema version 1.1.0 (creator_1_1_0.py)
+upgrades to the current schema, with the summary columns filled in and
+with every hot query (migrations.HOT_QUERIES) using an index.
+
+usage:  pytest test_migrations.py
+"""
+import os
+import sys
+import glob
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import creator_1_1_0
+
+import xasdb
+from xasdb.migrations import MIGRATIONS, check_query_plans
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+SUMMARY = ('npts', 'emin', 'emax', 'estep', 'e0', 'edge_step',
+           'has_reference')
+
+def make_old_library(dbname):
+    "library with schema 1.1.0 holding the example spectra"
+    creator_1_1_0.make_newdb(dbname)
+    db = xasdb.connect_xasdb(dbname)
+    db.add_person('person', 'person@example.com')
+    db.add_beamline('13-BM-D', facility_id=6)
+    db.add_beamline('13-ID-C', facility_id=6)
+    for fname in sorted(glob.glob(os.path.join(DATA, '*.xdi'))):
+        if 'upload' not in fname:
+            db.add_xdifile(fname, person='person@example.com')
+    return db
+
+def test_upgrade(tmp_path):
+    dbname = str(tmp_path / 'old.db')
+    db = make_old_library(dbname)
+    assert db.get_info('version') == '1.1.0'
+    applied = db.upgrade()
+    assert [version for version, desc in applied] == [
+        m[0] for m in MIGRATIONS]
+    db.close()
+
+    db = xasdb.connect_xasdb(dbname)
+    assert db.get_info('version') == MIGRATIONS[-1][0]
+    assert check_query_plans(db) == []
+    assert db.upgrade() == []
+    tab = db.tables['spectrum']
+    for row in tab.select().execute().fetchall():
+        assert (row.rating_sum, row.rating_count) == (0, 0)
+    db.close()
+
+def test_upgrade_summary(tmp_path):
+    """the summary columns filled in by migration 1.7.0 are those that
+    the current code makes"""
+    dbname = str(tmp_path / 'old.db')
+    make_old_library(dbname).upgrade()
+    db = xasdb.connect_xasdb(dbname)
+    tab = db.tables['spectrum']
+    query = tab.select().order_by(tab.c.id)
+    migrated = [[row[name] for name in SUMMARY]
+                for row in query.execute().fetchall()]
+    assert len(migrated) > 0 and all([row[0] > 0 for row in migrated])
+    db.update_summary(stale_only=False)
+    current = [[row[name] for name in SUMMARY]
+               for row in query.execute().fetchall()]
+    for old, new in zip(migrated, current):
+        assert old[:4] + old[6:] == new[:4] + new[6:]
+        for a, b in zip(old[4:6], new[4:6]):
+            assert (a is None) == (b is None)
+            if a is not None:
+                assert np.isclose(a, b, rtol=1.e-6)
+    db.close()
+
+def test_new_library(tmp_path):
+    dbname = str(tmp_path / 'new.db')
+    xasdb.create_xasdb(dbname)
+    db = xasdb.connect_xasdb(dbname)
+    assert db.get_info('version') == MIGRATIONS[-1][0]
+    assert check_query_plans(db) == []
+    assert db.upgrade() == []
+    db.close()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+check that page_spectra() pages through the spectra in the order of
+get_spectra(), for every column of sort_columns(), in both directions
+and with small pages, where columns hold repeated values and NULLs
+(e0 of spectra that cannot be normalized, rating_avg of spectra that
+are not rated).
+
+usage:  pytest test_paging.py
+"""
+import os
+import glob
+import pytest
+
+import xasdb
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    "library holding the example spectra, some of them rated"
+    dbname = str(tmp_path_factory.mktemp('paging') / 'paging.db')
+    xasdb.create_xasdb(dbname)
+    db = xasdb.connect_xasdb(dbname)
+    person = db.add_person('person', 'person@example.com')
+    db.add_beamline('13-BM-D', facility_id=6)
+    db.add_beamline('13-ID-C', facility_id=6)
+    for fname in sorted(glob.glob(os.path.join(DATA, '*.xdi'))):
+        if 'upload' not in fname:
+            db.add_xdifile(fname, person='person@example.com')
+    for spectrum_id, score in ((2, 4), (5, 1), (7, 4), (11, 3)):
+        db.set_spectrum_rating(person, spectrum_id, score)
+    yield db
+    db.close()
+
+def sort_key(column):
+    """key to sort rows by column and then id, with NULLs first (as in
+    sqlite) in ascending order"""
+    def key(row):
+        value = row[column]
+        return (value is not None, value, row.id)
+    return key
+
+def all_pages(db, column, reverse, limit, summary=False):
+    "rows of all pages of page_spectra(), checking the page sizes"
+    out, after = [], None
+    while True:
+        rows, after = db.page_spectra(after=after, limit=limit,
+                                      orderby=column, reverse=reverse,
+                                      summary=summary)
+        out.extend(rows)
+        if after is None:
+            assert len(rows) <= limit
+            return out
+        assert len(rows) == limit and after == rows[-1].id
+
+def test_sort_columns(db):
+    columns = db.sort_columns()
+    for column in ('id', 'name', 'e0', 'element_z', 'rating_avg'):
+        assert column in columns
+    rows = db.get_spectra()
+    for column in ('e0', 'rating_avg'):
+        values = [row[column] for row in rows]
+        assert None in values and len(set(values)) > 2
+
+@pytest.mark.parametrize('reverse', (False, True))
+@pytest.mark.parametrize('limit', (1, 2, 3, 5))
+def test_page_spectra(db, reverse, limit):
+    for column in db.sort_columns():
+        expected = sorted(db.get_spectra(), key=sort_key(column),
+                          reverse=reverse)
+        found = all_pages(db, column, reverse, limit)
+        assert [row.id for row in found] == [row.id for row in expected], (
+            column)
+        ordered = db.get_spectra(orderby=column, reverse=reverse)
+        assert [row[column] for row in found] == [row[column]
+                                                  for row in ordered], column
+
+def test_page_summary(db):
+    for column in ('e0', 'rating_avg', 'name'):
+        for reverse in (False, True):
+            found = all_pages(db, column, reverse, 2, summary=True)
+            expected = all_pages(db, column, reverse, 100)
+            assert [row.id for row in found] == [row.id for row in expected]
+
+def test_page_unknown(db):
+    with pytest.raises(xasdb.XASDBException):
+        db.page_spectra(orderby='comments')
+    with pytest.raises(xasdb.XASDBException):
+        db.page_spectra(after=9999, orderby='e0')
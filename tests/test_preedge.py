@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+check xasdb.xafs_preedge against version 1.0 of it (a verbatim copy in
+xafs_preedge_1_0.py), using the XDI files in data/ and synthetic
+spectra with repeated energies and NaNs.
+
+usage:  pytest test_preedge.py
+"""
+import os
+import sys
+import glob
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import xafs_preedge_1_0 as v10
+
+from xasdb.xasdb import read_xdifile, spectrum_mu
+from xasdb.xafs_preedge import (remove_dups, remove_nans2, preedge,
+                                preedge_batch)
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+def data_spectra(folder=DATA):
+    "(name, energy, mu) for the XDI files in folder that give mu(E)"
+    for fname in sorted(glob.glob(os.path.join(folder, '*.xdi'))):
+        rec = read_xdifile(fname)
+        mode = rec['modes'][0] if len(rec['modes']) > 0 else 'transmission'
+        energy, mu, mu_refer = spectrum_mu(rec['energy'], i0=rec['i0'],
+                                           itrans=rec['itrans'],
+                                           ifluor=rec['ifluor'],
+                                           irefer=rec['irefer'], mode=mode,
+                                           energy_units=rec['energy_units'])
+        if energy is not None and mu is not None:
+            yield os.path.basename(fname), energy, mu
+
+def synthetic_spectrum(npts, e0=7112.0, noise=2.e-3, seed=None):
+    """noisy mu(E) with an edge at e0, over e0-200 to e0+1000 eV, with
+    repeated energies, some in runs of three"""
+    rand = np.random.RandomState(npts if seed is None else seed)
+    energy = np.linspace(e0-200, e0+1000, npts)
+    mu = (0.2 + 1.0e-4*(energy-e0) + 1/(1+np.exp(-(energy-e0)/2.0)) +
+          0.05*np.sin((energy-e0)/15.0)*(energy > e0) +
+          noise*rand.normal(size=npts))
+    ndups = max(20, npts//50)
+    idx = rand.randint(1, npts-3, ndups)
+    energy[idx+1] = energy[idx]
+    energy[idx[:3]+2] = energy[idx[:3]]
+    energy.sort()
+    return energy, mu
+
+def add_nans(energy, mu, emin, emax, nnans=5, seed=0):
+    """mu with NaNs at nnans points between emin and emax, away from
+    repeated energies and the ends, and the indices of those points"""
+    rand = np.random.RandomState(seed)
+    inc = np.diff(energy) > 0
+    ok = np.zeros(len(energy), dtype=bool)
+    ok[1:-2] = inc[:-2] & inc[1:-1] & inc[2:]
+    ok &= (energy > emin) & (energy < emax)
+    idx = np.sort(rand.choice(np.where(ok)[0], nnans, replace=False))
+    mu = mu.copy()
+    mu[idx] = np.nan
+    return mu, idx
+
+def mismatches(new, old, points=None):
+    """keys of the preedge() dictionaries new and old that differ, with
+    arrays compared at points (default: all) and NaNs equal to NaNs"""
+    out = []
+    if set(new) != set(old):
+        out.append('keys')
+    for key in sorted(set(new) & set(old)):
+        a, b = np.asarray(new[key]), np.asarray(old[key])
+        if points is not None and a.shape == (len(points),):
+            a = a[points]
+        if a.shape != b.shape or not np.array_equal(a, b, equal_nan=True):
+            out.append(key)
+    return out
+
+def test_remove_dups():
+    for npts in (500, 2000, 20000):
+        energy, mu = synthetic_spectrum(npts)
+        assert np.array_equal(remove_dups(energy), v10.remove_dups(energy))
+    for name, energy, mu in data_spectra():
+        assert np.array_equal(remove_dups(energy),
+                              v10.remove_dups(energy)), name
+
+def test_remove_nans2():
+    energy, mu = synthetic_spectrum(1000)
+    for new, old in zip(remove_nans2(energy, mu),
+                        v10.remove_nans2(energy, mu)):
+        assert np.array_equal(new, old)
+    # version 1.0 compared with 'a==np.nan', so never removed NaNs
+    mu_nan, idx = add_nans(energy, mu, energy[0], energy[-1])
+    mu_nan[-1] = -np.inf
+    e1, m1 = remove_nans2(energy, mu_nan)
+    good = np.isfinite(mu_nan)
+    assert np.array_equal(e1, energy[good]) and np.array_equal(m1, mu[good])
+    e1, m1 = v10.remove_nans2(energy, mu_nan)
+    assert len(e1) == len(energy) and np.isnan(m1[idx]).all()
+
+def test_preedge_data():
+    nfiles = 0
+    for name, energy, mu in data_spectra():
+        assert mismatches(preedge(energy, mu),
+                          v10.preedge(energy, mu)) == [], name
+        nfiles += 1
+    assert nfiles > 0
+
+def test_preedge_synthetic():
+    for npts in (500, 1000, 2000, 5000, 10000, 20000):
+        energy, mu = synthetic_spectrum(npts)
+        for kws in ({}, {'nnorm': 2}, {'nnorm': 5, 'nvict': 1},
+                    {'e0': 7115.0, 'pre1': -150, 'norm1': 50}):
+            assert mismatches(preedge(energy, mu, **kws),
+                              v10.preedge(energy, mu, **kws)) == [], (npts,
+                                                                      kws)
+
+def test_preedge_nans_near_edge():
+    "NaNs outside the fit ranges: results as from 1.0"
+    for npts in (500, 2000, 20000):
+        energy, mu = synthetic_spectrum(npts)
+        mu_nan, idx = add_nans(energy, mu, 7112.0-40, 7112.0+90)
+        assert mismatches(preedge(energy, mu_nan),
+                          v10.preedge(energy, mu_nan)) == [], npts
+
+def test_preedge_nans_in_preedge_fit():
+    """NaNs in the pre-edge fit: 1.0 gave NaN for the pre-edge line.  The
+    results are those of 1.0 for the spectrum without the NaN points."""
+    for npts in (500, 2000, 20000):
+        energy, mu = synthetic_spectrum(npts)
+        mu_nan, idx = add_nans(energy, mu, 7112.0-190, 7112.0-60)
+        new, old = preedge(energy, mu_nan), v10.preedge(energy, mu_nan)
+        assert new['e0'] == old['e0'] and np.isnan(old['precoefs']).all()
+
+        good = np.isfinite(mu_nan)
+        without = v10.preedge(energy[good], mu[good])
+        assert mismatches(new, without, points=good) == [], npts
+
+def batch_mismatches(new, old, rtol):
+    """keys of preedge_batch() result new that differ from preedge()
+    result old: fit ranges must be equal, and curves and edge_step
+    equal to within rtol of their largest values"""
+    out = []
+    for key in ('e0', 'pre1', 'pre2', 'norm1', 'norm2', 'nnorm', 'nvict'):
+        if new[key] != old[key]:
+            out.append(key)
+    for key in ('edge_step', 'norm', 'pre_edge', 'post_edge', 'precoefs'):
+        a, b = np.asarray(new[key]), np.asarray(old[key])
+        if (a.shape != b.shape or
+            np.nanmax(abs(a - b)) > rtol*np.nanmax(abs(b))):
+            out.append(key)
+    return out
+
+def test_preedge_batch():
+    """preedge_batch() agrees with preedge() to the tolerance given in
+    its docstring, for spectra of different lengths with repeated
+    energies, in one chunk and in several"""
+    spectra = [synthetic_spectrum(npts, seed=npts)
+               for npts in (37, 120, 499, 500, 1001, 2500, 5000, 20000)]
+    spectra.extend([(energy, mu) for name, energy, mu in data_spectra()])
+    energies = [energy for energy, mu in spectra]
+    mus = [mu for energy, mu in spectra]
+    for kws in ({'nnorm': 1}, {'nnorm': 2}, {}, {'nnorm': 4},
+                {'nnorm': 5}, {'nnorm': 5, 'nvict': 1}, {'nvict': 2},
+                {'e0': 7115.0, 'pre1': -150, 'norm1': 50}):
+        rtol = 1.e-6 if kws.get('nnorm', 3) > 4 else 1.e-9
+        for chunk_points in (100000, 5000):
+            out = preedge_batch(energies, mus, chunk_points=chunk_points,
+                                **kws)
+            for (energy, mu), new in zip(spectra, out):
+                old = preedge(energy, mu, **kws)
+                assert batch_mismatches(new, old, rtol) == [], (len(energy),
+                                                                kws)
+
+def test_preedge_batch_invalid():
+    "None for spectra too short or with energy and mu of different lengths"
+    energy, mu = synthetic_spectrum(500)
+    out = preedge_batch([energy, energy[:2], energy], [mu, mu[:2], mu[:-1]])
+    assert out[0] is not None and out[1] is None and out[2] is None
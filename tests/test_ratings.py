@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+check that the rating totals of spectra and suites (rating_sum,
+rating_count, rating_avg) stay equal to the totals of their ratings
+when many threads rate the same spectrum and suite at once.
+
+usage:  pytest test_ratings.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+from sqlalchemy import select, func
+
+import xasdb
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+NTHREADS = 8
+NPERSONS = 12
+NRATINGS = 40
+
+def make_library(folder):
+    "new library with persons, one spectrum and one suite"
+    dbname = os.path.join(folder, 'ratings.db')
+    xasdb.create_xasdb(dbname)
+    db = xasdb.connect_xasdb(dbname, scoped=True)
+    persons = [db.add_person('person %i' % i, 'p%i@example.com' % i)
+               for i in range(NPERSONS)]
+    db.add_xdifile(os.path.join(DATA, 'cu_metal_rt.xdi'),
+                   person='p0@example.com')
+    spectrum_id = db.get_spectra()[0].id
+    suite_id = db.add_suite('rated suite', person_id=persons[0])
+    return db, persons, spectrum_id, suite_id
+
+def rate(db, persons, spectrum_id, suite_id, seed, errors):
+    "set, change and remove ratings, as one of several threads"
+    try:
+        for i in range(NRATINGS):
+            person = persons[(seed*7 + i) % len(persons)]
+            score = (seed + i) % 6
+            if i % 9 == 8:
+                db.del_spectrum_rating(person, spectrum_id)
+                db.del_suite_rating(person, suite_id)
+            else:
+                db.set_spectrum_rating(person, spectrum_id, score)
+                db.set_suite_rating(person, suite_id, score)
+    except Exception as exc:
+        errors.append(exc)
+
+def totals_mismatches(db, tablename, item_id):
+    "rating totals of a spectrum or suite that differ from its ratings"
+    tab = db.tables[tablename]
+    rtab = db.tables['%s_rating' % tablename]
+    ratings = rtab.c['%s_id' % tablename] == item_id
+    rsum, rcount, ravg = select([func.sum(rtab.c.score),
+                                 func.count(rtab.c.id),
+                                 func.avg(rtab.c.score)]).where(
+                                     ratings).execute().fetchone()
+    row = select([tab.c.rating_sum, tab.c.rating_count,
+                  tab.c.rating_avg]).where(
+                      tab.c.id==item_id).execute().fetchone()
+    out = []
+    if row.rating_count != rcount:
+        out.append('rating_count %s != %s' % (row.rating_count, rcount))
+    if (row.rating_sum or 0) != (rsum or 0):
+        out.append('rating_sum %s != %s' % (row.rating_sum, rsum))
+    if (ravg is None) != (row.rating_avg is None) or (
+            ravg is not None and abs(row.rating_avg - ravg) > 1.e-9):
+        out.append('rating_avg %s != %s' % (row.rating_avg, ravg))
+    return out
+
+def test_concurrent_ratings():
+    folder = tempfile.mkdtemp()
+    try:
+        db, persons, spectrum_id, suite_id = make_library(folder)
+        errors = []
+        threads = [threading.Thread(target=rate,
+                                    args=(db, persons, spectrum_id,
+                                          suite_id, seed, errors))
+                   for seed in range(NTHREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        for tablename, item_id in (('spectrum', spectrum_id),
+                                   ('suite', suite_id)):
+            assert totals_mismatches(db, tablename, item_id) == [], tablename
+            rtab = db.tables['%s_rating' % tablename]
+            npersons = select([func.count(func.distinct(
+                rtab.c.person_id))]).execute().scalar()
+            nrows = select([func.count(rtab.c.id)]).execute().scalar()
+            assert nrows == npersons, tablename
+        db.close()
+    finally:
+        shutil.rmtree(folder)
+
+def test_rating_replaced():
+    "a second rating by a person replaces the first, and returns its id"
+    folder = tempfile.mkdtemp()
+    try:
+        db, persons, spectrum_id, suite_id = make_library(folder)
+        row = db.get_spectrum(spectrum_id)
+        assert (row.rating_sum, row.rating_count, row.rating_avg) == (0, 0,
+                                                                      None)
+        first = db.set_spectrum_rating(persons[0], spectrum_id, 2)
+        db.set_spectrum_rating(persons[1], spectrum_id, 5)
+        assert db.set_spectrum_rating(persons[0], spectrum_id, 4) == first
+        row = db.get_spectrum(spectrum_id)
+        assert (row.rating_sum, row.rating_count) == (9, 2)
+        assert abs(row.rating_avg - 4.5) < 1.e-9
+        db.del_spectrum_rating(persons[0], spectrum_id)
+        db.del_spectrum_rating(persons[1], spectrum_id)
+        row = db.get_spectrum(spectrum_id)
+        assert (row.rating_sum, row.rating_count) == (0, 0)
+        assert row.rating_avg is None
+        db.close()
+    finally:
+        shutil.rmtree(folder)
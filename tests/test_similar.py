@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+check XASDataLibrary.find_similar() with the approximate XANES index
+(xanes_index.py) on libraries of synthetic normalized XANES vectors:
+the spectra found are ranked exactly, after a write to the library
+only the candidates' vectors are read, not those of the whole group,
+and searches run while other threads add spectra to the index.
+
+Synthetic spectra come in families (as for a series of samples of
+one compound) with an edge, a white line and post-edge features of
+random position and size, varied within each family and with noise.
+
+usage:  pytest test_similar.py
+"""
+import threading
+import numpy as np
+
+import xasdb
+from xasdb.similarity import (XANES_GRID, XANES_GRID_NAME, rank_similar,
+                              encode_vector)
+
+NSPECTRA = 3000
+K = 10
+
+def synthetic_xanes(nspectra, nfamily=None, seed=0):
+    "float32 matrix of nspectra normalized XANES on XANES_GRID"
+    if nfamily is None:
+        nfamily = max(10, nspectra//20)
+    rand = np.random.RandomState(seed)
+    x = XANES_GRID
+    family = rand.randint(0, nfamily, nspectra)
+    frand = np.random.RandomState(seed+1)
+    shift = (frand.uniform(-4, 4, nfamily)[family] +
+             rand.normal(0, 0.3, nspectra))
+    width = frand.uniform(1, 4, nfamily)[family]
+    white = (frand.uniform(0, 1.5, nfamily)[family] *
+             rand.uniform(0.9, 1.1, nspectra))
+    wpos = frand.uniform(2, 15, nfamily)[family]
+    out = np.zeros((nspectra, len(x)), dtype=np.float32)
+    for i in range(nspectra):
+        e = x - shift[i]
+        mu = 1/(1 + np.exp(-e/width[i]))
+        mu += white[i]*np.exp(-((e - wpos[i])/4.0)**2)
+        out[i] = mu
+    for feature in range(3):
+        amp = (frand.uniform(0, 0.2, nfamily)[family] *
+               rand.uniform(0.8, 1.2, nspectra))
+        pos = frand.uniform(20, 110, nfamily)[family]
+        wid = frand.uniform(3, 15, nfamily)[family]
+        e = x[None, :] - shift[:, None] - pos[:, None]
+        out += (amp[:, None]*np.exp(-(e/wid[:, None])**2)).astype(np.float32)
+    out += rand.normal(0, 5.e-3, out.shape).astype(np.float32)
+    return out
+
+def add_spectra(db, ids, vectors, element=29, edge=1):
+    """add spectra of an element (z) and edge (id) with XANES vectors
+    and no arrays, as another process would"""
+    stab, xtab = db.tables['spectrum'], db.tables['spectrum_xanes']
+    with db.engine.begin() as conn:
+        conn.execute(stab.insert(), [
+            {'id': int(spid), 'name': 'spectrum %i' % spid,
+             'element_z': element, 'edge_id': edge} for spid in ids])
+        conn.execute(xtab.insert(), [
+            {'spectrum_id': int(spid), 'grid': XANES_GRID_NAME,
+             'xanes': encode_vector(vec)} for spid, vec in zip(ids, vectors)])
+
+def make_library(dbname, nspectra):
+    """library holding nspectra spectra of one element and edge, with
+    synthetic XANES vectors and no arrays"""
+    xasdb.create_xasdb(dbname)
+    db = xasdb.connect_xasdb(dbname)
+    add_spectra(db, np.arange(1, nspectra+1),
+                synthetic_xanes(nspectra, seed=nspectra))
+    return db
+
+def test_approximate_ranked_exactly(tmp_path):
+    db = make_library(str(tmp_path / 'similar.db'), NSPECTRA)
+    ids, matrix = db.get_xanes_matrix(29, 1)
+    recall = 0.0
+    for spectrum_id in range(1, NSPECTRA+1, NSPECTRA//20):
+        exact = db.find_similar(spectrum_id, k=K, approximate=False)
+        approx = db.find_similar(spectrum_id, k=K, approximate=True)
+        assert len(approx) == K
+        vector = matrix[spectrum_id-1]
+        for spid, score in approx:
+            found, scores = rank_similar(matrix[spid-1:spid], vector, k=1)
+            assert np.isclose(score, scores[0], rtol=1.e-6)
+        best = set([spid for spid, score in exact])
+        recall += len(best & set([spid for spid, score in approx]))/float(K)
+    assert recall/20 > 0.8
+    db.close()
+
+def test_approximate_after_write(tmp_path):
+    """after a write by another process, a search reads the vectors of
+    the candidates and of the new spectra only"""
+    dbname = str(tmp_path / 'similar.db')
+    db = make_library(dbname, NSPECTRA)
+    db.get_xanes_index(29, 1)
+    vectors = synthetic_xanes(NSPECTRA + 10, seed=NSPECTRA)[NSPECTRA:]
+    other = xasdb.connect_xasdb(dbname)
+    add_spectra(other, np.arange(NSPECTRA+1, NSPECTRA+11), vectors)
+    other.set_mod_time()
+    other.close()
+
+    def no_matrix(element, edge):
+        raise AssertionError('read all vectors')
+    db.refresh_cache()
+    db.get_xanes_matrix = no_matrix
+    found = db.find_similar(NSPECTRA+1, k=K, approximate=True)
+    assert len(found) == K
+    assert NSPECTRA+10 in db.get_xanes_index(29, 1).ids
+    db.close()
+
+def test_index_changed_while_searched(tmp_path):
+    db = make_library(str(tmp_path / 'similar.db'), NSPECTRA)
+    index = db.get_xanes_index(29, 1)
+    vectors = synthetic_xanes(NSPECTRA + 200, seed=NSPECTRA)[NSPECTRA:]
+    errors, done = [], threading.Event()
+
+    def search(seed):
+        try:
+            rand = np.random.RandomState(seed)
+            while not done.is_set():
+                spectrum_id = int(rand.randint(1, NSPECTRA+1))
+                assert len(db.find_similar(spectrum_id, k=K,
+                                           approximate=True)) == K
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=search, args=(seed,))
+               for seed in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(0, 200, 10):
+            ids = np.arange(NSPECTRA+i+1, NSPECTRA+i+11)
+            add_spectra(db, ids, vectors[i:i+10])
+            db._index_xanes([int(spid) for spid in ids])
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+    assert errors == []
+    assert len(index) == NSPECTRA
+    assert len(db.get_xanes_index(29, 1)) == NSPECTRA + 200
+    db.close()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+  XAFS pre-edge subtraction and normalization, version 1.0
+
+  a verbatim copy of xasdb/xafs_preedge.py as of PREEDGE_VERSION 1.0,
+  used as the reference in bench_preedge.py.  Do not edit.
+"""
+
+import numpy as np
+from numpy import polyfit
+
+# version of the pre-edge and normalization algorithm: change this when
+# preedge() changes results, so that stored results are recomputed.
+PREEDGE_VERSION = '1.0'
+
+def index_of(arrval, value):
+    """return index of array *at or below* value
+    returns 0 if value < min(array)
+    """
+    if value < min(arrval):
+        return 0
+    return max(np.where(arrval<=value)[0])
+
+def index_nearest(array, value, _larch=None):
+    """return index of array *nearest* to value
+    """
+    return np.abs(array-value).argmin()
+
+def remove_dups(arr, tiny=1.e-8, frac=0.02):
+    """avoid repeated successive values of an array that is expected
+    to be monotonically increasing.
+
+    For repeated values, the first encountered occurance (at index i)
+    will be reduced by an amount that is the largest of these:
+
+    [tiny, frac*abs(arr[i]-arr[i-1]), frac*abs(arr[i+1]-arr[i])]
+
+    where tiny and frac are optional arguments.
+
+    Parameters
+    ----------
+    arr :  array of values expected to be monotonically increasing
+    tiny : smallest expected absolute value of interval [1.e-8]
+    frac : smallest expected fractional interval   [0.02]
+
+    Returns
+    -------
+    out : ndarray, strictly monotonically increasing array
+
+    Example
+    -------
+    >>> x = array([0, 1.1, 2.2, 2.2, 3.3])
+    >>> print remove_dups(x)
+    >>> array([ 0.   ,  1.1  ,  2.178,  2.2  ,  3.3  ])
+
+    """
+    if not isinstance(arr, np.ndarray):
+        try:
+            arr = np.array(arr)
+        except:
+            print( 'remove_dups: argument is not an array')
+    if isinstance(arr, np.ndarray):
+        shape = arr.shape
+        arr   = arr.flatten()
+        npts  = len(arr)
+        try:
+            dups = np.where(abs(arr[:-1] - arr[1:]) < tiny)[0].tolist()
+        except ValueError:
+            dups = []
+        for i in dups:
+            t = [tiny]
+            if i > 0:
+                t.append(frac*abs(arr[i]-arr[i-1]))
+            if i < len(arr)-1:
+                t.append(frac*abs(arr[i+1]-arr[i]))
+            dx = max(t)
+            arr[i] = arr[i] - dx
+        arr.shape = shape
+    return arr
+
+
+def remove_nans2(a, b):
+    """removes NAN and INF from 2 arrays,
+    returning 2 arrays of the same length
+    with NANs and INFs removed
+
+    Parameters
+    ----------
+    a :      array 1
+    b :      array 2
+
+    Returns
+    -------
+    anew, bnew
+
+    Example
+    -------
+    >>> x = array([0, 1.1, 2.2, nan, 3.3])
+    >>> y = array([1,  2,   3,   4,   5)
+    >>> emove_nans2(x, y)
+    >>> array([ 0.   ,  1.1, 2.2, 3.3]), array([1, 2, 3, 5])
+
+    """
+    if not isinstance(a, np.ndarray):
+        try:
+            a = np.array(a)
+        except:
+            print( 'remove_nans2: argument 1 is not an array')
+    if not isinstance(b, np.ndarray):
+        try:
+            b = np.array(b)
+        except:
+            print( 'remove_nans2: argument 2 is not an array')
+    if (np.any(np.isinf(a)) or np.any(np.isinf(b)) or
+        np.any(np.isnan(a)) or np.any(np.isnan(b))):
+        a1 = a[:]
+        b1 = b[:]
+        if np.any(np.isinf(a)):
+            bad = np.where(a==np.inf)[0]
+            a1 = np.delete(a1, bad)
+            b1 = np.delete(b1, bad)
+        if np.any(np.isinf(b)):
+            bad = np.where(b==np.inf)[0]
+            a1 = np.delete(a1, bad)
+            b1 = np.delete(b1, bad)
+        if np.any(np.isnan(a)):
+            bad = np.where(a==np.nan)[0]
+            a1 = np.delete(a1, bad)
+            b1 = np.delete(b1, bad)
+        if np.any(np.isnan(b)):
+            bad = np.where(b==np.nan)[0]
+            a1 = np.delete(a1, bad)
+            b1 = np.delete(b1, bad)
+        return a1, b1
+    return a, b
+
+def preedge(energy, mu, e0=None, step=None,
+            nnorm=3, nvict=0, pre1=None, pre2=-50,
+            norm1=100, norm2=None):
+    """pre edge subtraction, normalization for XAFS (straight python)
+
+    This performs a number of steps:
+       1. determine E0 (if not supplied) from max of deriv(mu)
+       2. fit a line of polymonial to the region below the edge
+       3. fit a polymonial to the region above the edge
+       4. extrapolae the two curves to E0 to determine the edge jump
+
+    Arguments
+    ----------
+    energy:  array of x-ray energies, in eV
+    mu:      array of mu(E)
+    e0:      edge energy, in eV.  If None, it will be determined here.
+    step:    edge jump.  If None, it will be determined here.
+    pre1:    low E range (relative to E0) for pre-edge fit
+    pre2:    high E range (relative to E0) for pre-edge fit
+    nvict:   energy exponent to use for pre-edg fit.  See Note
+    norm1:   low E range (relative to E0) for post-edge fit
+    norm2:   high E range (relative to E0) for post-edge fit
+    nnorm:   degree of polynomial (ie, nnorm+1 coefficients will be found) for
+             post-edge normalization curve. Default=3 (quadratic), max=5
+    Returns
+    -------
+      dictionary with elements (among others)
+          e0          energy origin in eV
+          edge_step   edge step
+          norm        normalized mu(E)
+          pre_edge    determined pre-edge curve
+          post_edge   determined post-edge, normalization curve
+
+    Notes
+    -----
+     1 nvict gives an exponent to the energy term for the fits to the pre-edge
+       and the post-edge region.  For the pre-edge, a line (m * energy + b) is
+       fit to mu(energy)*energy**nvict over the pre-edge region,
+       energy=[e0+pre1, e0+pre2].  For the post-edge, a polynomial of order
+       nnorm will be fit to mu(energy)*energy**nvict of the post-edge region
+       energy=[e0+norm1, e0+norm2].
+
+    """
+    energy = remove_dups(energy)
+
+    if e0 is None or e0 < energy[0] or e0 > energy[-1]:
+        energy = remove_dups(energy)
+        dmu = np.gradient(mu)/np.gradient(energy)
+        # find points of high derivative
+        high_deriv_pts = np.where(dmu >  max(dmu)*0.05)[0]
+        idmu_max, dmu_max = 0, 0
+        for i in high_deriv_pts:
+            if (dmu[i] > dmu_max and
+                (i+1 in high_deriv_pts) and
+                (i-1 in high_deriv_pts)):
+                idmu_max, dmu_max = i, dmu[i]
+
+        e0 = energy[idmu_max]
+    nnorm = max(min(nnorm, 5), 1)
+    ie0 = index_nearest(energy, e0)
+    e0 = energy[ie0]
+
+    if pre1 is None:  pre1  = min(energy) - e0
+    if norm2 is None: norm2 = max(energy) - e0
+    if norm2 < 0:     norm2 = max(energy) - e0 - norm2
+    pre1  = max(pre1,  (min(energy) - e0))
+    norm2 = min(norm2, (max(energy) - e0))
+
+
+    if pre1 > pre2:
+        pre1, pre2 = pre2, pre1
+    if norm1 > norm2:
+        norm1, norm2 = norm2, norm1
+
+    p1 = index_of(energy, pre1+e0)
+    p2 = index_nearest(energy, pre2+e0)
+    if p2-p1 < 2:
+        p2 = min(len(energy), p1 + 2)
+
+
+    omu  = mu*energy**nvict
+    ex, mx = remove_nans2(energy[p1:p2], omu[p1:p2])
+
+    precoefs = polyfit(ex, mx, 1)
+
+    pre_edge = (precoefs[0] * energy + precoefs[1]) * energy**(-nvict)
+    # normalization
+    p1 = index_of(energy, norm1+e0)
+    p2 = index_nearest(energy, norm2+e0)
+    if p2-p1 < 2:
+        p2 = min(len(energy), p1 + 2)
+    coefs = polyfit(energy[p1:p2], omu[p1:p2], nnorm)
+    post_edge = 0
+    norm_coefs = []
+    for n, c in enumerate(reversed(list(coefs))):
+        post_edge += c * energy**(n-nvict)
+        norm_coefs.append(c)
+
+    edge_step = step
+    if edge_step is None:
+        edge_step = post_edge[ie0] - pre_edge[ie0]
+
+    norm = (mu - pre_edge)/edge_step
+
+    return {'e0': e0, 'edge_step': edge_step, 'norm': norm,
+            'pre_edge': pre_edge, 'post_edge': post_edge,
+            'norm_coefs': norm_coefs, 'nvict': nvict,
+            'nnorm': nnorm, 'norm1': norm1, 'norm2': norm2,
+            'pre1': pre1, 'pre2': pre2, 'precoefs': precoefs}
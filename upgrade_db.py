@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# upgrades an existing XAS Spectral Library DB in place, applying any
+# pending schema migrations and checking that indexes are used, and
+# optionally converts its array data to 'binary' or 'json' encoding
+#
+
+from __future__ import print_function
+import sys
+import os
+import xasdb
+
+dbname = 'example.db'
+array_format = None
+
+if len(sys.argv) > 1:
+    dbname = sys.argv[1]
+if len(sys.argv) > 2:
+    array_format = sys.argv[2]
+
+if not os.path.exists(dbname):
+    print("Error:  database file '%s' does not exist" % dbname)
+    print("Usage:  upgrade_db.py  filename [binary|json]")
+
+elif array_format not in (None,) + xasdb.ARRAY_FORMATS:
+    print("Error:  unknown array format '%s'" % array_format)
+    print("Usage:  upgrade_db.py  filename [binary|json]")
+
+else:
+    db = xasdb.connect_xasdb(dbname)
+    for version, description in db.upgrade():
+        print('  %s: %s' % (version, description))
+    print('Upgraded %s to version %s' % (dbname, db.get_info('version')))
+    db.check_query_plans()
+    if array_format is not None:
+        print('Converting arrays in %s from %s to %s' % (dbname,
+                                                         db.array_format,
+                                                         array_format))
+        db.convert_arrays(array_format=array_format)
+    db.close()
@@ -1,4 +1,8 @@
 import io
+import os
+import glob
+import hashlib
+import threading
 
 import base64
 
@@ -15,10 +19,15 @@ mpl_lfont = FontProperties()
 mpl_lfont.set_size(18)
 rcParams['xtick.labelsize'] =  rcParams['ytick.labelsize'] = 18
 
-def make_xafs_plot(x, y, title, xlabel='Energy (eV)', ylabel='mu', x0=None,
-                   ref_mu=None, ref_name=None):
+# parameters used to render plots, part of the plot cache key
+PLOT_PARAMS = {'figsize': (8.5, 5.0), 'dpi': 300, 'facecolor': '#FDFDFA'}
 
-    fig  = Figure(figsize=(8.5, 5.0), dpi=300)
+def render_xafs_plot(x, y, title, xlabel='Energy (eV)', ylabel='mu',
+                     x0=None, ref_mu=None, ref_name=None, format='png',
+                     figsize=(8.5, 5.0), dpi=300, facecolor='#FDFDFA'):
+    """render an XAFS plot, returning the image file contents as bytes
+    format can be any format supported by matplotlib, 'png' or 'svg'"""
+    fig  = Figure(figsize=figsize, dpi=dpi)
     canvas = FigureCanvas(fig)
     axes = fig.add_axes([0.16, 0.16, 0.75, 0.75]) #, axisbg='#FFFFFF')
 
@@ -43,6 +52,113 @@ def make_xafs_plot(x, y, title, xlabel='Energy (eV)', ylabel='mu', x0=None,
     axes.set_title(title, fontproperties=mpl_lfont)
 
     figdata = io.BytesIO()
-    fig.savefig(figdata, format='png', facecolor='#FDFDFA')
-    figdata.seek(0)
-    return base64.b64encode(figdata.getvalue())
+    fig.savefig(figdata, format=format, facecolor=facecolor)
+    return figdata.getvalue()
+
+def make_xafs_plot(x, y, title, xlabel='Energy (eV)', ylabel='mu', x0=None,
+                   ref_mu=None, ref_name=None):
+    """render an XAFS plot as a base64-encoded PNG"""
+    return base64.b64encode(render_xafs_plot(x, y, title, xlabel=xlabel,
+                                             ylabel=ylabel, x0=x0,
+                                             ref_mu=ref_mu,
+                                             ref_name=ref_name))
+
+class PlotCache(object):
+    """cache of rendered plots, as files in a folder on local disk
+
+    Files are named '<spectrum id>_<kind>_<hash>.<format>', with the hash
+    made from the spectrum modify_date and the rendering parameters, so
+    that a changed spectrum is never shown with an old plot.  When the
+    files add up to more than max_size bytes, the least recently used
+    are removed.  Hits update the file modification time, so that is
+    used to find the least recently used files.
+
+    The folder may be shared by several processes (as for the workers
+    of a pre-forking server), so the size of the cache is not counted
+    in each process: it is summed from the folder after every put(),
+    which is cheap next to rendering a plot.  max_size then holds for
+    the folder as a whole, and plots removed by one process are not
+    counted by any other.
+    """
+    def __init__(self, folder, max_size=256*1024*1024):
+        self.folder = os.path.abspath(folder)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def digest(self, stamp, **params):
+        """hash of a spectrum modify_date (stamp) and rendering parameters,
+        which changes whenever the plots of a spectrum would change"""
+        text = repr((str(stamp), sorted(params.items())))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()[:20]
+
+    def key(self, spectrum_id, kind, stamp, format='png', **params):
+        """key for a plot of a spectrum, from its modify_date (stamp)
+        and the rendering parameters"""
+        return '%i_%s_%s.%s' % (spectrum_id, kind,
+                                self.digest(stamp, **params), format)
+
+    def get(self, key):
+        """contents of a cached plot, or None if not cached"""
+        path = os.path.join(self.folder, key)
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        """add a plot to the cache, removing old plots if needed"""
+        path = os.path.join(self.folder, key)
+        # write and rename, so that other processes never see part of a file
+        tmpfile = '%s.%i_%i.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmpfile, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmpfile, path)
+        if self.size() > self.max_size:
+            with self.lock:
+                self.evict()
+
+    def size(self):
+        "total size in bytes of the cached plots, from the folder"
+        return sum([size for mtime, size, path in self._files()])
+
+    def invalidate(self, spectrum_id):
+        """remove all cached plots for a spectrum"""
+        pattern = os.path.join(self.folder, '%i_*' % spectrum_id)
+        for path in glob.glob(pattern):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+    def evict(self, fraction=0.8):
+        """remove least recently used plots until the cache uses less
+        than fraction of max_size, rescanning the folder so that plots
+        added or removed by other processes are counted"""
+        files = sorted(self._files())
+        total = sum([size for mtime, size, path in files])
+        for mtime, size, path in files:
+            if total <= fraction*self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def _files(self):
+        "list of (mtime, size, path) for cached plots"
+        out = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            out.append((stat.st_mtime, stat.st_size, entry.path))
+        return out
@@ -6,9 +6,10 @@ from collections import namedtuple
 from datetime import datetime
 from random import randrange
 from string import printable
+import numpy as np
 from sqlalchemy import text
 
-from xasdb import fmttime
+from xasdb import fmttime, rating_summary
 
 def make_secret_key():
     "make a secret key for web app"
@@ -50,6 +51,8 @@ def session_init(session, db):
     if 'person_id' not in session:   session['person_id'] = "-1"
 
 def get_rating(item):
+    if hasattr(item, 'rating_sum'):
+        return rating_summary(item.rating_sum, item.rating_count)
     rating = getattr(item, 'rating_summary', None)
     if rating is None or len(rating) < 1:
         rating = 'No ratings'
@@ -74,9 +77,9 @@ def get_edge_list(db):
         l.append({'id': '%i' % r.id, 'name': r.name})
     return l
 
-def get_beamline_list(db, orderby='id'):
+def get_beamline_list(db, orderby='id', reverse=False):
     l = []
-    for r in db.get_beamlines(orderby=orderby):
+    for r in db.get_beamlines(orderby=orderby, reverse=reverse):
         facid = '%i' % r.facility_id
         fac  = db.filtered_query('facility', id=r.facility_id)[0]
         l.append({'id': '%i' % r.id,
@@ -176,39 +179,50 @@ def citation_for_spectrum(db, s, notes=None):
     return '%i' % cid, desc
 
 
-def spectra_for_beamline(db, blid):
+def spectrum_summary(s):
+    "return dict for a summary row from db.list_spectra_summary()"
+    blid  = -1
+    desc = 'unknown'
+    if s.beamline_id is not None:
+        blid = s.beamline_id
+        desc = '%s @ %s ' % (s.beamline_name, s.facility_name)
+    return {'id': s.id,
+            'name': s.name,
+            'element': s.element_z,
+            'edge': s.edge,
+            'person_email': s.person_email,
+            'person_name': s.person_name,
+            'elem_sym': s.elem_sym,
+            'rating': get_rating(s),
+            'beamline_desc': desc,
+            'beamline_id': '%i' % blid}
+
+def spectra_list(db, **kws):
     spectra = []
-    for r in db.get_spectra():
-        if r.beamline_id !=int(blid):
-            continue
-        elem = db.get_element(r.element_z)
-        edge = db.get_edge(r.edge_id)
+    for r in db.list_spectra_summary(**kws):
         spectra.append({'spectrum_id': r.id, 'name':    r.name,
-                        'elem_sym': elem.symbol, 'edge': edge.name})
+                        'elem_sym': r.elem_sym, 'edge': r.edge})
     return spectra
 
+def spectra_for_beamline(db, blid):
+    return spectra_list(db, beamline=int(blid))
 
-def spectra_for_citation(db, cid):
-    spectra = []
-    for r in db.get_spectra():
-        if r.citation_id !=int(cid):
-            continue
-        elem = db.get_element(r.element_z)
-        edge = db.get_edge(r.edge_id)
-        spectra.append({'spectrum_id': r.id, 'name':    r.name,
-                        'elem_sym': elem.symbol, 'edge': edge.name})
-    return spectra
+def spectra_by_beamline(db):
+    "dict of beamline id: spectra_list() for all beamlines"
+    out = {}
+    for r in db.iter_spectra(summary=True):
+        out.setdefault(r.beamline_id, []).append(
+            {'spectrum_id': r.id, 'name': r.name,
+             'elem_sym': r.elem_sym, 'edge': r.edge})
+    return out
 
+def spectra_for_citation(db, cid):
+    return spectra_list(db, citation=int(cid))
 
 def spectra_for_suite(db, stid):
     spectra = []
     if stid is not None:
-        for r in db.filtered_query('spectrum_suite', suite_id=int(stid)):
-            spec = db.get_spectrum(r.spectrum_id)
-            elem = db.get_element(spec.element_z)
-            edge = db.get_edge(spec.edge_id)
-            spectra.append({'spectrum_id': r.spectrum_id, 'name': spec.name,
-                            'elem_sym': elem.symbol, 'edge': edge.name})
+        spectra = spectra_list(db, suite=int(stid))
     return spectra
 
 
@@ -292,3 +306,44 @@ def parse_spectrum(s, db):
             'xdi_filename': "%s.xdi" % (s.name.strip()),
             'fullfig': None,
             'xanesfig': None}
+
+def finite_list(values):
+    "list of the values of an array, with None for NaN and inf"
+    return [v if np.isfinite(v) else None for v in np.asarray(
+        values, dtype=float).tolist()]
+
+def lttb_indices(x, y, max_points):
+    """indices of the points to keep to downsample (x, y) to max_points,
+    using largest-triangle-three-buckets: the first and last points are
+    kept, and the others are split into max_points-2 buckets.  From each
+    bucket, the point kept makes the largest triangle with the point kept
+    from the previous bucket and the average of the next bucket.
+
+    all indices are returned if max_points < 3 or len(x) <= max_points.
+    Points where x or y is not finite (NaN or inf) are never kept when
+    downsampling, and do not enter the bucket averages.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    npts = len(x)
+    if max_points < 3 or npts <= max_points:
+        return np.arange(npts)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not np.all(finite):
+        keep = np.nonzero(finite)[0]
+        return keep[lttb_indices(x[keep], y[keep], max_points)]
+    edges = np.linspace(1, npts-1, max_points-1).astype(int)
+    out = np.zeros(max_points, dtype=int)
+    out[-1] = npts-1
+    last = 0
+    for i in range(max_points-2):
+        lo, hi = edges[i], edges[i+1]
+        if i < max_points-3:
+            xnext = x[hi:edges[i+2]].mean()
+            ynext = y[hi:edges[i+2]].mean()
+        else:
+            xnext, ynext = x[-1], y[-1]
+        area = abs((x[last]-xnext)*(y[lo:hi]-y[last]) -
+                   (x[last]-x[lo:hi])*(ynext-y[last]))
+        last = lo + np.argmax(area)
+        out[i+1] = last
+    return out
@@ -11,4 +11,8 @@ DEBUG = True
 LOCAL_ONLY = False
 
 UPLOAD_FOLDER='/tmp'
+
+# rendered plots are cached here, up to PLOT_CACHE_SIZE MB
+PLOT_CACHE_FOLDER='/tmp/xasdb_plots'
+PLOT_CACHE_SIZE=256
 ADMIN_EMAIL='nobody@here'
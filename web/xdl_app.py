@@ -3,13 +3,14 @@
 import sys
 import os
 import time
+import threading
 
 t0 = time.time()
 
 import smtplib
 
+import io
 import json
-import base64
 import numpy as np
 
 from flask import (Flask, request, session, redirect, url_for,
@@ -17,37 +18,69 @@ from flask import (Flask, request, session, redirect, url_for,
 
 from werkzeug import secure_filename
 
-from xasdb import (connect_xasdb, fmttime, valid_score, unique_name)
-from xafs_preedge import (preedge, edge_energies)
+from xasdb import connect_xasdb, fmttime, valid_score, XASDBException
+from xasdb.xafs_preedge import edge_energies
 
 from utils import (random_string, multiline_text, session_init,
                    session_clear, parse_spectrum,
                    spectrum_ratings, suite_ratings,
-                   spectra_for_suite, beamline_for_spectrum,
-                   spectra_for_beamline, get_element_list,
+                   spectra_for_suite, spectrum_summary,
+                   spectra_for_beamline, spectra_for_citation,
+                   spectra_by_beamline,
+                   get_element_list,
                    get_energy_units_list, get_edge_list,
-                   get_beamline_list, get_sample_list, get_rating)
+                   get_beamline_list, get_sample_list, get_rating,
+                   lttb_indices, finite_list)
 
 
 # sys.path.insert(0, '/home/newville/XASDB_Secrets')
 
 from xasdb_secrets import (SECRET_KEY, DBNAME, DBCONN, PORT, DEBUG,
-                           UPLOAD_FOLDER, LOCAL_ONLY, ADMIN_EMAIL)
+                           UPLOAD_FOLDER, LOCAL_ONLY, ADMIN_EMAIL,
+                           PLOT_CACHE_FOLDER, PLOT_CACHE_SIZE)
 
 
-from plot import make_xafs_plot
+from plot import render_xafs_plot, PlotCache, PLOT_PARAMS
 
 from sqlalchemy import text
 
 ALLOWED_EXTENSIONS = set(['XDI', 'xdi'])
 
+# spectra per page of the /all and /search listings, and the most
+# that can be asked for with ?limit=
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 NAME = 'XASDB'
 
 app = Flask(__name__)
 app.config.from_object(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024
 
-db = connect_xasdb(DBNAME, **DBCONN)
+# the database is connected on the first request in each process, so
+# that a pre-forking server does not share an engine between workers.
+# Each request gets its own session, ended in teardown_request.
+db = None
+db_pid = None
+db_lock = threading.Lock()
+
+plot_cache = PlotCache(PLOT_CACHE_FOLDER, max_size=PLOT_CACHE_SIZE*1024*1024)
+
+@app.before_request
+def connect_db():
+    global db, db_pid
+    if db is None or db_pid != os.getpid():
+        with db_lock:
+            if db is None or db_pid != os.getpid():
+                db = connect_xasdb(DBNAME, scoped=True, **DBCONN)
+                db_pid = os.getpid()
+    # see writes made by other processes since the last request
+    db.refresh_cache()
+
+@app.teardown_request
+def end_db_session(error=None):
+    if db is not None and db_pid == os.getpid():
+        db.end_session(error)
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -111,7 +144,7 @@ def notify_account_creation(person):
 
 @app.errorhandler(404)
 def page_not_found(error):
-    return render_template('notfound.html')
+    return render_template('notfound.html'), 404
 
 
 @app.route('/clear')
@@ -319,79 +352,75 @@ def user():
     return render_template('userprofile.html', error=error, email=email,
                            name=name, affiliation=affiliation)
 
+def page_args():
+    """(after, limit) for a page of a spectra listing, from the query
+    args: a value that is not an integer is a bad request (400)"""
+    try:
+        after = request.args.get('after', None)
+        if after is not None:
+            after = int(after)
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    return after, max(1, min(limit, MAX_PAGE_SIZE))
+
 @app.route('/search')
 @app.route('/search/<elem>')
 @app.route('/search/<elem>/<orderby>')
 @app.route('/search/<elem>/<orderby>/<reverse>')
 def search(elem=None, orderby=None, reverse=0):
     session_init(session, db)
-    dbspectra = []
     if orderby is None: orderby = 'id'
-    if elem is not None:
+    try:
+        reverse = int(reverse)
+    except ValueError:
+        abort(400)
+    dbspectra, nspectra, next_url = [], 0, None
+    after = None
+    if elem is not None and db.get_element(elem) is not None:
+        after, limit = page_args()
         try:
-            dbspectra = db.get_spectra(element=elem, orderby=orderby)
-        except:
-            pass
-
-    reverse = int(reverse)
-    if reverse:
-        dbspectra.reverse()
-        reverse = 0
-    else:
-        reverse = 1
+            dbspectra, after = db.page_spectra(after=after, limit=limit,
+                                               orderby=orderby,
+                                               reverse=reverse,
+                                               summary=True, element=elem)
+        except XASDBException:
+            # an orderby that is not an indexed column, or an after
+            # that is not a spectrum
+            abort(400)
+        nspectra = db.count_spectra(element=elem)
+        if after is not None:
+            next_url = url_for('search', elem=elem, orderby=orderby,
+                               reverse=reverse, after=after, limit=limit)
 
     spectra = []
     for s in dbspectra:
-        edge     = db.get_edge(s.edge_id)
-        elem_sym = db.get_element(s.element_z).symbol
-        person   = db.get_person(s.person_id)
-        bl_id, bl_desc = beamline_for_spectrum(db, s)
-
-        spectra.append({'id': s.id,
-                        'name': s.name,
-                        'element': elem,
-                        'edge': edge.name,
-                        'person_email': person.email,
-                        'person_name': person.name,
-                        'elem_sym': elem_sym,
-                        'rating': get_rating(s),
-                        'beamline_desc': bl_desc,
-                        'beamline_id': bl_id,
-                        })
+        opts = spectrum_summary(s)
+        opts['element'] = elem
+        spectra.append(opts)
 
-    return render_template('ptable.html', nspectra=len(dbspectra),
+    return render_template('ptable.html', nspectra=nspectra,
                            elem=elem, spectra=spectra,
-                           reverse=reverse)
+                           reverse=0 if reverse else 1, next_url=next_url)
 
 
 @app.route('/all')
 @app.route('/all/')
 def all():
     session_init(session, db)
-    spectra = []
-    dbspectra = db.get_spectra()
-    for s in dbspectra:
-        edge     = db.get_edge(s.edge_id)
-        elem_sym = db.get_element(s.element_z).symbol
-        elem     = s.element_z
-        person   = db.get_person(s.person_id)
-
-        bl_id, bl_desc = beamline_for_spectrum(db, s)
-
-        spectra.append({'id': s.id,
-                        'name': s.name,
-                        'element': elem,
-                        'edge': edge.name,
-                        'person_email': person.email,
-                        'person_name': person.name,
-                        'elem_sym': elem_sym,
-                        'rating': get_rating(s),
-                        'beamline_desc': bl_desc,
-                        'beamline_id': bl_id,
-                        })
-
-    return render_template('ptable.html', nspectra=len(dbspectra),
-                           elem='All Elements', spectra=spectra)
+    after, limit = page_args()
+    try:
+        dbspectra, after = db.page_spectra(after=after, limit=limit,
+                                           summary=True)
+    except XASDBException:
+        abort(400)
+    next_url = None
+    if after is not None:
+        next_url = url_for('all', after=after, limit=limit)
+    spectra = [spectrum_summary(s) for s in dbspectra]
+    return render_template('ptable.html', nspectra=db.count_spectra(),
+                           elem='All Elements', spectra=spectra,
+                           next_url=next_url)
 
 @app.route('/spectrum/')
 @app.route('/spectrum/<int:spid>')
@@ -406,89 +435,271 @@ def spectrum(spid=None):
     opts['spectrum_owner'] = (session['person_id'] == "%i" % s.person_id)
     opts['rating'] = get_rating(s)
 
-    modes = db.get_spectrum_mode(spid)
-    if modes is None:
-        modes = 1
-    else:
-        modes = modes[0][1]
+    # plots are loaded by the browser from spectrum_plot(), with the
+    # version in the url so that they can be cached for a long time
+    version = plot_cache.digest(s.modify_date, **PLOT_PARAMS)
+    for kind in PLOT_KINDS:
+        opts['%sfig' % kind] = url_for('spectrum_plot', spid=s.id, kind=kind,
+                                       format='png', v=version)
 
-    if modes == 1:
-        try:
-            energy = np.array(json.loads(s.energy))
-            i0     = np.array(json.loads(s.i0))
-            itrans = np.array(json.loads(s.itrans))
-            mutrans = -np.log(itrans/i0)
-        except:
-            error = 'Could not extract data from spectrum'
-            return render_template('spectrum.html', **opts)
-    else: #get a fluorescence
-        try:
-            energy = np.array(json.loads(s.energy))
-            i0     = np.array(json.loads(s.i0))
-            ifluor = np.array(json.loads(s.ifluor))
-            mutrans = ifluor/i0
-        except:
-            error = 'Could not extract data from spectrum'
-            return render_template('spectrum.html', **opts)
-
-    murefer = None
-    try:
-        irefer = np.array(json.loads(s.irefer))
-        murefer = -np.log(irefer/itrans)
-    except:
-        pass
+    suites = []
+    for r in db.filtered_query('spectrum_suite', spectrum_id=s.id):
+        st = db.filtered_query('suite', id=r.suite_id)[0]
+        suites.append({'id': r.suite_id, 'name': st.name})
+    opts['nsuites'] = len(suites)
+    opts['suites'] = suites
 
+    return render_template('spectrum.html', **opts)
 
-    eunits = opts['energy_units']
-    if eunits.startswith('keV'):
-        energy = energy /1000.0
-    elif eunits.startswith('deg'):
-        print('Need to convert angle to energy')
+PLOT_KINDS = ('raw', 'xanes')
+PLOT_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
 
+# seconds plots may be cached by browsers and proxies: urls with the
+# current version (as from the spectrum page) never change contents
+PLOT_MAX_AGE = 60
+PLOT_VERSIONED_MAX_AGE = 365*24*3600
 
-    if modes != 7:
-        group = preedge(energy, mutrans)
-        e0 = group['e0']
-    try:
-        e0 = edge_energies[int(s.element_z)][str(opts['edge'])]
-    except:
-        pass
+@app.route('/spectrum/<int:spid>/plot/<kind>.<format>')
+def spectrum_plot(spid, kind, format):
+    """plot of a spectrum ('raw' or 'xanes') as a png or svg image"""
+    if kind not in PLOT_KINDS or format not in PLOT_MIMETYPES:
+        abort(404)
+    s = db.get_spectrum(spid)
+    if s is None:
+        abort(404)
 
-    try:
-        i1 = max(np.where(energy<=e0 - 25)[0])
-    except:
-        i1 = 0
-    i2 = max(np.where(energy<=e0 + 75)[0]) + 1
-    xanes_en = energy[i1:i2] - e0
-    
-    if modes !=3:
-        xanes_mu = group['norm'][i1:i2]
+    version = plot_cache.digest(s.modify_date, **PLOT_PARAMS)
+    etag = '%i-%s-%s' % (spid, kind, version)
+    max_age = PLOT_MAX_AGE
+    if request.args.get('v', None) == version:
+        max_age = PLOT_VERSIONED_MAX_AGE
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
     else:
-        xanes_mu = mutrans[i1:i2]
-        
-    xanes_ref = None
-    if murefer is not None:
-        rgroup = preedge(energy, murefer)
-        xanes_ref = rgroup['norm'][i1:i2]
+        plot = spectrum_plots(s, (kind,), format=format)[kind]
+        if plot is None:
+            abort(404)
+        response = Response(plot, mimetype=PLOT_MIMETYPES[format])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=%i' % max_age
+    return response
+
+def spectrum_plots(s, kinds=PLOT_KINDS, format='png'):
+    """rendered plots for a spectrum (without arrays), as a dict
+    of kind: image bytes, using the plot cache.  Arrays are only
+    read and plots only rendered for plots not in the cache.
+    kinds that cannot be plotted are None."""
+    out, keys = {}, {}
+    for kind in kinds:
+        keys[kind] = plot_cache.key(s.id, kind, s.modify_date,
+                                    format=format, **PLOT_PARAMS)
+        out[kind] = plot_cache.get(keys[kind])
+    missing = [kind for kind in kinds if out[kind] is None]
+    if len(missing) > 0:
+        out.update(render_spectrum_plots(s, missing, format=format))
+        for kind in missing:
+            if out[kind] is not None:
+                plot_cache.put(keys[kind], out[kind])
+    return out
+
+def render_spectrum_plots(s, kinds=PLOT_KINDS, format='png'):
+    """render plots for a spectrum, as for spectrum_plots()"""
+    out = dict([(kind, None) for kind in kinds])
+    energy, mutrans, murefer, mode = db.get_spectrum_mu(s.id)
+    if energy is None or mutrans is None:
+        return out
+    if 'raw' in kinds:
+        out['raw'] = render_xafs_plot(energy, mutrans, s.name,
+                                      ylabel='Raw XAFS', format=format,
+                                      **PLOT_PARAMS)
+    if 'xanes' not in kinds:
+        return out
+
+    derived = db.get_derived(s.id)
+    if 'sample' not in derived:
+        return out
+
+    e0 = spectrum_e0(s, derived)
+    xanes = xanes_slice(energy, e0)
+    xanes_en = energy[xanes] - e0
+    xanes_mu = derived['sample']['norm'][xanes]
 
-    opts['e0'] = '%f' % e0
-    opts['fullfig'] =  make_xafs_plot(energy, mutrans, s.name,
-                                      ylabel='Raw XAFS').decode('UTF-8')
+    xanes_ref = None
+    if 'reference' in derived:
+        xanes_ref = derived['reference']['norm'][xanes]
+
+    out['xanes'] = render_xafs_plot(xanes_en, xanes_mu, s.name,
+                                    xlabel='Energy-%.1f (eV)' % e0,
+                                    ylabel='Normalized XANES',
+                                    x0=e0, ref_mu=xanes_ref,
+                                    ref_name='with reference',
+                                    format=format, **PLOT_PARAMS)
+    return out
+
+def spectrum_e0(s, derived):
+    """e0 for plots of a spectrum: the tabulated edge energy, if
+    known, or the e0 found in normalizing the spectrum"""
+    e0 = derived['sample']['e0']
+    try:
+        edge = db.filtered_query('edge', id=s.edge_id)[0].name
+        e0 = edge_energies[int(s.element_z)][str(edge)]
+    except (IndexError, KeyError, TypeError):
+        pass
+    return e0
+
+def xanes_slice(energy, e0, emin=-25, emax=75):
+    "slice of energy array for the XANES region, e0+emin to e0+emax"
+    i1, i2 = 0, len(energy)
+    below = np.where(energy <= e0 + emin)[0]
+    if len(below) > 0:
+        i1 = max(below)
+    below = np.where(energy <= e0 + emax)[0]
+    if len(below) > 0:
+        i2 = max(below) + 1
+    return slice(i1, i2)
+
+DATA_KINDS = ('raw', 'norm', 'xanes')
+DATA_FORMATS = ('json', 'npy')
+
+@app.route('/api/spectrum/<int:spid>/data')
+def spectrum_data(spid):
+    """arrays for a spectrum, for plotting by the browser or for scripts
+
+    query arguments:
+      format      'json' (default) or 'npy' (a numpy structured array)
+      kind        'raw' (default) or 'norm' for all points, 'xanes' for
+                  e0-25 to e0+75 eV
+      max_points  maximum number of points, downsampled with
+                  largest-triangle-three-buckets on mu for 'raw', and
+                  on norm for 'norm' and 'xanes'
+
+    arrays are energy (eV), mu, norm, reference and reference_norm,
+    with normalized arrays None if the spectrum could not be normalized
+    and reference arrays None if there is no reference channel.  For
+    'npy', arrays that are None are left out and e0 and edge_step are
+    sent as X-E0 and X-Edge-Step headers.  Values that are not finite,
+    as for mu where a detector reading is <= 0, are sent as null in
+    JSON, and are never kept when downsampling.
+    """
+    format = request.args.get('format', 'json')
+    kind = request.args.get('kind', 'raw')
+    max_points = request.args.get('max_points', None)
+    if format not in DATA_FORMATS or kind not in DATA_KINDS:
+        abort(400)
+    if max_points is not None:
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            abort(400)
 
-    opts['xanesfig'] = make_xafs_plot(xanes_en, xanes_mu, s.name,
-                                      xlabel='Energy-%.1f (eV)' % e0,
-                                      ylabel='Normalized XANES',
-                                      x0=e0, ref_mu=xanes_ref,
-                                      ref_name='with reference').decode('UTF-8')
+    s = db.get_spectrum(spid)
+    if s is None:
+        abort(404)
+    version = plot_cache.digest(s.modify_date, **PLOT_PARAMS)
+    etag = '%i-data-%s-%s-%s-%s' % (spid, kind, format, max_points, version)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, max-age=%i' % PLOT_MAX_AGE
+        return response
+
+    energy, mu, mu_refer, mode = db.get_spectrum_mu(s.id)
+    if energy is None or mu is None:
+        abort(404)
+    arrays = {'energy': energy, 'mu': mu, 'reference': mu_refer,
+              'norm': None, 'reference_norm': None}
+    e0 = edge_step = None
+    derived = db.get_derived(s.id)
+    if 'sample' in derived:
+        arrays['norm'] = derived['sample']['norm']
+        e0 = derived['sample']['e0']
+        edge_step = derived['sample']['edge_step']
+        if 'reference' in derived:
+            arrays['reference_norm'] = derived['reference']['norm']
+    elif kind != 'raw':
+        abort(404)
+
+    index = slice(None)
+    if kind == 'xanes':
+        index = xanes_slice(energy, spectrum_e0(s, derived))
+    for name in arrays:
+        if arrays[name] is not None:
+            arrays[name] = np.asarray(arrays[name])[index]
+    if max_points is not None:
+        ydata = arrays['mu'] if kind == 'raw' else arrays['norm']
+        index = lttb_indices(arrays['energy'], ydata, max_points)
+        for name in arrays:
+            if arrays[name] is not None:
+                arrays[name] = arrays[name][index]
+
+    names = ('energy', 'mu', 'norm', 'reference', 'reference_norm')
+    if format == 'npy':
+        names = [name for name in names if arrays[name] is not None]
+        out = np.zeros(len(arrays['energy']),
+                       dtype=[(name, 'f8') for name in names])
+        for name in names:
+            out[name] = arrays[name]
+        buff = io.BytesIO()
+        np.save(buff, out)
+        response = Response(buff.getvalue(),
+                            mimetype='application/octet-stream')
+        response.headers['X-E0'] = repr(e0)
+        response.headers['X-Edge-Step'] = repr(edge_step)
+    else:
+        out = {'id': s.id, 'name': s.name, 'kind': kind, 'mode': mode,
+               'e0': e0, 'edge_step': edge_step}
+        for name in ('e0', 'edge_step'):
+            if out[name] is not None and not np.isfinite(out[name]):
+                out[name] = None
+        for name in names:
+            if arrays[name] is not None:
+                arrays[name] = finite_list(arrays[name])
+            out[name] = arrays[name]
+        response = Response(json.dumps(out, allow_nan=False),
+                            mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=%i' % PLOT_MAX_AGE
+    return response
+
+@app.route('/spectrum/<int:spid>/similar')
+def similar_spectra(spid):
+    """spectra of the same element and edge most similar to a spectrum
+
+    query arguments:
+      metric      'cosine' (default), 'pearson' or 'l2'
+      k           number of spectra to show (default 10)
+      emin, emax  energy window relative to the edge (default -20, 80)
+    """
+    session_init(session, db)
+    s = db.get_spectrum(spid)
+    if s is None:
+        error = 'Could not find Spectrum #%i' % spid
+        return render_template('ptable.html', error=error)
 
-    suites = []
-    for r in db.filtered_query('spectrum_suite', spectrum_id=s.id):
-        st = db.filtered_query('suite', id=r.suite_id)[0]
-        suites.append({'id': r.suite_id, 'name': st.name})
-    opts['nsuites'] = len(suites)
-    opts['suites'] = suites
+    metric = request.args.get('metric', 'cosine')
+    try:
+        k = int(request.args.get('k', 10))
+        window = (float(request.args.get('emin', -20)),
+                  float(request.args.get('emax', 80)))
+    except ValueError:
+        abort(400)
 
-    return render_template('spectrum.html', **opts)
+    error = None
+    similar = []
+    try:
+        found = db.find_similar(s.id, k=k, metric=metric, window=window)
+    except XASDBException as exc:
+        error, found = str(exc), []
+    for spectrum_id, score in found:
+        row = db.get_spectrum(spectrum_id)
+        similar.append({'spectrum_id': spectrum_id, 'name': row.name,
+                        'score': '%.4f' % score})
+
+    return render_template('similar.html', spectrum_id=s.id,
+                           spectrum_name=s.name, metric=metric,
+                           emin=window[0], emax=window[1], error=error,
+                           nsimilar=len(similar), similar=similar)
 
 @app.route('/showspectrum_rating/<int:spid>')
 def showspectrum_rating(spid=None):
@@ -532,8 +743,7 @@ def submit_spectrum_edits():
                   beamline_id= int(request.form['beamline']),
                   sample_id= int(request.form['sample']),
                   energy_units_id=int(request.form['energy_units']))
-
-        time.sleep(0.25)
+        plot_cache.invalidate(spid)
 
     return redirect(url_for('spectrum', spid=spid, error=error))
 
@@ -578,7 +788,7 @@ def delete_spectrum(spid, ask=1):
 
     else:
         db.del_spectrum(spid)
-        time.sleep(1)
+        plot_cache.invalidate(spid)
         flash('Deleted spectrum %s' % s_name)
     return redirect(url_for('search', error=error))
 
@@ -594,12 +804,13 @@ def submit_spectrum_rating(spid=None):
 
     if request.method == 'POST':
         score_is_valid = False
+        score = request.form.get('score', '')
         try:
-            score = float(request.form['score'])
+            score = float(score)
             vscore = valid_score(score)
             score_is_valid = ((int(score) == vscore) and
                               (abs(score-int(score)) < 1.e-3))
-        except:
+        except ValueError:
             pass
 
         review = request.form['review']
@@ -615,7 +826,7 @@ def submit_spectrum_rating(spid=None):
             return render_template('ratespectrum.html', error=error,
                                    spectrum_id=spid, spectrum_name=sname,
                                    person_id=pid, score=score,
-                                   review=multilne_text(review))
+                                   review=multiline_text(review))
 
 @app.route('/rate_spectrum/')
 @app.route('/rate_spectrum/<int:spid>')
@@ -658,12 +869,13 @@ def submit_suite_rating(spid=None):
 
     if request.method == 'POST':
         score_is_valid = False
+        score = request.form.get('score', '')
         try:
-            score = float(request.form['score'])
+            score = float(score)
             vscore = valid_score(score)
             score_is_valid = ((int(score) == vscore) and
                               (abs(score-int(score)) < 1.e-3))
-        except:
+        except ValueError:
             pass
 
         review = request.form['review']
@@ -679,7 +891,7 @@ def submit_suite_rating(spid=None):
             return render_template('ratesuite.html', error=error,
                                    suite_id=stid, suite_name=stname,
                                    person_id=pid, score=score,
-                                   review=multilne_text(review))
+                                   review=multiline_text(review))
 
 @app.route('/rate_suite/')
 @app.route('/rate_suite/<int:stid>')
@@ -770,11 +982,11 @@ def submit_spectrum_to_suite():
             found = found or (r.spectrum_id == spid)
         if not found:
             db.addrow('spectrum_suite', suite_id=stid, spectrum_id=spid)
-            time.sleep(0.25)
         else:
             stname = db.filtered_query('suite', id=stid)[0].name
             spname = db.get_spectrum(spid).name
             error = "Spectrum '%s' is already in Suite '%s'" % (spname, stname)
+        return redirect(url_for('suites', stid=stid, error=error))
 
     return redirect(url_for('suites', error=error))
 
@@ -782,7 +994,7 @@ def submit_spectrum_to_suite():
 @app.route('/rawfile/<int:spid>/<fname>')
 def rawfile(spid, fname):
     session_init(session, db)
-    s  = db.get_spectrum(spid)
+    s  = db.get_spectrum(spid, arrays=True)
     if s is None:
         error = 'Could not find Spectrum #%i' % spid
         return render_template('ptable.html', error=error)
@@ -840,14 +1052,14 @@ def add_suite():
         suite_name = request.form['suite_name']
         person_id = request.form['person']
         notes = request.form['notes']
-        _sname = [s.name for s in db.filtered_query('suite')]
+        stid = None
         try:
-            suite_name = unique_name(suite_name, _sname,  msg='suite')
-        except:
-            error = 'a suite named %s exists'
-        db.add_suite(suite_name, notes=notes, person_id=int(person_id))
-        time.sleep(0.5)
-        return redirect(url_for('suites', error=error))
+            suite_name = db.get_unique_name('suite', suite_name, msg='suite')
+            stid = db.add_suite(suite_name, notes=notes,
+                                person_id=int(person_id))
+        except XASDBException:
+            error = 'a suite named %s exists' % suite_name
+        return redirect(url_for('suites', stid=stid, error=error))
     else:
 
         return render_template('add_suite.html', error=error,
@@ -869,8 +1081,7 @@ def delete_suite(stid, ask=1):
 
     else:
         db.del_suite(stid)
-        time.sleep(1)
-        flash('Deleted suite %s' % s_name)
+        flash('Deleted suite %s' % suite_name)
     return redirect(url_for('suites', error=error))
 
 @app.route('/edit_suite/<int:stid>')
@@ -912,7 +1123,6 @@ def submit_suite_edits():
             key = 'spec_%i' % spid
             if key not in request.form:
                 db.remove_spectrum_from_suite(stid, spid)
-        time.sleep(0.25)
 
     return redirect(url_for('suites', stid=stid, error=error))
 
@@ -961,13 +1171,12 @@ def submit_sample_edits():
         # xtal_data   = request.form['xtal_data']
 
         db.update('sample', int(sid),
-                  person=pid,
+                  person_id=int(pid),
                   name=name,
                   notes=notes,
                   formula=formula,
                   material_source=source,
                   preparation=prep)
-        time.sleep(0.25)
     return redirect(url_for('sample', sid=sid, error=error))
 
 @app.route('/beamlines')
@@ -977,23 +1186,17 @@ def beamlines(blid=None, orderby='id', reverse=0):
     session_init(session, db)
     beamlines = []
 
-    for bldat in get_beamline_list(db, orderby=orderby):
-        blid = bldat['id']
-        spectra = spectra_for_beamline(db, blid)
+    reverse = int(reverse)
+    all_spectra = spectra_by_beamline(db)
+    for bldat in get_beamline_list(db, orderby=orderby, reverse=reverse):
+        spectra = all_spectra.get(int(bldat['id']), [])
         opts = {'nspectra': len(spectra), 'spectra': spectra}
         opts.update(bldat)
         beamlines.append(opts)
 
-    reverse = int(reverse)
-    if reverse:
-        beamlines.reverse()
-        reverse = 0
-    else:
-        reverse = 1
-
     return render_template('beamlines.html',
                            nbeamlines=len(beamlines),
-                           beamlines=beamlines, reverse=reverse)
+                           beamlines=beamlines, reverse=0 if reverse else 1)
 
 @app.route('/beamline')
 @app.route('/beamline/<int:blid>')
@@ -1028,17 +1231,13 @@ def add_beamline():
         fac_id = int(request.form['fac_id'])
         source = request.form['xray_source']
 
-        _blnames = [s.name for s in db.filtered_query('beamline')]
         try:
-            bl_name = unique_name(bl_name, _blnames,
-                                  msg='beamline', maxcount=5)
-        except:
-            error = 'a beamline named %s exists'
-
-        db.add_beamline(bl_name, notes=notes, xray_source=source,
-                        facility_id=fac_id)
-
-        time.sleep(1)
+            bl_name = db.get_unique_name('beamline', bl_name,
+                                         msg='beamline', maxcount=5)
+            db.add_beamline(bl_name, notes=notes, xray_source=source,
+                            facility_id=fac_id)
+        except XASDBException:
+            error = 'a beamline named %s exists' % bl_name
         return redirect(url_for('beamlines', error=error))
     else:
         facilities = []
@@ -1065,13 +1264,16 @@ def add_facility():
 
     if request.method == 'POST':
         fac_name = request.form['facility_name']
-        _facnames = [s.name for s in db.filtered_query('facility')]
         try:
-            fac_name = unique_name(fac_name, _facnames,  msg='facility', maxcount=5)
-        except:
-            error = 'a facility named %s exists'
-        db.add_beamline(fac_name)
-        time.sleep(1)
+            fac_name = db.get_unique_name('facility', fac_name,
+                                          msg='facility', maxcount=5)
+            db.add_facility(fac_name,
+                            laboratory=request.form.get('facility_lab', ''),
+                            city=request.form.get('facility_city', ''),
+                            region=request.form.get('facility_region', ''),
+                            country=request.form.get('facility_country', ''))
+        except XASDBException:
+            error = 'a facility named %s exists' % fac_name
         return redirect(url_for('list_facilities', error=error))
     else:
         facilities = []
@@ -1091,7 +1293,7 @@ def list_facilities():
 
 @app.route('/citation')
 @app.route('/citation/<int:cid>')
-def citation(blid=None):
+def citation(cid=None):
     session_init(session, db)
     spectra = spectra_for_citation(db, cid)
     opts = {'nspectra': len(spectra), 'spectra': spectra}
@@ -1145,15 +1347,13 @@ def submit_upload():
                 pass
 
             if file_ok:
-                time.sleep(1.0)
-                db.add_xdifile(fullpath, person=pemail, create_sample=True)
-                time.sleep(1.0)
-                db.session.commit()
-
-            s  = db.get_spectra()[-1]
-            if s is None:
-                error = 'Could not find Spectrum #%i' % s.id
-                return render_template('upload.html', error=error)
+                try:
+                    spid = db.add_xdifile(fullpath, person=pemail,
+                                          create_sample=True)
+                except XASDBException as exc:
+                    error = "Could not add '%s': %s" % (file.filename, exc)
+                    return render_template('upload.html', error=error)
+                s = db.get_spectrum(spid)
 
         if s is None:
             error = "File '%s' not found or not suppported type" %  (file.filename)
@@ -1161,7 +1361,7 @@ def submit_upload():
 
         try:
             opts = parse_spectrum(s, db)
-        except:
+        except (XASDBException, ValueError, TypeError, KeyError, IndexError):
             error = "Could not read spectrum from '%s'" % (file.filename)
             return render_template('upload.html', error=error)
         return redirect(url_for('spectrum', spid=s.id, error=error))
@@ -1169,4 +1369,4 @@ def submit_upload():
 
 if __name__ == "__main__":
     app.jinja_env.cache = {}
-    app.run(port=PORT)
+    app.run(port=PORT, threaded=True)
@@ -28,20 +28,27 @@ from .xasdb import (isXASDataLibrary, XASDataLibrary, XASDBException,
                     Info, Mode, Facility, Beamline, EnergyUnits, Edge,
                     Element, Ligand, Citation,
                     Person, Spectrum_Rating, Suite_Rating, Suite,
-                    Sample, Spectrum, fmttime, valid_score, unique_name)
+                    Sample, Spectrum, fmttime, valid_score, unique_name,
+                    rating_summary,
+                    encode_array, decode_array, ARRAY_FORMATS,
+                    read_xdifile, XDIResult, LCFResult)
 
 from .creator import make_newdb
 
 def create_xasdb(dbname, server='sqlite', user='',
-              password='', port=5432, host=''):
+              password='', port=5432, host='', array_format='json'):
     """create a new XAS Data Library"""
     return make_newdb(dbname,
                       server=server, user=user,
-                      password=password, port=port, host=host)
+                      password=password, port=port, host=host,
+                      array_format=array_format)
 
 def connect_xasdb(dbname, server='sqlite', user='',
-            password='', port=5432, host=''):
-    """connect to a XAS Data Library"""
+            password='', port=5432, host='', scoped=False, pool_size=5):
+    """connect to a XAS Data Library
+
+    use scoped=True for a session per thread, as for a web server"""
     return XASDataLibrary(dbname,
                           server=server, user=user,
-                          password=password, port=port, host=host)
+                          password=password, port=port, host=host,
+                          scoped=scoped, pool_size=pool_size)
@@ -10,7 +10,8 @@ from datetime import datetime
 
 from sqlalchemy.orm import sessionmaker, create_session
 from sqlalchemy import MetaData, create_engine, \
-     Table, Column, Integer, Float, String, Text, DateTime, ForeignKey
+     Table, Column, Integer, Float, String, Text, DateTime, ForeignKey, \
+     LargeBinary, Index
 from sqlalchemy.pool import SingletonThreadPool
 
 def PointerCol(name, other=None, keyid='id', **kws):
@@ -27,6 +28,12 @@ def StrCol(name, size=None, **kws):
     else:
         return Column(name, String(size), **kws)
 
+def ArrayCol(name, array_format='json', **kws):
+    "array column: text for 'json' arrays, blob for 'binary' arrays"
+    if array_format == 'binary':
+        return Column(name, LargeBinary, **kws)
+    return Column(name, Text, **kws)
+
 def IntCol(name, **kws):
     "integer column"
     return Column(name, Integer, **kws)
@@ -47,8 +54,112 @@ def NamedTable(tablename, metadata, keyid='id', nameid='name',
         args.extend(cols)
     return Table(tablename, metadata, *args)
 
+def make_spectrum_data(metadata, array_format='json'):
+    """create spectrum_data table, holding the bulk array data and
+    original file text for each spectrum, keyed by spectrum id"""
+    return Table('spectrum_data', metadata,
+                 Column('spectrum_id', None, ForeignKey('spectrum.id'),
+                        primary_key=True),
+                 ArrayCol('energy', array_format),
+                 ArrayCol('i0', array_format),
+                 ArrayCol('itrans', array_format),
+                 ArrayCol('ifluor', array_format),
+                 ArrayCol('irefer', array_format),
+                 ArrayCol('energy_stderr', array_format),
+                 ArrayCol('i0_stderr', array_format),
+                 ArrayCol('itrans_stderr', array_format),
+                 ArrayCol('ifluor_stderr', array_format),
+                 ArrayCol('irefer_stderr', array_format),
+                 StrCol('filetext'))
+
+def make_spectrum_derived(metadata, array_format='json'):
+    """create spectrum_derived table, holding results of pre-edge
+    subtraction and normalization for each channel ('sample' or
+    'reference') of a spectrum, with the parameters and algorithm
+    version used"""
+    return Table('spectrum_derived', metadata,
+                 Column('spectrum_id', None, ForeignKey('spectrum.id'),
+                        primary_key=True),
+                 StrCol('channel', size=16, primary_key=True),
+                 StrCol('version', size=16),
+                 StrCol('params'),
+                 Column('e0', Float),
+                 Column('edge_step', Float),
+                 StrCol('pre_coefs'),
+                 StrCol('norm_coefs'),
+                 ArrayCol('norm', array_format))
+
+def make_spectrum_xanes(metadata):
+    """create spectrum_xanes table, holding the normalized XANES of
+    each spectrum on the grid of energies relative to the edge used for
+    similarity searches (see similarity.py), as float32 blobs.  xanes
+    is NULL for spectra that could not be normalized."""
+    return Table('spectrum_xanes', metadata,
+                 Column('spectrum_id', None, ForeignKey('spectrum.id'),
+                        primary_key=True),
+                 StrCol('grid', size=32),
+                 Column('xanes', LargeBinary))
+
+def summary_columns():
+    """columns of the spectrum table summarizing its arrays, so that
+    spectra can be selected without reading them: number of points,
+    energy range and median energy step in eV, e0 and edge step of the
+    sample channel, and whether there is a reference channel"""
+    return [IntCol('npts'), Column('emin', Float), Column('emax', Float),
+            Column('estep', Float), Column('e0', Float),
+            Column('edge_step', Float), IntCol('has_reference')]
+
+def rating_columns():
+    """columns of the spectrum and suite tables for the average, number
+    and sum of the scores of their ratings, kept up to date as ratings
+    change, so that they can be sorted by rating.  The totals are 0
+    and the average NULL for items without ratings."""
+    return [Column('rating_avg', Float),
+            IntCol('rating_count', nullable=False, server_default='0'),
+            IntCol('rating_sum', nullable=False, server_default='0')]
+
+# secondary indexes, as (table, column): names that are not unique,
+# and the foreign keys used to select spectra, suites, ratings and modes.
+# A tuple of columns makes an index on all of them: (element_z, column)
+# lists the spectra of an element sorted by column, as the web pages do.
+INDEXES = (('spectrum', 'name'), ('sample', 'name'),
+           ('spectrum', 'element_z'), ('spectrum', 'edge_id'),
+           ('spectrum', 'beamline_id'), ('spectrum', 'person_id'),
+           ('spectrum_suite', 'suite_id'), ('spectrum_suite', 'spectrum_id'),
+           ('spectrum_rating', 'spectrum_id'), ('suite_rating', 'suite_id'),
+           ('spectrum_mode', 'spectrum_id'), ('spectrum', 'npts'),
+           ('spectrum', 'emin'), ('spectrum', 'emax'), ('spectrum', 'estep'),
+           ('spectrum', 'e0'), ('spectrum', 'edge_step'),
+           ('spectrum', 'sample_id'), ('spectrum', 'citation_id'),
+           ('beamline', 'facility_id'), ('spectrum_mode', 'mode_id'),
+           ('spectrum_ligand', 'spectrum_id'),
+           ('spectrum_ligand', 'ligand_id'), ('spectrum', 'rating_avg'),
+           ('spectrum', ('element_z', 'name')),
+           ('spectrum', ('element_z', 'edge_id')),
+           ('spectrum', ('element_z', 'beamline_id')),
+           ('spectrum', ('element_z', 'rating_avg')))
+
+def index_name(tablename, colname):
+    "name of the index on a column, or tuple of columns, of a table"
+    if isinstance(colname, tuple):
+        colname = '_'.join(colname)
+    return 'ix_%s_%s' % (tablename, colname)
+
+# unique indexes: one rating of a spectrum or suite per person
+UNIQUE_INDEXES = (('spectrum_rating', ('person_id', 'spectrum_id')),
+                  ('suite_rating', ('person_id', 'suite_id')))
+
+def make_index(metadata, tablename, colname, unique=False):
+    """index on one column, or a tuple of columns, of a table, named
+    ix_<table>_<column>[_<column>]"""
+    table = metadata.tables[tablename]
+    if not isinstance(colname, tuple):
+        colname = (colname,)
+    return Index(index_name(tablename, colname),
+                 *[table.c[col] for col in colname], unique=unique)
+
 class InitialData:
-    info    = [["version", "1.1.0"],
+    info    = [["version", "1.10.0"],
                ["create_date", '<now>'],
                ["modify_date", '<now>']]
 
@@ -164,9 +275,12 @@ class InitialData:
                 [111,"Rg", "roentgenium"],  [112,"Cn", "copernicium"] ]
 
 def  make_newdb(dbname, server= 'sqlite', user='',
-                password='',  host='', port=None):
+                password='',  host='', port=None, array_format='json'):
     """create initial xafs data library.  server can be
     'sqlite' or 'postgresql'
+
+    array_format sets how spectrum arrays are stored, and can be
+    'json' (text) or 'binary' (little-endian float64 blobs)
     """
     if server.startswith('sqlit'):
         engine = create_engine('sqlite:///%s' % (dbname),
@@ -252,27 +366,17 @@ def  make_newdb(dbname, server= 'sqlite', user='',
                               ])
 
     spectrum = NamedTable('spectrum', metadata, name_unique=False,
-                          cols=[StrCol('energy'),
-                                StrCol('i0'),
-                                StrCol('itrans'),
-                                StrCol('ifluor'),
-                                StrCol('irefer'),
-                                StrCol('energy_stderr'),
-                                StrCol('i0_stderr'),
-                                StrCol('itrans_stderr'),
-                                StrCol('ifluor_stderr'),
-                                StrCol('irefer_stderr'),
-                                StrCol('energy_notes'),
+                          cols=[StrCol('energy_notes'),
                                 StrCol('i0_notes'),
                                 StrCol('itrans_notes'),
                                 StrCol('ifluor_notes'),
                                 StrCol('irefer_notes'),
                                 StrCol('temperature'),
-                                StrCol('filetext'),
                                 StrCol('comments'),
                                 Column('d_spacing', Float),
                                 DateCol('submission_date'),
                                 DateCol('collection_date'),
+                                DateCol('modify_date'),
                                 IntCol('reference_used'),
                                 PointerCol('energy_units'),
                                 PointerCol('person'),
@@ -283,12 +387,17 @@ def  make_newdb(dbname, server= 'sqlite', user='',
                                 PointerCol('citation'),
                                 PointerCol('reference_mode', 'mode'),
                                 PointerCol('reference', 'sample'),
-                                StrCol('rating_summary')])
+                                StrCol('rating_summary')] +
+                          rating_columns() + summary_columns())
+
+    spectrum_data = make_spectrum_data(metadata, array_format)
+    spectrum_derived = make_spectrum_derived(metadata, array_format)
+    spectrum_xanes = make_spectrum_xanes(metadata)
 
     suite = NamedTable('suite', metadata,
                        cols=[PointerCol('person'),
                              StrCol('rating_summary'),
-                             ])
+                             ] + rating_columns())
 
     beamline = NamedTable('beamline', metadata,
                           cols=[StrCol('xray_source'),
@@ -325,6 +434,11 @@ def  make_newdb(dbname, server= 'sqlite', user='',
                            PointerCol('ligand'),
                            PointerCol('spectrum'))
 
+    for tablename, colname in INDEXES:
+        make_index(metadata, tablename, colname)
+    for tablename, colname in UNIQUE_INDEXES:
+        make_index(metadata, tablename, colname, unique=True)
+
     metadata.create_all()
     session = sessionmaker(bind=engine)()
 
@@ -355,6 +469,7 @@ def  make_newdb(dbname, server= 'sqlite', user='',
         if value == '<now>':
             value = now
         info.insert().execute(key=key, value=value)
+    info.insert().execute(key='array_format', value=array_format)
 
     session.flush()
     session.commit()
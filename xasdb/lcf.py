@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+   linear-combination fitting of normalized XANES
+
+   An unknown spectrum is fit as a non-negative sum of standards, for
+   every subset of up to max_components standards.  The standards are
+   interpolated onto the unknown's energies once, as the columns of a
+   design matrix A, and all subsets are then solved from the shared
+   A^T A and A^T y: for each subset, the unconstrained least-squares
+   weights come from one small linear solve, done for many subsets at
+   a time.  A subset whose weights are not all positive is dropped, as
+   its non-negative least-squares fit is that of one of its own
+   subsets, which is solved too.
+
+   Fits are ranked by R-factor, sum((y - fit)^2) / sum(y^2).
+"""
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations, islice, chain
+from math import factorial
+import os
+import numpy as np
+
+LCFResult = namedtuple('LCFResult', ('spectrum_ids', 'weights',
+                                     'rfactor', 'chi_square'))
+
+# subsets solved per call of lcf_subsets(), and the number of subsets
+# above which lcf_fit() uses a pool of processes
+CHUNK_SIZE = 50000
+POOL_MIN_SUBSETS = 500000
+
+def ncombinations(n, k):
+    "number of subsets of 1 to k of n items"
+    total = 0
+    for m in range(1, min(n, k)+1):
+        total += factorial(n)//(factorial(m)*factorial(n-m))
+    return total
+
+def lcf_subsets(gram, aty, yty, subsets, nbest=10, tiny=1.e-12):
+    """non-negative least-squares fits for subsets of the columns of a
+    design matrix A, from gram = A^T A, aty = A^T y and yty = y^T y.
+
+    subsets is an int array of shape (nsubsets, ncomponents).
+    returns (subsets, weights, chi_square) for the nbest fits with all
+    weights positive, best first"""
+    subsets = np.asarray(subsets)
+    gsub = gram[subsets[:, :, None], subsets[:, None, :]]
+    csub = aty[subsets]
+    try:
+        weights = np.linalg.solve(gsub, csub[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        weights = np.einsum('nij,nj->ni', np.linalg.pinv(gsub), csub)
+    chisq = (yty - 2*np.einsum('ni,ni->n', weights, csub) +
+             np.einsum('ni,nij,nj->n', weights, gsub, weights))
+    good = np.all(weights > tiny, axis=1) & np.isfinite(chisq)
+    subsets, weights, chisq = subsets[good], weights[good], chisq[good]
+    if len(chisq) > nbest:
+        best = np.argpartition(chisq, nbest-1)[:nbest]
+        subsets, weights, chisq = subsets[best], weights[best], chisq[best]
+    order = np.argsort(chisq, kind='stable')
+    return subsets[order], weights[order], np.maximum(chisq[order], 0)
+
+def _subset_chunks(ncols, max_components, chunk_size=CHUNK_SIZE):
+    "generate int arrays of subsets of ncols columns, by size"
+    for ncomp in range(1, min(ncols, max_components)+1):
+        subsets = combinations(range(ncols), ncomp)
+        while True:
+            chunk = np.fromiter(chain.from_iterable(islice(subsets,
+                                                           chunk_size)),
+                                dtype=np.int32)
+            if len(chunk) == 0:
+                break
+            yield chunk.reshape((-1, ncomp))
+
+def lcf_fit(y, design, max_components=3, nbest=10, workers=None):
+    """fit y as non-negative linear combinations of up to max_components
+    columns of design, for all subsets of columns.
+
+    Large searches (more than POOL_MIN_SUBSETS subsets) are spread over
+    a pool of workers processes (default: one per cpu).
+
+    returns list of (columns, weights, rfactor, chi_square) for the
+    nbest fits, best first"""
+    y = np.asarray(y, dtype=np.float64)
+    design = np.asarray(design, dtype=np.float64)
+    gram, aty, yty = design.T.dot(design), design.T.dot(y), y.dot(y)
+    chunks = _subset_chunks(design.shape[1], max_components)
+    nsubsets = ncombinations(design.shape[1], max_components)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and nsubsets > POOL_MIN_SUBSETS:
+        results, pending = [], deque()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chunk in chunks:
+                pending.append(pool.submit(lcf_subsets, gram, aty, yty,
+                                           chunk, nbest))
+                if len(pending) >= 2*workers:
+                    results.append(pending.popleft().result())
+            while len(pending) > 0:
+                results.append(pending.popleft().result())
+    else:
+        results = [lcf_subsets(gram, aty, yty, chunk, nbest)
+                   for chunk in chunks]
+    fits = []
+    for subsets, weights, chisq in results:
+        for cols, wts, chi2 in zip(subsets, weights, chisq):
+            fits.append((chi2, cols.tolist(), wts.tolist()))
+    fits.sort(key=lambda fit: fit[0])
+    return [(cols, wts, float(chi2/yty), float(chi2))
+            for chi2, cols, wts in fits[:nbest]]
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+   schema migrations for an existing XAS Data Library
+
+   Each migration upgrades a library to a schema version.  migrate()
+   applies, in order, every migration newer than the 'version' entry
+   of the info table, then records the migration in the info table
+   (as 'migration <version>') and updates 'version'.
+
+   Migrations check what is already present, so that re-running a
+   migration that was interrupted part way is safe.
+"""
+import re
+import logging
+from datetime import datetime
+import numpy as np
+
+from sqlalchemy import select, text, func, and_
+
+from .creator import (make_spectrum_data, make_spectrum_derived,
+                      make_spectrum_xanes, make_index, index_name,
+                      INDEXES, UNIQUE_INDEXES, DateCol, summary_columns,
+                      rating_columns)
+from .xafs_preedge import preedge
+
+MIGRATIONS = []
+
+def migration(version, description):
+    "decorator to register a migration function for a schema version"
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: version_tuple(m[0]))
+        return func
+    return register
+
+def version_tuple(version):
+    "version string '1.2.0' -> (1, 2, 0) for comparisons"
+    return tuple([int(x) for x in version.split('.')])
+
+def add_columns(db, tablename, cols):
+    "add columns to an existing table, skipping any already present"
+    tab = db.tables[tablename]
+    for col in cols:
+        if col.name in tab.c:
+            continue
+        coltype = col.type.compile(dialect=db.engine.dialect)
+        if col.server_default is not None:
+            coltype = '%s default %s' % (coltype, col.server_default.arg)
+        if not col.nullable:
+            coltype = '%s not null' % coltype
+        with db.engine.begin() as conn:
+            conn.execute(text('alter table %s add column %s %s' %
+                              (tablename, col.name, coltype)))
+        tab.append_column(col)
+        if tablename == 'spectrum':
+            db.spectrum_cols.append(col)
+
+@migration('1.2.0', 'move spectrum arrays and file text to spectrum_data')
+def spectrum_data(db):
+    """create spectrum_data table and move array data and file text
+    out of the spectrum table"""
+    if 'spectrum_data' in db.tables:
+        return
+    tab = db.tables['spectrum']
+    dtab = make_spectrum_data(db.metadata, db.array_format)
+    dtab.create()
+    names = [col.name for col in dtab.c if col.name != 'spectrum_id']
+    cols = [getattr(tab.c, name) for name in names]
+    with db.engine.begin() as conn:
+        conn.execute(dtab.insert().from_select(
+            ['spectrum_id'] + names, select([tab.c.id] + cols)))
+        conn.execute(tab.update().values(
+            **dict([(col.name, None) for col in cols])))
+    db.data_table, db.data_key = dtab, dtab.c.spectrum_id
+
+@migration('1.3.0', 'add indexes for names and foreign keys')
+def secondary_indexes(db):
+    """add any missing indexes from creator.INDEXES, for columns that
+    exist: columns added by later migrations are indexed there"""
+    for tablename, colname in INDEXES:
+        table = db.tables[tablename]
+        colnames = colname if isinstance(colname, tuple) else (colname,)
+        if any([col not in table.c for col in colnames]):
+            continue
+        indexed = [tuple([col.name for col in ix.columns])
+                   for ix in table.indexes]
+        if colnames not in indexed:
+            make_index(db.metadata, tablename, colname).create(db.engine)
+
+def fill_rating_totals(db):
+    """set the rating columns of spectrum and suite (those present of
+    rating_avg, rating_count and rating_sum) from their ratings, with
+    totals of 0 for items without ratings"""
+    aggregates = {'rating_avg': func.avg, 'rating_count': func.count,
+                  'rating_sum': lambda score: func.coalesce(func.sum(score),
+                                                            0)}
+    for tablename in ('spectrum', 'suite'):
+        tab = db.tables[tablename]
+        rtab = db.tables['%s_rating' % tablename]
+        match = rtab.c['%s_id' % tablename] == tab.c.id
+        values = {}
+        for name, aggregate in aggregates.items():
+            if name in tab.c:
+                values[name] = select([aggregate(rtab.c.score)]).where(
+                    match).as_scalar()
+        with db.engine.begin() as conn:
+            conn.execute(tab.update().values(**values))
+
+@migration('1.4.0', 'add spectrum_derived table for normalized spectra')
+def spectrum_derived(db):
+    """create spectrum_derived table: rows are filled in as spectra
+    are viewed, or with XASDataLibrary.recompute_derived()"""
+    if 'spectrum_derived' not in db.tables:
+        make_spectrum_derived(db.metadata, db.array_format).create()
+
+@migration('1.5.0', 'add modify_date to spectrum')
+def spectrum_modify_date(db):
+    """add spectrum.modify_date, the time a spectrum or its derived
+    data last changed, set to the submission date for existing spectra"""
+    tab = db.tables['spectrum']
+    if 'modify_date' in tab.c:
+        return
+    add_columns(db, 'spectrum', [DateCol('modify_date')])
+    tab.update().values(modify_date=tab.c.submission_date).execute()
+
+@migration('1.6.0', 'add spectrum_xanes table for similarity searches')
+def spectrum_xanes(db):
+    """create spectrum_xanes table: rows are filled in for each element
+    and edge on the first similarity search"""
+    if 'spectrum_xanes' not in db.tables:
+        make_spectrum_xanes(db.metadata).create()
+
+def summary_1_7(arrays, units, mode, stored):
+    """values of the summary columns added in schema 1.7.0, from a
+    spectrum's decoded arrays, energy units and first mode, and the
+    (e0, edge_step) stored for its sample channel, or None if there
+    are none stored"""
+    out = {'npts': None, 'emin': None, 'emax': None, 'estep': None,
+           'e0': None, 'edge_step': None, 'has_reference': 0}
+    energy = arrays['energy']
+    if energy is None or not (units.startswith('eV') or
+                              units.startswith('keV')):
+        return out
+    out['has_reference'] = int(arrays['irefer'] is not None and
+                               arrays['itrans'] is not None)
+    energy = np.asarray(energy, dtype=np.float64)
+    if units.startswith('keV'):
+        energy = energy*1000.0
+    valid = np.sort(energy[np.isfinite(energy)])
+    out['npts'] = len(valid)
+    if len(valid) > 0:
+        out['emin'], out['emax'] = float(valid[0]), float(valid[-1])
+    if len(valid) > 1:
+        out['estep'] = float(np.median(np.diff(valid)))
+    if stored is not None:
+        out['e0'], out['edge_step'] = stored
+        return out
+    i0, itrans, ifluor = arrays['i0'], arrays['itrans'], arrays['ifluor']
+    mu = None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if mode == 'transmission':
+            if itrans is not None and i0 is not None:
+                mu = -np.log(itrans/i0)
+        elif ifluor is not None and i0 is not None:
+            mu = ifluor/i0
+    if mu is not None and len(energy) == len(mu) and len(energy) > 2:
+        try:
+            group = preedge(energy, mu)
+            out['e0'] = float(group['e0'])
+            out['edge_step'] = float(group['edge_step'])
+            if mode.endswith('unitstep'):
+                out['edge_step'] = 1.0
+        except Exception:
+            logging.getLogger('xasdb').exception(
+                'could not normalize spectrum for its summary')
+    return out
+
+@migration('1.7.0', 'add array summary columns to spectrum')
+def spectrum_summary(db, batch_size=200):
+    """add the spectrum columns summarizing its arrays (npts, emin,
+    emax, estep, e0, edge_step, has_reference), with their indexes,
+    and fill them in for existing spectra.
+
+    The values are made here, with summary_1_7(), and not with the
+    library's current code, so that this step does not change when
+    that code does.  e0 and edge_step are taken from stored normalized
+    spectra, or found with preedge() for spectra with none.  Only the
+    decoding of stored arrays is shared, as it must read them as they
+    were stored."""
+    from .xasdb import decode_array
+    add_columns(db, 'spectrum', summary_columns())
+    secondary_indexes(db)
+    stab, dtab = db.tables['spectrum'], db.tables['spectrum_data']
+    utab, mtab = db.tables['energy_units'], db.tables['mode']
+    smtab = db.tables['spectrum_mode']
+    xtab = db.tables.get('spectrum_derived', None)
+    names = ('energy', 'i0', 'itrans', 'ifluor', 'irefer')
+    spectrum_ids = [row.id for row in select([stab.c.id]).where(
+        stab.c.npts==None).order_by(stab.c.id).execute().fetchall()]
+    for i in range(0, len(spectrum_ids), batch_size):
+        batch = spectrum_ids[i:i+batch_size]
+        query = select([stab.c.id, utab.c.units] +
+                       [dtab.c[name] for name in names]).select_from(
+            stab.join(dtab, dtab.c.spectrum_id==stab.c.id).outerjoin(
+                utab, utab.c.id==stab.c.energy_units_id)).where(
+                    stab.c.id.in_(batch))
+        rows = query.execute().fetchall()
+        modes = {}
+        query = select([smtab.c.spectrum_id, mtab.c.name]).where(and_(
+            smtab.c.mode_id==mtab.c.id, smtab.c.spectrum_id.in_(batch)))
+        for row in query.order_by(smtab.c.id).execute().fetchall():
+            modes.setdefault(row.spectrum_id, row.name)
+        stored = {}
+        if xtab is not None:
+            # 'none' rows mark spectra that could not be normalized
+            query = select([xtab.c.spectrum_id, xtab.c.channel,
+                            xtab.c.e0, xtab.c.edge_step]).where(and_(
+                                xtab.c.spectrum_id.in_(batch),
+                                xtab.c.channel.in_(['sample', 'none'])))
+            for row in query.execute().fetchall():
+                if row.channel == 'sample':
+                    stored[row.spectrum_id] = (row.e0, row.edge_step)
+                else:
+                    stored.setdefault(row.spectrum_id, (None, None))
+        with db.engine.begin() as conn:
+            for row in rows:
+                arrays = dict([(name, decode_array(row[name]))
+                               for name in names])
+                values = summary_1_7(arrays, row.units or 'eV',
+                                     modes.get(row.id, 'transmission'),
+                                     stored.get(row.id, None))
+                conn.execute(stab.update().where(
+                    stab.c.id==row.id).values(**values))
+
+@migration('1.8.0', 'add indexes for spectrum filters')
+def filter_indexes(db):
+    """add indexes used by get_spectra() filters: sample, citation,
+    facility, mode and ligand"""
+    secondary_indexes(db)
+
+@migration('1.9.0', 'add rating average and count to spectrum and suite')
+def rating_aggregates(db):
+    """add the rating_avg and rating_count columns of spectrum and
+    suite, filled in from their ratings, and the indexes for sorting
+    spectra by name, edge, beamline and rating"""
+    for tablename in ('spectrum', 'suite'):
+        add_columns(db, tablename, rating_columns()[:2])
+    fill_rating_totals(db)
+    secondary_indexes(db)
+
+@migration('1.10.0', 'add rating sums, with one rating per person')
+def rating_sums(db):
+    """add the rating_sum column of spectrum and suite, keep only the
+    latest rating of a spectrum or suite by each person, with a unique
+    index so that there cannot be two, and set the rating totals.  The
+    rating_summary strings are cleared: they are made from the totals
+    when read."""
+    for tablename in ('spectrum', 'suite'):
+        add_columns(db, tablename, rating_columns())
+        rtab = db.tables['%s_rating' % tablename]
+        item = rtab.c['%s_id' % tablename]
+        latest = select([func.max(rtab.c.id)]).group_by(rtab.c.person_id,
+                                                         item)
+        with db.engine.begin() as conn:
+            conn.execute(rtab.delete().where(~rtab.c.id.in_(latest)))
+            conn.execute(db.tables[tablename].update().values(
+                rating_summary=None))
+    fill_rating_totals(db)
+    for tablename, colname in UNIQUE_INDEXES:
+        table = db.tables[tablename]
+        if index_name(tablename, colname) not in [ix.name for ix in
+                                                  table.indexes]:
+            make_index(db.metadata, tablename, colname,
+                       unique=True).create(db.engine)
+
+def pending_migrations(db):
+    "list of (version, description, function) not yet applied to db"
+    current = version_tuple(db.get_info('version', default='1.0.0'))
+    return [m for m in MIGRATIONS if version_tuple(m[0]) > current]
+
+def migrate(db):
+    """apply all pending migrations to db, returning list of
+    (version, description) for the migrations applied"""
+    applied = []
+    for version, description, func in pending_migrations(db):
+        func(db)
+        now = datetime.isoformat(datetime.now())
+        db.set_info('migration %s' % version,
+                    '%s, applied %s' % (description, now))
+        db.set_info('version', version)
+        applied.append((version, description))
+    if len(applied) > 0:
+        db.clear_cache()
+        db.set_mod_time()
+    return applied
+
+# queries made for nearly every page of the web app, as
+# (description, sql): each must be able to use an index
+HOT_QUERIES = (
+    ('spectra by name', "select id from spectrum where name='x'"),
+    ('samples by name', "select id from sample where name='x'"),
+    ('spectra by element', "select id from spectrum where element_z=1"),
+    ('spectra by edge', "select id from spectrum where edge_id=1"),
+    ('spectra by beamline', "select id from spectrum where beamline_id=1"),
+    ('spectra by person', "select id from spectrum where person_id=1"),
+    ('spectra in suite',
+     "select spectrum_id from spectrum_suite where suite_id=1"),
+    ('suites for spectrum',
+     "select suite_id from spectrum_suite where spectrum_id=1"),
+    ('spectrum ratings',
+     "select score from spectrum_rating where spectrum_id=1"),
+    ('suite ratings', "select score from suite_rating where suite_id=1"),
+    ('spectrum modes',
+     "select mode_id from spectrum_mode where spectrum_id=1"),
+    ('spectra by points', "select id from spectrum where npts<300"),
+    ('spectra by energy range', "select id from spectrum where emax>8000"),
+    ('spectra by sample', "select id from spectrum where sample_id=1"),
+    ('spectra by citation', "select id from spectrum where citation_id=1"),
+    ('beamlines by facility', "select id from beamline where facility_id=1"),
+    ('spectra by mode',
+     "select spectrum_id from spectrum_mode where mode_id=1"),
+    ('spectra by ligand',
+     "select spectrum_id from spectrum_ligand where ligand_id=1"),
+    ('spectra by element, by name',
+     "select id from spectrum where element_z=1 order by name, id limit 100"),
+    ('spectra by element, by rating',
+     "select id from spectrum where element_z=1 "
+     "order by rating_avg desc, id desc limit 100"),
+    ('spectra by rating',
+     "select id from spectrum order by rating_avg, id limit 100"))
+
+SQLITE_SCAN = re.compile(r'\bSCAN (TABLE )?\w+')
+SQLITE_SORT = 'USE TEMP B-TREE'
+
+def check_query_plans(db, queries=HOT_QUERIES):
+    """check that the hot queries use indexes, not full table scans
+    or sorts, returning a list of (description, plan) for those that
+    do not.
+
+    For postgresql, sequential scans are disabled while explaining,
+    so that a sequential scan is only chosen when no index applies.
+    """
+    failed = []
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == 'sqlite':
+            for desc, sql in queries:
+                rows = conn.execute(text('explain query plan %s' % sql))
+                steps = [row[-1] for row in rows]
+                for step in steps:
+                    if ((SQLITE_SCAN.search(step) and 'INDEX' not in step)
+                            or SQLITE_SORT in step):
+                        failed.append((desc, '; '.join(steps)))
+                        break
+        else:
+            trans = conn.begin()
+            conn.execute(text('set local enable_seqscan = off'))
+            for desc, sql in queries:
+                rows = conn.execute(text('explain %s' % sql))
+                plan = '; '.join([row[0] for row in rows])
+                if 'Seq Scan' in plan:
+                    failed.append((desc, plan))
+            trans.rollback()
+    return failed
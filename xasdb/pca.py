@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+   principal component analysis of normalized XANES
+
+   Spectra are stacked as rows of a matrix on the XANES grid (see
+   similarity.py), over an energy window relative to the edge.  The
+   mean spectrum is subtracted, and the SVD gives the components
+   (eigenspectra), eigenvalues and the scores of each spectrum.
+
+   The number of significant components is estimated with Malinowski's
+   indicator function, IND, which is smallest at that number.  A target
+   spectrum is tested against the first ncomps components (target
+   transformation): a small R-factor means it can be made from the
+   same species as the analyzed spectra.
+"""
+from collections import namedtuple
+import numpy as np
+
+PCAResult = namedtuple('PCAResult', ('spectrum_ids', 'element', 'edge',
+                                     'energy', 'mean', 'components',
+                                     'eigenvalues', 'variance', 'scores',
+                                     'ind', 'ncomps'))
+
+TargetResult = namedtuple('TargetResult', ('ncomps', 'weights', 'fit',
+                                           'rfactor', 'chi_square'))
+
+# number of analyses kept by XASDataLibrary.pca()
+PCA_CACHE_SIZE = 16
+
+def indicator(eigenvalues, npoints):
+    "Malinowski's indicator function for 1 to len(eigenvalues)-1 components"
+    nspec = len(eigenvalues)
+    ind = np.zeros(max(nspec-1, 0))
+    for ncomp in range(1, nspec):
+        resid = eigenvalues[ncomp:].sum()/(npoints*(nspec - ncomp))
+        ind[ncomp-1] = np.sqrt(resid)/(nspec - ncomp)**2
+    return ind
+
+def pca_decompose(spectrum_ids, element, edge, energy, matrix):
+    """PCA of matrix (one spectrum per row, on energy) for spectrum_ids
+    of an element (z) and edge (id), returning a PCAResult"""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    mean = matrix.mean(axis=0)
+    u, s, vt = np.linalg.svd(matrix - mean, full_matrices=False)
+    eigenvalues = s**2
+    total = eigenvalues.sum()
+    variance = eigenvalues/total if total > 0 else eigenvalues
+    ind = indicator(eigenvalues, matrix.shape[1])
+    ncomps = 1 + int(np.argmin(ind)) if len(ind) > 0 else 1
+    return PCAResult(list(spectrum_ids), element, edge, energy, mean,
+                     vt, eigenvalues, variance, u*s, ind, ncomps)
+
+def target_transform(result, target, ncomps=None):
+    """fit target (on result.energy) with the mean and the first ncomps
+    components of a PCAResult (default: result.ncomps)"""
+    if ncomps is None:
+        ncomps = result.ncomps
+    components = result.components[:ncomps]
+    target = np.asarray(target, dtype=np.float64)
+    weights = components.dot(target - result.mean)
+    fit = result.mean + weights.dot(components)
+    chisq = ((target - fit)**2).sum()
+    return TargetResult(ncomps, weights, fit, chisq/(target**2).sum(),
+                        chisq)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+   similarity of normalized XANES spectra
+
+   Spectra are compared as vectors of normalized mu(E) interpolated
+   onto XANES_GRID, a grid of energies relative to the tabulated edge
+   energy for the element and edge, so that chemical shifts between
+   spectra are kept.  Vectors are stored as float32 in the
+   spectrum_xanes table, and compared over a window of XANES_GRID with
+   one of SIMILARITY_METRICS:
+
+     'l2'       root-mean-square difference (smaller is more similar)
+     'cosine'   cosine of the angle between vectors (larger is more similar)
+     'pearson'  correlation coefficient (larger is more similar)
+"""
+import numpy as np
+
+from .xafs_preedge import edge_energies, symbols
+
+# energies relative to the edge, in eV: changing the grid changes
+# XANES_GRID_NAME, so that stored vectors are recomputed
+XANES_GRID = np.linspace(-30, 120, 301)
+XANES_GRID_NAME = '-30:120:301'
+
+SIMILARITY_METRICS = ('l2', 'cosine', 'pearson')
+
+def reference_energy(element, edge, e0=None):
+    """tabulated edge energy for an element (z or symbol) and edge name,
+    or e0 if there is no tabulated value"""
+    if not isinstance(element, int):
+        element = symbols.index(str(element).title())
+    return edge_energies[element].get(str(edge), e0)
+
+def xanes_vector(energy, norm, eref):
+    """normalized mu(E) interpolated onto eref+XANES_GRID, as float32,
+    or None if energy does not overlap the grid"""
+    energy = np.asarray(energy, dtype=np.float64)
+    norm = np.asarray(norm, dtype=np.float64)
+    good = np.isfinite(energy) & np.isfinite(norm)
+    energy, norm = energy[good], norm[good]
+    order = np.argsort(energy)
+    energy, norm = energy[order], norm[order]
+    grid = eref + XANES_GRID
+    if len(energy) < 2 or energy[-1] < grid[0] or energy[0] > grid[-1]:
+        return None
+    return np.interp(grid, energy, norm).astype(np.float32)
+
+def encode_vector(vector):
+    "float32 vector as bytes for the spectrum_xanes table"
+    if vector is None:
+        return None
+    return np.asarray(vector, dtype='<f4').tobytes()
+
+def decode_vector(blob):
+    "float32 vector from bytes in the spectrum_xanes table"
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype='<f4')
+
+def grid_window(window=None):
+    "boolean mask of XANES_GRID for (emin, emax), relative to the edge"
+    if window is None:
+        return np.ones(len(XANES_GRID), dtype=bool)
+    emin, emax = window
+    mask = (XANES_GRID >= emin) & (XANES_GRID <= emax)
+    if not np.any(mask):
+        raise ValueError('window %s does not overlap %g to %g eV' %
+                         (repr(window), XANES_GRID[0], XANES_GRID[-1]))
+    return mask
+
+def similarity(matrix, vector, metric='cosine', window=(-20, 80)):
+    """similarity of vector to each row of matrix, over window (emin,
+    emax) relative to the edge, using metric: see SIMILARITY_METRICS.
+    returns array of scores, with NaN for rows that cannot be compared"""
+    if metric not in SIMILARITY_METRICS:
+        raise ValueError("unknown metric '%s'" % metric)
+    mask = grid_window(window)
+    matrix = np.atleast_2d(matrix)[:, mask].astype(np.float64)
+    vector = np.asarray(vector, dtype=np.float64)[mask]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if metric == 'l2':
+            return np.sqrt(((matrix - vector)**2).mean(axis=1))
+        if metric == 'pearson':
+            matrix = matrix - matrix.mean(axis=1)[:, None]
+            vector = vector - vector.mean()
+        norms = np.sqrt((matrix**2).sum(axis=1)*(vector**2).sum())
+        return matrix.dot(vector)/norms
+
+def rank_similar(matrix, vector, k=10, metric='cosine', window=(-20, 80)):
+    """indices and scores of the k rows of matrix most similar to vector,
+    most similar first: see similarity()"""
+    scores = similarity(matrix, vector, metric=metric, window=window)
+    if metric == 'l2':
+        order = np.where(np.isnan(scores), np.inf, scores)
+    else:
+        order = -np.where(np.isnan(scores), -np.inf, scores)
+    k = min(k, len(scores))
+    if k < 1:
+        return np.array([], dtype=int), np.array([])
+    index = np.argpartition(order, k-1)[:k]
+    index = index[np.argsort(order[index], kind='stable')]
+    return index, scores[index]
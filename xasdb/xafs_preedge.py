@@ -4,16 +4,21 @@
   taken from larch (plugins/xafs/pre_edge.py)
 """
 
+from math import factorial
 import numpy as np
-from scipy import polyfit
+from numpy import polyfit
+
+# version of the pre-edge and normalization algorithm: change this when
+# preedge() changes results, so that stored results are recomputed.
+PREEDGE_VERSION = '1.2'
 
 def index_of(arrval, value):
     """return index of array *at or below* value
     returns 0 if value < min(array)
     """
-    if value < min(arrval):
+    if value < np.min(arrval):
         return 0
-    return max(np.where(arrval<=value)[0])
+    return np.where(arrval<=value)[0][-1]
 
 def index_nearest(array, value, _larch=None):
     """return index of array *nearest* to value
@@ -56,19 +61,22 @@ def remove_dups(arr, tiny=1.e-8, frac=0.02):
     if isinstance(arr, np.ndarray):
         shape = arr.shape
         arr   = arr.flatten()
-        npts  = len(arr)
-        try:
-            dups = np.where(abs(arr[:-1] - arr[1:]) < tiny)[0].tolist()
-        except ValueError:
-            dups = []
-        for i in dups:
-            t = [tiny]
-            if i > 0:
-                t.append(frac*abs(arr[i]-arr[i-1]))
-            if i < len(arr)-1:
-                t.append(frac*abs(arr[i+1]-arr[i]))
-            dx = max(t)
-            arr[i] = arr[i] - dx
+        dups = np.where(abs(arr[:-1] - arr[1:]) < tiny)[0]
+        if len(dups) > 0:
+            orig, onext = arr[dups], arr[dups+1]
+            dprev = np.where(dups > 0,
+                             frac*abs(orig - arr[np.maximum(dups-1, 0)]),
+                             tiny)
+            dnext = frac*abs(onext - orig)
+            dx = np.maximum(tiny, np.maximum(dprev, dnext))
+            arr[dups] = orig - dx
+            # in a run of repeated values, each value is reduced using
+            # the already reduced value before it, so these are done in turn
+            for j in np.where(np.diff(dups) == 1)[0] + 1:
+                i = dups[j]
+                dx = max(tiny, frac*abs(orig[j]-arr[i-1]),
+                         frac*abs(onext[j]-orig[j]))
+                arr[i] = orig[j] - dx
         arr.shape = shape
     return arr
 
@@ -105,29 +113,33 @@ def remove_nans2(a, b):
             b = np.array(b)
         except:
             print( 'remove_nans2: argument 2 is not an array')
-    if (np.any(np.isinf(a)) or np.any(np.isinf(b)) or
-        np.any(np.isnan(a)) or np.any(np.isnan(b))):
-        a1 = a[:]
-        b1 = b[:]
-        if np.any(np.isinf(a)):
-            bad = np.where(a==np.inf)[0]
-            a1 = np.delete(a1, bad)
-            b1 = np.delete(b1, bad)
-        if np.any(np.isinf(b)):
-            bad = np.where(b==np.inf)[0]
-            a1 = np.delete(a1, bad)
-            b1 = np.delete(b1, bad)
-        if np.any(np.isnan(a)):
-            bad = np.where(a==np.nan)[0]
-            a1 = np.delete(a1, bad)
-            b1 = np.delete(b1, bad)
-        if np.any(np.isnan(b)):
-            bad = np.where(b==np.nan)[0]
-            a1 = np.delete(a1, bad)
-            b1 = np.delete(b1, bad)
-        return a1, b1
+    good = np.isfinite(a) & np.isfinite(b)
+    if not np.all(good):
+        return a[good], b[good]
     return a, b
 
+def find_e0(energy, mu):
+    """find E0 for mu(energy): the energy of the largest positive
+    derivative among points of high derivative (more than 5% of the
+    largest) whose neighbors also have high derivative.
+
+    NaN derivatives are skipped, as they were by the loop in version
+    1.0.  returns energy[0] if no such point is found.
+    """
+    dmu = np.gradient(mu)/np.gradient(energy)
+    finite = ~np.isnan(dmu)
+    if not np.any(finite):
+        return energy[0]
+    high = dmu > np.max(dmu[finite])*0.05
+    candidates = np.zeros(len(dmu), dtype=bool)
+    candidates[1:-1] = (high[1:-1] & high[:-2] & high[2:] &
+                        (dmu[1:-1] > 0))
+    idmu_max = 0
+    if np.any(candidates):
+        idx = np.where(candidates)[0]
+        idmu_max = idx[np.argmax(dmu[idx])]
+    return energy[idmu_max]
+
 def preedge(energy, mu, e0=None, step=None,
             nnorm=3, nvict=0, pre1=None, pre2=-50,
             norm1=100, norm2=None):
@@ -175,26 +187,17 @@ def preedge(energy, mu, e0=None, step=None,
 
     if e0 is None or e0 < energy[0] or e0 > energy[-1]:
         energy = remove_dups(energy)
-        dmu = np.gradient(mu)/np.gradient(energy)
-        # find points of high derivative
-        high_deriv_pts = np.where(dmu >  max(dmu)*0.05)[0]
-        idmu_max, dmu_max = 0, 0
-        for i in high_deriv_pts:
-            if (dmu[i] > dmu_max and
-                (i+1 in high_deriv_pts) and
-                (i-1 in high_deriv_pts)):
-                idmu_max, dmu_max = i, dmu[i]
-
-        e0 = energy[idmu_max]
+        e0 = find_e0(energy, mu)
     nnorm = max(min(nnorm, 5), 1)
     ie0 = index_nearest(energy, e0)
     e0 = energy[ie0]
 
-    if pre1 is None:  pre1  = min(energy) - e0
-    if norm2 is None: norm2 = max(energy) - e0
-    if norm2 < 0:     norm2 = max(energy) - e0 - norm2
-    pre1  = max(pre1,  (min(energy) - e0))
-    norm2 = min(norm2, (max(energy) - e0))
+    emin, emax = np.min(energy), np.max(energy)
+    if pre1 is None:  pre1  = emin - e0
+    if norm2 is None: norm2 = emax - e0
+    if norm2 < 0:     norm2 = emax - e0 - norm2
+    pre1  = max(pre1,  (emin - e0))
+    norm2 = min(norm2, (emax - e0))
 
 
     if pre1 > pre2:
@@ -238,6 +241,215 @@ def preedge(energy, mu, e0=None, step=None,
             'nnorm': nnorm, 'norm1': norm1, 'norm2': norm2,
             'pre1': pre1, 'pre2': pre2, 'precoefs': precoefs}
 
+def preedge_batch(energies, mus, e0=None, step=None, nnorm=3, nvict=0,
+                  pre1=None, pre2=-50, norm1=100, norm2=None,
+                  chunk_size=256, chunk_points=100000):
+    """preedge() for many spectra with the same parameters, returning
+    a list of dictionaries with the same keys as from preedge().
+
+    Spectra are sorted by length and put, up to chunk_size spectra and
+    chunk_points points at a time, into 2-D arrays padded with NaNs.
+    E0, the fit ranges, the fits of the pre-edge lines and post-edge
+    polynomials (with polyfit_batch) and the normalized spectra are
+    then found for all spectra in a chunk with array operations.
+
+    E0 and the fit ranges are the same as from preedge().  Relative to
+    their largest values, edge_step, norm, pre_edge and post_edge agree
+    with preedge() to 1.e-9 for nnorm up to 4, but only to 1.e-6 for
+    nnorm=5: preedge() fits powers of the energy itself with polyfit,
+    which loses about that much to rounding at that degree.  Unlike
+    preedge(), NaNs and INFs are also left out of the post-edge fit.
+
+    Arguments
+    ---------
+    energies:   list of arrays of x-ray energies, in eV
+    mus:        list of arrays of mu(E)
+    chunk_size:   largest number of spectra done at once
+    chunk_points: largest size of the 2-D arrays for spectra done at once
+    other arguments are as for preedge(), for all spectra
+
+    Returns
+    -------
+      list with a dictionary for each spectrum, as from preedge(), or
+      None for spectra with fewer than 3 points or with energy and mu
+      of different lengths.
+    """
+    out = [None]*len(energies)
+    lengths = {}
+    for i, (energy, mu) in enumerate(zip(energies, mus)):
+        if len(energy) == len(mu) and len(energy) > 2:
+            lengths[i] = len(energy)
+    order = sorted(lengths, key=lambda i: lengths[i])
+    while len(order) > 0:
+        # rows in a chunk, keeping the 2-D arrays small
+        nrows = 1
+        while (nrows < min(chunk_size, len(order)) and
+               (nrows+1)*lengths[order[nrows]] <= chunk_points):
+            nrows += 1
+        index, order = order[:nrows], order[nrows:]
+        npts = [lengths[i] for i in index]
+        energy = np.nan*np.ones((len(index), max(npts)))
+        mu = np.nan*np.ones((len(index), max(npts)))
+        for row, i in enumerate(index):
+            energy[row, :npts[row]] = energies[i]
+            mu[row, :npts[row]] = mus[i]
+        with np.errstate(invalid='ignore'):
+            dups = np.any(abs(np.diff(energy, axis=1)) < 1.e-8, axis=1)
+        for row in np.where(dups)[0]:
+            energy[row, :npts[row]] = remove_dups(energy[row, :npts[row]])
+        group = _preedge_2d(energy, mu, np.array(npts), e0=e0, step=step,
+                            nnorm=nnorm, nvict=nvict, pre1=pre1, pre2=pre2,
+                            norm1=norm1, norm2=norm2)
+        for row, i in enumerate(index):
+            n = npts[row]
+            out[i] = {'e0': group['e0'][row],
+                      'edge_step': group['edge_step'][row],
+                      'norm': group['norm'][row, :n],
+                      'pre_edge': group['pre_edge'][row, :n],
+                      'post_edge': group['post_edge'][row, :n],
+                      'norm_coefs': list(group['coefs'][row, ::-1]),
+                      'nvict': nvict, 'nnorm': group['nnorm'],
+                      'norm1': group['norm1'][row],
+                      'norm2': group['norm2'][row],
+                      'pre1': group['pre1'][row], 'pre2': group['pre2'][row],
+                      'precoefs': group['precoefs'][row]}
+    return out
+
+def _rows_index_of(energy, values):
+    "index_of() for each row of a 2-D energy array"
+    below = energy <= values[:, None]
+    last = energy.shape[1] - 1 - np.argmax(below[:, ::-1], axis=1)
+    return np.where(values < np.nanmin(energy, axis=1), 0, last)
+
+def _rows_index_nearest(energy, values):
+    "index_nearest() for each row of a 2-D energy array"
+    diff = np.abs(energy - values[:, None])
+    return np.argmin(np.where(np.isnan(diff), np.inf, diff), axis=1)
+
+def _rows_gradient(arr, npts):
+    "numpy.gradient() for each row of a 2-D array, rows of length npts"
+    rows = np.arange(len(npts))
+    out = np.nan*np.ones(arr.shape)
+    out[:, 1:-1] = (arr[:, 2:] - arr[:, :-2])/2.
+    out[:, 0] = arr[:, 1] - arr[:, 0]
+    out[rows, npts-1] = arr[rows, npts-1] - arr[rows, npts-2]
+    return out
+
+def _preedge_2d(energy, mu, npts, e0=None, step=None, nnorm=3, nvict=0,
+                pre1=None, pre2=-50, norm1=100, norm2=None):
+    """preedge() for rows of 2-D arrays of energy and mu, padded with
+    NaNs after npts points, returning a dictionary of arrays"""
+    nrows = len(npts)
+    rows = np.arange(nrows)
+    valid = np.arange(energy.shape[1])[None, :] < npts[:, None]
+    emin, emax = np.nanmin(energy, axis=1), np.nanmax(energy, axis=1)
+
+    # e0, as in find_e0()
+    if e0 is None:
+        e0 = np.nan*np.ones(nrows)
+    else:
+        e0 = e0*np.ones(nrows)
+    find = np.isnan(e0) | (e0 < energy[:, 0]) | (e0 > energy[rows, npts-1])
+    if np.any(find):
+        with np.errstate(invalid='ignore'):
+            dmu = _rows_gradient(mu, npts)/_rows_gradient(energy, npts)
+            high = dmu > np.nanmax(dmu, axis=1)[:, None]*0.05
+            candidates = np.zeros(dmu.shape, dtype=bool)
+            candidates[:, 1:-1] = (high[:, 1:-1] & high[:, :-2] &
+                                   high[:, 2:] & (dmu[:, 1:-1] > 0))
+        idmu_max = np.argmax(np.where(candidates, dmu, -np.inf), axis=1)
+        idmu_max[~np.any(candidates, axis=1)] = 0
+        e0 = np.where(find, energy[rows, idmu_max], e0)
+    nnorm = max(min(nnorm, 5), 1)
+    ie0 = _rows_index_nearest(energy, e0)
+    e0 = energy[rows, ie0]
+
+    # fit ranges
+    pre1 = emin - e0 if pre1 is None else pre1*np.ones(nrows)
+    pre2 = pre2*np.ones(nrows)
+    norm1 = norm1*np.ones(nrows)
+    norm2 = emax - e0 if norm2 is None else norm2*np.ones(nrows)
+    norm2 = np.where(norm2 < 0, emax - e0 - norm2, norm2)
+    pre1 = np.maximum(pre1, emin - e0)
+    norm2 = np.minimum(norm2, emax - e0)
+    pre1, pre2 = np.minimum(pre1, pre2), np.maximum(pre1, pre2)
+    norm1, norm2 = np.minimum(norm1, norm2), np.maximum(norm1, norm2)
+
+    col = np.arange(energy.shape[1])[None, :]
+    omu = mu*energy**nvict
+    fits = []
+    for lo, hi, deg in ((pre1, pre2, 1), (norm1, norm2, nnorm)):
+        p1 = _rows_index_of(energy, lo+e0)
+        p2 = _rows_index_nearest(energy, hi+e0)
+        p2 = np.where(p2-p1 < 2, np.minimum(npts, p1+2), p2)
+        inrange = valid & (col >= p1[:, None]) & (col < p2[:, None])
+        cols = slice(np.min(p1), np.max(p2))
+        fits.append(polyfit_batch(energy[:, cols], omu[:, cols], deg,
+                                  weight=inrange[:, cols]))
+    precoefs, coefs = fits
+
+    pre_edge = ((precoefs[:, 0:1]*energy + precoefs[:, 1:2]) *
+                energy**(-nvict))
+    post_edge = 0
+    for n in range(nnorm+1):
+        post_edge += coefs[:, nnorm-n:nnorm-n+1] * energy**(n-nvict)
+    edge_step = post_edge[rows, ie0] - pre_edge[rows, ie0]
+    if step is not None:
+        edge_step = step*np.ones(nrows)
+    norm = (mu - pre_edge)/edge_step[:, None]
+    return {'e0': e0, 'edge_step': edge_step, 'norm': norm,
+            'pre_edge': pre_edge, 'post_edge': post_edge,
+            'precoefs': precoefs, 'coefs': coefs, 'nnorm': nnorm,
+            'pre1': pre1, 'pre2': pre2, 'norm1': norm1, 'norm2': norm2}
+
+def polyfit_batch(x, y, deg, weight=None):
+    """least-squares polynomial fits of degree deg to each row of 2-D
+    arrays x and y, using only points with non-zero weight (default:
+    all points) and finite values.  returns an array of shape
+    (len(x), deg+1) with coefficients highest power first, as from
+    numpy.polyfit.
+
+    x is shifted and scaled onto [-1, 1] for each row, so that the
+    normal equations for all rows can be made from sums of powers and
+    solved together.
+    """
+    x, y = np.atleast_2d(x), np.atleast_2d(y)
+    npar = deg+1
+    if weight is None:
+        weight = np.ones(x.shape)
+    weight = np.where(np.isfinite(x) & np.isfinite(y) & (weight != 0),
+                      1.0, 0.0)
+    use = weight > 0
+    xmin = np.where(use, x, np.inf).min(axis=1)
+    xmax = np.where(use, x, -np.inf).max(axis=1)
+    empty = ~np.any(use, axis=1)
+    xmin[empty], xmax[empty] = 0.0, 0.0
+    center = (xmax + xmin)/2.0
+    scale = np.where(xmax > xmin, (xmax - xmin)/2.0, 1.0)
+    t = np.where(use, (x - center[:, None])/scale[:, None], 0.0)
+    y = np.where(use, y, 0.0)
+
+    # normal equations from sums of powers of t
+    tsums = np.zeros((len(x), 2*deg+1))
+    rhs = np.zeros((len(x), npar))
+    tpow = weight
+    for m in range(2*deg+1):
+        tsums[:, m] = tpow.sum(axis=1)
+        if m < npar:
+            rhs[:, m] = (tpow*y).sum(axis=1)
+        tpow = tpow*t
+    gram = tsums[:, np.add.outer(np.arange(npar), np.arange(npar))]
+    tcoefs = np.einsum('fij,fj->fi', np.linalg.pinv(gram), rhs)
+
+    # coefficients for powers of x = center + scale*t, lowest first
+    coefs = np.zeros((len(x), npar))
+    for k in range(npar):
+        ck = tcoefs[:, k]/scale**k
+        for j in range(k+1):
+            binom = factorial(k)//(factorial(j)*factorial(k-j))
+            coefs[:, j] += ck*binom*(-center)**(k-j)
+    return coefs[:, ::-1]
+
 symbols = ["", "H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne", "Na",
            "Mg", "Al", "Si", "P", "S", "Cl", "Ar", "K", "Ca", "Sc", "Ti",
            "V", "Cr", "Mn", "Fe", "Co", "Ni", "Cu", "Zn", "Ga", "Ge", "As",
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+   approximate nearest-neighbour index of normalized XANES vectors
+
+   XANESIndex hashes the vectors of one element and edge (see
+   similarity.py) with random hyperplanes: each of ntables hash tables
+   uses nbits hyperplanes, and a vector's code in a table has one bit
+   for the side of each hyperplane it falls on.  Vectors are measured
+   from the mean vector of the group, so that the codes follow the
+   shape of the spectra rather than the edge step they all share.
+
+   A query collects the spectra whose code in any table is within
+   `probes` bits of the query's code, and these candidates are then
+   ranked exactly.  Recall is tuned with:
+
+     ntables  more tables give more candidates and higher recall
+     nbits    more bits give smaller buckets, fewer candidates and
+              faster but less complete queries
+     probes   0, 1 or 2: also look in buckets that differ in up to
+              this many bits, raising recall without rebuilding
+
+   Spectra can be added and removed without rebuilding.  The mean
+   vector is kept from the first build, which is fine as long as the
+   group is not mostly replaced: build() it again if it is.  An index
+   being searched by other threads should not be changed: change a
+   copy() and use that in its place.
+"""
+import os
+import threading
+from itertools import combinations
+import numpy as np
+
+from .similarity import XANES_GRID, XANES_GRID_NAME, rank_similar
+
+# groups with fewer spectra are searched exactly by default: exact
+# search of 5000 spectra takes about 10 msec
+INDEX_MIN_SPECTRA = 5000
+
+class XANESIndex(object):
+    """random-projection index of XANES vectors for one element and edge
+
+    ntables  number of hash tables
+    nbits    bits (hyperplanes) per table, at most 62
+    seed     seed for the random hyperplanes
+    """
+    def __init__(self, ntables=8, nbits=16, seed=0, ndim=None):
+        if ndim is None:
+            ndim = len(XANES_GRID)
+        self.ntables, self.nbits, self.seed = ntables, nbits, seed
+        self.grid = XANES_GRID_NAME
+        rng = np.random.RandomState(seed)
+        self.planes = rng.standard_normal((ndim, ntables*nbits))
+        self.planes = self.planes.astype(np.float32)
+        self.center = np.zeros(ndim, dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.codes = np.zeros((0, ntables), dtype=np.int64)
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def copy(self):
+        """a copy that can be changed while this index is searched.  The
+        arrays are shared: build(), add() and remove() replace them
+        rather than changing them in place."""
+        index = XANESIndex.__new__(XANESIndex)
+        index.__dict__.update(self.__dict__)
+        return index
+
+    def hash(self, vectors):
+        "codes for vectors, as array of shape (len(vectors), ntables)"
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors.reshape((-1, len(self.center))) - self.center
+        bits = vectors.dot(self.planes) > 0
+        bits = bits.reshape((len(vectors), self.ntables, self.nbits))
+        return bits.dot(1 << np.arange(self.nbits, dtype=np.int64))
+
+    def build(self, ids, vectors):
+        "index vectors (one per row) for ids, replacing all contents"
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors.reshape((-1, len(self.center)))
+        if len(vectors) > 0:
+            self.center = vectors.mean(axis=0)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.codes = self.hash(vectors)
+        self._sorted = None
+
+    def add(self, ids, vectors):
+        "add vectors for ids, replacing any already indexed for those ids"
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return self.build(ids, vectors)
+        self.remove(ids)
+        self.ids = np.concatenate((self.ids, ids))
+        self.codes = np.concatenate((self.codes, self.hash(vectors)))
+        self._sorted = None
+
+    def remove(self, ids):
+        "remove ids from the index"
+        keep = ~np.isin(self.ids, ids)
+        if not np.all(keep):
+            self.ids, self.codes = self.ids[keep], self.codes[keep]
+            self._sorted = None
+
+    def _tables(self):
+        "(positions, codes) sorted by code for each table"
+        if self._sorted is None:
+            order = np.argsort(self.codes, axis=0, kind='stable')
+            self._sorted = (order, np.take_along_axis(self.codes, order,
+                                                      axis=0))
+        return self._sorted
+
+    def probe_masks(self, probes=1):
+        "bit masks for the codes within probes bits of a code"
+        masks = [0]
+        for nflip in range(1, probes+1):
+            for bits in combinations(range(self.nbits), nflip):
+                masks.append(sum([1 << bit for bit in bits]))
+        return np.array(masks, dtype=np.int64)
+
+    def candidates(self, vector, probes=1):
+        """ids of indexed vectors whose code in any table is within
+        probes bits of the code for vector"""
+        if len(self.ids) == 0:
+            return self.ids
+        order, codes = self._tables()
+        query = self.hash(vector)[0]
+        masks = self.probe_masks(probes)
+        found = []
+        for table in range(self.ntables):
+            keys = query[table] ^ masks
+            lo = np.searchsorted(codes[:, table], keys, side='left')
+            hi = np.searchsorted(codes[:, table], keys, side='right')
+            for i in np.nonzero(hi > lo)[0]:
+                found.append(order[lo[i]:hi[i], table])
+        if len(found) == 0:
+            return self.ids[:0]
+        return self.ids[np.unique(np.concatenate(found))]
+
+    def search(self, vector, ids, matrix, k=10, metric='cosine',
+               window=(-20, 80), probes=1):
+        """the k candidates most similar to vector, ranked exactly as
+        with similarity.rank_similar(), where matrix holds the vectors
+        for ids, sorted.  All of matrix is ranked if there are fewer
+        than k candidates.
+
+        returns (ids, scores), most similar first
+        """
+        found = self.candidates(vector, probes=probes)
+        rows = np.searchsorted(ids, found)
+        inside = rows < len(ids)
+        rows = rows[inside][ids[rows[inside]] == found[inside]]
+        if len(rows) < k:
+            rows = np.arange(len(ids))
+        index, scores = rank_similar(matrix[rows], vector, k=k,
+                                     metric=metric, window=window)
+        return ids[rows[index]], scores
+
+    def save(self, path):
+        "save to an .npz file, replacing it in one step"
+        tmp = '%s.%i_%i.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, ntables=self.ntables, nbits=self.nbits,
+                     seed=self.seed, grid=self.grid, planes=self.planes,
+                     center=self.center, ids=self.ids, codes=self.codes)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        "read an index written with save()"
+        with np.load(path) as saved:
+            index = cls(ntables=int(saved['ntables']),
+                        nbits=int(saved['nbits']), seed=int(saved['seed']),
+                        ndim=len(saved['center']))
+            index.grid = str(saved['grid'])
+            index.planes = saved['planes']
+            index.center = saved['center']
+            index.ids = saved['ids']
+            index.codes = saved['codes']
+        return index
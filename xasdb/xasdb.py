@@ -9,12 +9,18 @@ Main Class:  XASDataLibrary
 
 import os
 import sys
+import glob
 import time
 import random
+import socket
 import json
+import struct
 import logging
+import threading
 import numpy as np
 from datetime import datetime
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from base64 import b64encode
 try:
@@ -22,16 +28,46 @@ try:
 except ImportError:
     from .pbkdf2_local import pbkdf2_hmac
 
-from sqlalchemy import MetaData, create_engine, text
-from sqlalchemy.orm import sessionmaker,  mapper, relationship, backref
+from sqlalchemy import (MetaData, create_engine, text, select, and_, or_,
+                        tuple_, func, bindparam, cast, Float)
+from sqlalchemy.orm import (sessionmaker, scoped_session, mapper,
+                            relationship, backref)
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import  NoResultFound
 
 from xdifile import XDIFile
 
+from .migrations import migrate, check_query_plans
+from .xafs_preedge import preedge, preedge_batch, PREEDGE_VERSION
+from .similarity import (XANES_GRID, XANES_GRID_NAME, reference_energy,
+                         xanes_vector, encode_vector, decode_vector,
+                         rank_similar, grid_window)
+from .xanes_index import XANESIndex, INDEX_MIN_SPECTRA
+from .lcf import lcf_fit, LCFResult
+from .pca import pca_decompose, target_transform, PCA_CACHE_SIZE
+
 PW_ALGORITHM = 'sha512'
 PW_NROUNDS   = 120000
 
+# array columns of the spectrum table
+SPECTRUM_ARRAYS = ('energy', 'i0', 'itrans', 'ifluor', 'irefer',
+                   'energy_stderr', 'i0_stderr', 'itrans_stderr',
+                   'ifluor_stderr', 'irefer_stderr')
+
+# small, rarely changing tables that are cached in-process
+CACHED_TABLES = ('element', 'edge', 'energy_units', 'beamline',
+                 'facility', 'mode')
+
+# bulk data columns, kept in the spectrum_data table
+SPECTRUM_DATA = SPECTRUM_ARRAYS + ('filetext',)
+
+# array encodings:  'json' text or 'binary' blobs, which are
+#   ARRAY_MAGIC, version, dtype code, ndim, shape (uint32 each),
+# followed by the little-endian array data
+ARRAY_FORMATS = ('json', 'binary')
+ARRAY_MAGIC   = b'XDLA'
+ARRAY_DTYPES  = {b'd': '<f8', b'f': '<f4'}
+
 def isXASDataLibrary(dbname):
     """test if a file is a valid XAS Data Library file:
        must be a sqlite db file, with tables named
@@ -68,11 +104,54 @@ def json_encode(val):
         val = val.flatten().tolist()
     return  json.dumps(val)
 
+def encode_array(val, array_format='json', dtype=b'd'):
+    """encode an array for storage in the database, either as
+    json text or as a binary blob (little-endian float64 by default)
+    """
+    if val is None or isinstance(val, (str, bytes)):
+        return val
+    if array_format != 'binary':
+        return json_encode(val)
+    arr = np.ascontiguousarray(val, dtype=ARRAY_DTYPES[dtype])
+    header = struct.pack('<4sBcB', ARRAY_MAGIC, 1, dtype, arr.ndim)
+    header += struct.pack('<%iI' % arr.ndim, *arr.shape)
+    return header + arr.tobytes()
+
+def decode_array(val):
+    """decode an array stored with encode_array(), for either json text
+    or binary blobs.  Returns None for empty values.
+
+    Note that binary blobs are decoded without copying, so that the
+    returned array is read-only.
+    """
+    if val is None:
+        return None
+    if isinstance(val, memoryview):
+        val = val.tobytes()
+    if isinstance(val, bytes):
+        if val[:4] == ARRAY_MAGIC:
+            version, dtype, ndim = struct.unpack('<BcB', val[4:7])
+            offset = 7 + 4*ndim
+            shape = struct.unpack('<%iI' % ndim, val[7:offset])
+            return np.frombuffer(val, dtype=ARRAY_DTYPES[dtype],
+                                 offset=offset).reshape(shape)
+        val = val.decode('utf-8')
+    if len(val) < 1:
+        return None
+    return np.array(json.loads(val))
+
 def valid_score(score, smin=0, smax=5):
     """ensure that the input score is an integr
     in the range [smin, smax]  (inclusive)"""
     return max(smin, min(smax, int(score)))
 
+def rating_summary(rating_sum, rating_count):
+    "summary of ratings from their total score and number"
+    if not rating_count:
+        return 'No ratings'
+    return '%.1f (%i ratings)' % (rating_sum/float(rating_count),
+                                  rating_count)
+
 def unique_name(name, namelist, maxcount=100, msg='spectrum'):
     """
     find a name that is not in namelist by making
@@ -115,14 +194,21 @@ def None_or_one(val, msg='Expected 1 or None result'):
     else:
         raise XASDBException(msg)
 
-def apply_orderby(q, tab, orderby=None):
-    """apply an order_by to a query to sort results"""
-    if orderby is not None:
-        key = getattr(tab.c, orderby, None)
-        if key is None:
-            key = getattr(tab.c, "%s_id" % orderby, None)
-        if key is not None:
-            q = q.order_by(key)
+def orderby_column(tab, orderby=None):
+    """column of a table to sort by: orderby or orderby_id, or None"""
+    if orderby is None:
+        return None
+    key = getattr(tab.c, orderby, None)
+    if key is None:
+        key = getattr(tab.c, "%s_id" % orderby, None)
+    return key
+
+def apply_orderby(q, tab, orderby=None, reverse=False):
+    """apply an order_by to a query to sort results, descending
+    with reverse=True"""
+    key = orderby_column(tab, orderby)
+    if key is not None:
+        q = q.order_by(key.desc() if reverse else key)
     return q
 
 def slow_string_compare(a, b):
@@ -140,6 +226,330 @@ def slow_string_compare(a, b):
     return isgood == 0
 
 
+def spectrum_mu(energy, i0=None, itrans=None, ifluor=None, irefer=None,
+                mode='transmission', energy_units='eV'):
+    """mu(E) for a spectrum's arrays and collection mode, returns
+    (energy, mu, mu_refer) with energy in eV.  mu or mu_refer are None
+    if the needed arrays are missing, and energy is None for units that
+    cannot be converted to eV.
+    """
+    energy = np.asarray(energy, dtype=np.float64)
+    if energy_units.startswith('keV'):
+        energy = energy*1000.0
+    elif not energy_units.startswith('eV'):
+        return None, None, None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu = mu_refer = None
+        if mode == 'transmission':
+            if itrans is not None and i0 is not None:
+                mu = -np.log(itrans/i0)
+        elif ifluor is not None and i0 is not None:
+            mu = ifluor/i0
+        if irefer is not None and itrans is not None:
+            mu_refer = -np.log(irefer/itrans)
+    return energy, mu, mu_refer
+
+def normalize_mu(energy, mu, params=None, unitstep=False):
+    """pre-edge subtraction and normalization of mu(E) with preedge(),
+    returning a dictionary of values for a spectrum_derived row.
+    For spectra that are already normalized (unitstep=True), mu is kept
+    as the normalized spectrum."""
+    if params is None:
+        params = {}
+    return _derived_values(preedge(energy, mu, **params), mu, params,
+                           unitstep)
+
+def _derived_values(group, mu, params, unitstep=False):
+    "spectrum_derived values from the results of preedge()"
+    norm, edge_step = group['norm'], group['edge_step']
+    if unitstep:
+        norm, edge_step = np.asarray(mu), 1.0
+    return {'version': PREEDGE_VERSION, 'params': params,
+            'e0': float(group['e0']), 'edge_step': float(edge_step),
+            'pre_coefs': [float(c) for c in group['precoefs']],
+            'norm_coefs': [float(c) for c in group['norm_coefs']],
+            'norm': norm}
+
+def normalize_channels(energy, mu, mu_refer=None, mode='transmission',
+                       params=None):
+    """normalize_mu() for the sample and (if available) reference
+    channels of a spectrum, returning a dictionary with keys
+    'sample' and 'reference'.  Channels that cannot be normalized
+    are logged and left out."""
+    out = {}
+    if energy is None:
+        return out
+    for channel, cmu in (('sample', mu), ('reference', mu_refer)):
+        if cmu is None:
+            continue
+        unitstep = (channel == 'sample' and mode.endswith('unitstep'))
+        try:
+            out[channel] = normalize_mu(energy, cmu, params=params,
+                                        unitstep=unitstep)
+        except Exception as exc:
+            logging.getLogger('xasdb').warning(
+                'could not normalize %s channel: %s', channel, _errmsg(exc))
+    return out
+
+# relative difference below which normalized spectra are the same:
+# the agreement of preedge_batch() with preedge() at nnorm=5
+DERIVED_RTOL = 1.e-6
+
+def same_derived(a, b, rtol=DERIVED_RTOL):
+    """whether two results of normalize_channels() are the same, to
+    within rtol of the largest value of each array"""
+    if sorted(a.keys()) != sorted(b.keys()):
+        return False
+    for channel in a:
+        x, y = a[channel], b[channel]
+        if x['version'] != y['version'] or x['params'] != y['params']:
+            return False
+        for key in ('e0', 'edge_step', 'pre_coefs', 'norm_coefs', 'norm'):
+            xval = np.asarray(x[key], dtype=np.float64)
+            yval = np.asarray(y[key], dtype=np.float64)
+            if xval.shape != yval.shape:
+                return False
+            scale = np.nanmax(np.abs(yval)) if yval.size > 0 else 0
+            if not np.allclose(xval, yval, rtol=rtol, atol=rtol*scale,
+                               equal_nan=True):
+                return False
+    return True
+
+def normalize_batch(spectra, params=None):
+    """normalize_channels() for many spectra at once, using
+    preedge_batch().  spectra is a list of (energy, mu, mu_refer, mode)
+    as from XASDataLibrary.get_spectrum_mu(), and a list of dictionaries
+    as from normalize_channels() is returned."""
+    if params is None:
+        params = {}
+    out = [{} for spectrum in spectra]
+    channels, energies, mus = [], [], []
+    for i, (energy, mu, mu_refer, mode) in enumerate(spectra):
+        if energy is None:
+            continue
+        for channel, cmu in (('sample', mu), ('reference', mu_refer)):
+            if cmu is not None:
+                unitstep = (channel == 'sample' and mode.endswith('unitstep'))
+                channels.append((i, channel, unitstep))
+                energies.append(energy)
+                mus.append(cmu)
+    groups = preedge_batch(energies, mus, **params)
+    for (i, channel, unitstep), mu, group in zip(channels, mus, groups):
+        if group is None:
+            logging.getLogger('xasdb').warning(
+                'could not normalize %s channel of spectrum %i of batch',
+                channel, i)
+        else:
+            out[i][channel] = _derived_values(group, mu, params, unitstep)
+    return out
+
+# spectrum_derived channel of the row stored for a spectrum that could
+# not be normalized, so that it is not tried again with the same
+# params and PREEDGE_VERSION
+NOT_NORMALIZED = 'none'
+
+# seconds after which a claim on a background job (see claim_job()) that
+# has not been renewed is taken to be abandoned
+JOB_CLAIM_TIMEOUT = 600
+
+# spectrum columns summarizing the arrays, see creator.summary_columns()
+SUMMARY_COLUMNS = ('npts', 'emin', 'emax', 'estep', 'e0', 'edge_step',
+                   'has_reference')
+
+# E - e0 in eV = KTOE * k**2, k in 1/Angstrom
+KTOE = 3.8099819442818976
+
+def summarize_spectrum(energy, mu_refer=None, derived=None):
+    """values for the spectrum summary columns (SUMMARY_COLUMNS) from
+    energy in eV, the reference mu and the results of
+    normalize_channels(), with None for values that are not known"""
+    out = dict([(name, None) for name in SUMMARY_COLUMNS])
+    out['has_reference'] = 0 if mu_refer is None else 1
+    if energy is not None:
+        energy = np.sort(np.asarray(energy, dtype=np.float64))
+        energy = energy[np.isfinite(energy)]
+        out['npts'] = len(energy)
+        if len(energy) > 0:
+            out['emin'], out['emax'] = float(energy[0]), float(energy[-1])
+        if len(energy) > 1:
+            out['estep'] = float(np.median(np.diff(energy)))
+    if derived is not None and 'sample' in derived:
+        out['e0'] = derived['sample']['e0']
+        out['edge_step'] = derived['sample']['edge_step']
+    return out
+
+def range_filter(query, column, value):
+    """restrict query to rows with column within value, given as (min,
+    max) with None for no limit, or to rows with column equal to value"""
+    if value is None:
+        return query
+    if isinstance(value, (tuple, list)):
+        low, high = value
+        if low is not None:
+            query = query.where(column >= low)
+        if high is not None:
+            query = query.where(column <= high)
+        return query
+    return query.where(column == value)
+
+XDIResult = namedtuple('XDIResult', ('filename', 'spectrum_id', 'error'))
+
+def _errmsg(exc):
+    return '%s: %s' % (exc.__class__.__name__, exc)
+
+def read_xdifile(fname):
+    """read an XDI file into a dictionary of plain values and arrays
+    suitable for XASDataLibrary.add_xdirecords()"""
+    with open(fname, 'r') as fh:
+        filetext = fh.read()
+
+    xfile = XDIFile(fname)
+    path, fname = os.path.split(fname)
+    now = fmttime()
+
+    spectrum_name = fname
+    if spectrum_name.endswith('.xdi'):
+        spectrum_name = spectrum_name[:-4]
+
+    try:
+        c_date = xfile.attrs['scan']['start_time']
+    except:
+        c_date = 'collection date unknown'
+
+    edge, element = xfile.edge, xfile.element
+    if isinstance(edge, bytes):
+        edge = edge.decode('utf-8')
+    if isinstance(element, bytes):
+        element = element.decode('utf-8')
+
+    comments  = ''
+    if hasattr(xfile, 'comments'):
+        comments = xfile.comments
+
+    i0 = None
+    if hasattr(xfile, 'i0'):
+        i0 = xfile.i0
+
+    modes = []
+    ifluor = itrans = irefer = None
+    if hasattr(xfile, 'itrans'):
+        itrans = xfile.itrans
+        modes.append('transmission')
+    elif hasattr(xfile, 'i1'):
+        itrans = xfile.i1
+        modes.append('transmission')
+
+    if hasattr(xfile, 'ifluor'):
+        ifluor= xfile.ifluor
+        modes.append('fluorescence')
+    elif hasattr(xfile, 'ifl'):
+        ifluor= xfile.ifl
+        modes.append('fluorescence')
+
+    # special case: mutrans given,
+    # itrans not available,
+    # and maybe i0 not available
+    if (hasattr(xfile, 'mutrans') and
+        not hasattr(xfile, 'itrans')):
+        if not hasattr(xfile, 'i0'):
+            i0 = np.ones(len(xfile.mutrans))*1.0
+            itrans = np.exp(-xfile.mutrans)
+        modes.append('transmission')
+
+    if (hasattr(xfile, 'mufluor') and
+        not hasattr(xfile, 'ifluor')):
+        if not hasattr(xfile, 'i0'):
+            i0 = np.ones(len(xfile.mufluor))*1.0
+            ifluor = xfile.mufluor
+        modes.append('fluorescence')
+
+    if (hasattr(xfile, 'munorm')):
+        i0 = np.ones(len(xfile.munorm))*1.0
+        ifluor = xfile.munorm
+        modes.append('fluorescence, unitstep')
+
+    refer_used = 0
+    if hasattr(xfile, 'irefer'):
+        refer_used = 1
+        irefer= xfile.irefer
+    elif hasattr(xfile, 'i2'):
+        refer_used = 1
+        irefer= xfile.i2
+
+    en_units = 'eV'
+    for index, value in xfile.attrs.get('column', {}).items():
+        words = value.split()
+        if len(words) > 1:
+            if (value.lower().startswith('energy') or
+                value.lower().startswith('angle') ):
+                en_units = words[1]
+
+    sattrs = dict(xfile.attrs.get('sample', {}))
+    sname = sattrs.pop('name', 'unknown')
+    notes = "sample for '%s', uploaded %s" % (fname, now)
+    sample = {'name': sname,
+              'preparation': sattrs.pop('prep', ''),
+              'formula': sattrs.pop('formula', ''),
+              'reference': sattrs.get('reference', None),
+              'reference_notes': "reference for '%s', uploaded %s" % (fname, now)}
+    if len(sattrs) > 0:
+        notes  = '%s\n%s' % (notes, json_encode(sattrs))
+    sample['notes'] = notes
+
+    beamline = xfile.attrs.get('beamline', {}).get('name', None)
+
+    mode = 'transmission'
+    if len(modes) > 0:
+        mode = modes[0]
+    energy, mu, mu_refer = spectrum_mu(xfile.energy, i0=i0, itrans=itrans,
+                                       ifluor=ifluor, irefer=irefer,
+                                       mode=mode, energy_units=en_units)
+    derived = normalize_channels(energy, mu, mu_refer, mode=mode)
+    xanes = None
+    if 'sample' in derived:
+        eref = reference_energy(element, edge, derived['sample']['e0'])
+        xanes = xanes_vector(energy, derived['sample']['norm'], eref)
+
+    return {'name': spectrum_name, 'filetext': filetext,
+            'collection_date': c_date, 'd_spacing': xfile.dspacing,
+            'edge': edge, 'element': element, 'energy': xfile.energy,
+            'energy_units': en_units, 'i0': i0, 'itrans': itrans,
+            'ifluor': ifluor, 'irefer': irefer, 'reference_used': refer_used,
+            'comments': comments, 'modes': modes, 'sample': sample,
+            'beamline': beamline, 'notes': json_encode(xfile.attrs),
+            'derived': derived, 'xanes': xanes,
+            'summary': summarize_spectrum(energy, mu_refer, derived)}
+
+def read_xdirecord(fname):
+    """read_xdifile() for bulk ingest: returns (fname, record, error)
+    with error=None on success, and record=None on failure"""
+    try:
+        return fname, read_xdifile(fname), None
+    except Exception as exc:
+        return fname, None, _errmsg(exc)
+
+def read_xdirecords(paths, workers=None, window=200):
+    """generate (fname, record, error) tuples for a sequence of XDI
+    files, in order, parsing in a pool of worker processes.
+
+    At most window files are read ahead of the consumer.  With
+    workers=1 the files are parsed in the calling process.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for fname in paths:
+            yield read_xdirecord(fname)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for fname in paths:
+            pending.append(pool.submit(read_xdirecord, fname))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
 class XASDBException(Exception):
     """XAS DB Access Exception: General Errors"""
     def __init__(self, msg):
@@ -264,29 +674,125 @@ class Spectrum_Mode(_BaseTable):
     pass
 
 
+# classes can only be mapped once per process, and are mapped to the
+# tables of the first library connected.  Queries here select from
+# tables, not classes, so this does not limit using other libraries.
+_mapped_classes = []
+
+def map_tables(tables):
+    "map table classes to the tables of a library"
+    mapper(Info,             tables['info'])
+    mapper(Sample,           tables['sample'])
+    mapper(Spectrum_Rating,  tables['spectrum_rating'])
+    mapper(Spectrum_Ligand,  tables['spectrum_ligand'])
+    mapper(Spectrum_Mode,    tables['spectrum_mode'])
+    mapper(Suite_Rating,     tables['suite_rating'])
+    mapper(EnergyUnits,      tables['energy_units'])
+    mapper(Spectrum,         tables['spectrum'])
+
+    relate = relationship
+
+    mapper(Mode, tables['mode'],
+           properties={'spectrum': relate(Spectrum, backref='mode',
+                                    secondary=tables['spectrum_mode'])})
+
+    mapper(Edge, tables['edge'],
+           properties={'spectrum': relate(Spectrum, backref='edge')})
+
+    mapper(Element, tables['element'],
+           properties={'spectrum': relate(Spectrum, backref='element')})
+
+    mapper(Beamline, tables['beamline'],
+           properties={'spectrum': relate(Spectrum, backref='beamline')})
+
+    mapper(Citation, tables['citation'],
+           properties={'spectrum': relate(Spectrum, backref='citation')})
+
+    mapper(Ligand,   tables['ligand'],
+           properties={'spectrum': relate(Spectrum, backref='ligand',
+                                          secondary=tables['spectrum_ligand'])})
+
+    mapper(Crystal_Structure,   tables['crystal_structure'],
+           properties={'samples': relate(Sample, backref='structure')})
+
+    mapper(Facility, tables['facility'],
+           properties={'beamlines': relate(Beamline, backref='facility')})
+
+    mapper(Person,   tables['person'],
+           properties={'suites': relate(Suite, backref='person'),
+                       'samples': relate(Sample, backref='person'),
+                       'spectrum': relate(Spectrum, backref='person')})
+
+    mapper(Suite,   tables['suite'],
+    properties={'spectrum': relate(Spectrum, backref='suite',
+                                    secondary=tables['spectrum_suite'])})
+
+
+class TableCache(object):
+    """in-process cache of all rows of a small table,
+    indexed by each of its key columns (id, z, name, symbol, units)"""
+    keys = ('id', 'z', 'name', 'symbol', 'units')
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.index = {}
+        if len(rows) > 0:
+            for key in self.keys:
+                if key in rows[0].keys():
+                    self.index[key] = dict([(getattr(r, key), r) for r in rows])
+
+    def filter(self, **kws):
+        "return list of rows with equality filter on columns"
+        if len(kws) == 1:
+            key, val = list(kws.items())[0]
+            if key in self.index:
+                row = self.index[key].get(val, None)
+                return [] if row is None else [row]
+        return [r for r in self.rows
+                if all([getattr(r, k) == v for k, v in kws.items()])]
+
+
 class XASDataLibrary(object):
-    """full interface to XAS Spectral Library"""
+    """full interface to XAS Spectral Library
+
+    with scoped=True, each thread gets its own session (and so its own
+    connection from the engine pool), which should be ended with
+    end_session() when the thread's unit of work is done.
+    """
     def __init__(self, dbname=None, server= 'sqlite', user='',
-                 password='',  host='', port=5432, logfile=None):
+                 password='',  host='', port=5432, logfile=None,
+                 scoped=False, pool_size=5):
         self.engine = None
         self.session = None
         self.metadata = None
         self.logfile = logfile
+        self.cache_interval = 2.0
+        self._derived_lock = threading.Lock()
+        self._derived_thread = None
+        self._derived_claim = None
         if dbname is not None:
             self.connect(dbname, server=server, user=user,
-                         password=password, port=port, host=host)
+                         password=password, port=port, host=host,
+                         scoped=scoped, pool_size=pool_size)
 
     def connect(self, dbname, server='sqlite', user='',
-                password='', port=5432, host=''):
+                password='', port=5432, host='', scoped=False,
+                pool_size=5):
         "connect to an existing database"
 
         self.dbname = dbname
+        self.scoped = scoped
         if server.startswith('sqlit'):
-            self.engine = create_engine('sqlite:///%s' % self.dbname)
+            # connections may be handed between threads by the pool,
+            # but a connection is never used by two threads at once
+            self.engine = create_engine('sqlite:///%s' % self.dbname,
+                            connect_args={'check_same_thread': False})
         else:
             conn_str= 'postgresql://%s:%s@%s:%i/%s'
             self.engine = create_engine(conn_str % (user, password, host,
-                                                    port, dbname))
+                                                    port, dbname),
+                                        pool_size=pool_size,
+                                        pool_pre_ping=True)
 
         self.metadata =  MetaData(self.engine)
         try:
@@ -295,57 +801,35 @@ class XASDataLibrary(object):
             raise XASDBException('%s is not a valid database' % dbname)
 
         tables = self.tables = self.metadata.tables
-        self.session = sessionmaker(bind=self.engine)()
+        if 'spectrum_data' in tables:
+            self.data_table = tables['spectrum_data']
+            self.data_key = self.data_table.c.spectrum_id
+        else: # older library: arrays are in the spectrum table
+            self.data_table = tables['spectrum']
+            self.data_key = self.data_table.c.id
+        self.spectrum_cols = [c for c in tables['spectrum'].c
+                              if c.name not in SPECTRUM_DATA]
+        if scoped:
+            self.session = scoped_session(sessionmaker(bind=self.engine))
+        else:
+            self.session = sessionmaker(bind=self.engine)()
         self.query   = self.session.query
 
-
-        mapper(Info,             tables['info'])
-        mapper(Sample,           tables['sample'])
-        mapper(Spectrum_Rating,  tables['spectrum_rating'])
-        mapper(Spectrum_Ligand,  tables['spectrum_ligand'])
-        mapper(Spectrum_Mode,    tables['spectrum_mode'])
-        mapper(Suite_Rating,     tables['suite_rating'])
-        mapper(EnergyUnits,      tables['energy_units'])
-        mapper(Spectrum,         tables['spectrum'])
-
-        relate = relationship
-
-        mapper(Mode, tables['mode'],
-               properties={'spectrum': relate(Spectrum, backref='mode',
-                                        secondary=tables['spectrum_mode'])})
-
-        mapper(Edge, tables['edge'],
-               properties={'spectrum': relate(Spectrum, backref='edge')})
-
-        mapper(Element, tables['element'],
-               properties={'spectrum': relate(Spectrum, backref='element')})
-
-        mapper(Beamline, tables['beamline'],
-               properties={'spectrum': relate(Spectrum, backref='beamline')})
-
-        mapper(Citation, tables['citation'],
-               properties={'spectrum': relate(Spectrum, backref='citation')})
-
-        mapper(Ligand,   tables['ligand'],
-               properties={'spectrum': relate(Spectrum, backref='ligand',
-                                              secondary=tables['spectrum_ligand'])})
-
-        mapper(Crystal_Structure,   tables['crystal_structure'],
-               properties={'samples': relate(Sample, backref='structure')})
-
-        mapper(Facility, tables['facility'],
-               properties={'beamlines': relate(Beamline, backref='facility')})
-
-        mapper(Person,   tables['person'],
-               properties={'suites': relate(Suite, backref='person'),
-                           'samples': relate(Sample, backref='person'),
-                           'spectrum': relate(Spectrum, backref='person')})
-
-        mapper(Suite,   tables['suite'],
-        properties={'spectrum': relate(Spectrum, backref='suite',
-                                        secondary=tables['spectrum_suite'])})
+        if len(_mapped_classes) == 0:
+            map_tables(tables)
+            _mapped_classes.append(dbname)
 
         self.update_mod_time =  None
+        self.clear_cache()
+        # approximate XANES indexes, see get_xanes_index()
+        self.xanes_index_folder = None
+        if server.startswith('sqlit'):
+            self.xanes_index_folder = '%s.xanes' % self.dbname
+        self._xanes_indexes, self._xanes_synced = {}, {}
+        self._xanes_lock = threading.RLock()
+        self._pca_cache = OrderedDict()
+        self._pca_lock = threading.Lock()
+        self.array_format = self.get_info('array_format', default='json')
 
         if self.logfile is None and server.startswith('sqlit'):
             lfile = self.dbname
@@ -363,29 +847,103 @@ class XASDataLibrary(object):
         self.session.flush()
         self.session.close()
 
+    def end_session(self, error=None):
+        """end the unit of work for the current thread: roll back the
+        session if there was an error, and release its connection"""
+        if error is not None:
+            self.session.rollback()
+        if self.scoped:
+            self.session.remove()
+        else:
+            self.session.close()
+
+    def get_info(self, key, default=None):
+        """get value for key in the info table"""
+        table = self.tables['info']
+        row = table.select(table.c.key==key).execute().fetchone()
+        if row is None:
+            return default
+        return row.value
+
     def set_info(self, key, value):
         """set key / value in the info table"""
         table = self.tables['info']
-        vals  = self.query(table).filter(Info.key==key).all()
+        vals  = self.query(table).filter(table.c.key==key).all()
         if len(vals) < 1:
             # none found -- insert
             table.insert().execute(key=key, value=value)
         else:
-            table.update(whereclause="key='%s'" % key).execute(value=value)
+            table.update(table.c.key==key).execute(value=value)
 
     def set_mod_time(self):
         """set modify_date in info table"""
         if self.update_mod_time is None:
             self.update_mod_time = self.tables['info'].update(
                 whereclause=text("key='modify_date'"))
-        self.update_mod_time.execute(value=fmttime())
+        self.update_mod_time.execute(value=datetime.isoformat(datetime.now()))
+
+    def get_normalize_params(self):
+        """parameters for preedge() used to normalize the spectra of the
+        library, as set by recompute_derived(params=...): {} for the
+        defaults"""
+        return json.loads(self.get_info('normalize_params', default='{}'))
+
+    def set_normalize_params(self, params):
+        """set parameters for preedge() used to normalize spectra.
+        Stored results made with other parameters are recomputed when
+        read:  use recompute_derived(params=...) to do all at once."""
+        self.set_info('normalize_params', json.dumps(params or {},
+                                                     sort_keys=True))
+
+    def clear_cache(self, tablename=None):
+        """clear in-process cache for a table, or for all tables"""
+        if tablename is None:
+            self._cache = {}
+            self._cache_stamp = None
+            self._cache_checked = 0
+        else:
+            self._cache.pop(tablename, None)
+
+    def refresh_cache(self):
+        """check modify_date on the next use of the cache, rather than
+        waiting for cache_interval: use at the start of a web request so
+        that writes made through other processes are seen"""
+        self._cache_checked = 0
+
+    def _check_cache(self):
+        """drop all caches if modify_date in the info table has changed,
+        checking at most every cache_interval seconds"""
+        now = time.time()
+        if now > self._cache_checked + self.cache_interval:
+            self._cache_checked = now
+            stamp = self.get_info('modify_date')
+            if stamp != self._cache_stamp:
+                self._cache = {}
+                self._cache_stamp = stamp
+
+    def get_cache(self, tablename):
+        """return TableCache for a small table (see CACHED_TABLES).
+
+        The cache is dropped when this process changes the table, and
+        all caches are dropped when modify_date in the info table changes,
+        which is checked at most every cache_interval seconds.
+        """
+        self._check_cache()
+        cache = self._cache.get(tablename, None)
+        if cache is None:
+            rows = self.tables[tablename].select().execute().fetchall()
+            cache = self._cache[tablename] = TableCache(rows)
+        return cache
 
     def addrow(self, tablename, **kws):
-        """add generic row"""
+        """add generic row, returns id of the new row.
+        The row is committed and visible to any following read."""
         table = self.tables[tablename]
-        table.insert().execute(**kws)
+        result = table.insert().execute(**kws)
+        self.clear_cache(tablename)
         self.set_mod_time()
         self.session.commit()
+        return result.inserted_primary_key[0]
 
     def filtered_query(self, tablename, **kws):
         """
@@ -398,15 +956,60 @@ class XASDataLibrary(object):
 
         will return all rows from table
 
+        rows for the tables in CACHED_TABLES are taken from an
+        in-process cache.
         """
         table = self.tables[tablename]
-        query = self.query(table)
-
+        filters = {}
         for key, val in kws.items():
             if key in table.c and val is not None:
-                query = query.filter(getattr(table.c, key)==val)
+                filters[key] = val
+        if tablename in CACHED_TABLES:
+            return self.get_cache(tablename).filter(**filters)
+
+        query = self.query(table)
+        for key, val in filters.items():
+            query = query.filter(getattr(table.c, key)==val)
         return query.all()
 
+    def name_exists(self, tablename, name, conn=None):
+        """return whether a row with the given name exists in a table,
+        as a single indexed lookup"""
+        tab = self.tables[tablename]
+        query = select([tab.c.id]).where(tab.c.name==name).limit(1)
+        if conn is None:
+            conn = self.engine
+        return conn.execute(query).first() is not None
+
+    def get_unique_name(self, tablename, name, maxcount=100, msg=None,
+                        conn=None):
+        """return a name not yet used in a table, either name itself or
+        the first free 'name (1)', 'name (2)', etc.
+
+        The existing numbered names are found with one LIKE 'name (%)'
+        query, so this does not depend on the size of the table.
+        """
+        if not self.name_exists(tablename, name, conn=conn):
+            return name
+        tab = self.tables[tablename]
+        prefix = "%s (" % name
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%')
+        pattern = "%s%%)" % pattern.replace('_', '\\_')
+        query = select([tab.c.name]).where(tab.c.name.like(pattern,
+                                                           escape='\\'))
+        if self.engine.dialect.name == 'sqlite':
+            # sqlite will not use the index for LIKE on a case-sensitive
+            # column: add the equivalent range on the name
+            query = query.where(tab.c.name >= prefix).where(
+                tab.c.name < "%s)" % name)
+        if conn is None:
+            conn = self.engine
+        names = set([row.name for row in conn.execute(query)])
+        names.add(name)
+        if msg is None:
+            msg = tablename
+        return unique_name(name, names, maxcount=maxcount, msg=msg)
+
     def get_facility(self, just_one=False, **kws):
         """return facility or list of facilities"""
 
@@ -452,8 +1055,8 @@ class XASDataLibrary(object):
     def add_energy_units(self, units, notes=None, **kws):
         """add Energy Units: units required
         notes  optional
-        returns EnergyUnits instance"""
-        self.addrow('energy_units', units=units, notes=notes, **kws)
+        returns id"""
+        return self.addrow('energy_units', units=units, notes=notes, **kws)
 
     def get_sample(self, sid):
         """return sample by id"""
@@ -461,60 +1064,61 @@ class XASDataLibrary(object):
 
     def add_mode(self, name, notes='', **kws):
         """add collection mode: name required
-        returns Mode instance"""
+        returns id"""
         return self.addrow('mode', name=name, notes=notes, **kws)
 
     def add_crystal_structure(self, name, notes='',
                                format=None, data=None, **kws):
-         """add data format: name required
-         returns Format instance"""
+         """add crystal structure: name required
+         returns id"""
          kws['notes'] = notes
          kws['format'] = format
          kws['data'] = data
-         return self.addrow(Crystal_Structure, ('name',), (name,), **kws)
+         return self.addrow('crystal_structure', name=name, **kws)
 
     def add_edge(self, name, level):
         """add edge: name and level required
-        returns Edge instance"""
+        returns id"""
         return self.addrow('edge', name=name, level=level)
 
     def add_facility(self, name, notes='', **kws):
-        """add facilty by name, return Facility instance"""
+        """add facilty by name, returns id"""
         return self.addrow('facility', name=name, notes=notes, **kws)
 
     def add_beamline(self, name, facility_id=None,
                      xray_source=None,  notes='', **kws):
         """add beamline by name, with facility:
-               facility= Facility instance or id
-               returns Beamline instance"""
+               facility_id= Facility id
+               returns id"""
         return self.addrow('beamline', name=name, xray_source=xray_source,
                             notes=notes, facility_id=facility_id, **kws)
 
     def add_citation(self, name, **kws):
         """add literature citation: name required
-        returns Citation instance"""
+        returns id"""
         return self.addrow('citation', name=name, **kws)
 
     def add_info(self, key, value):
-        """add Info key value pair -- returns Info instance"""
+        """add Info key value pair -- returns key"""
         return self.addrow('info', key=key, value=value)
 
     def add_ligand(self, name, **kws):
         """add ligand: name required
-        returns Ligand instance"""
+        returns id"""
         return self.addrow('ligand', name=name, **kws)
 
     def add_person(self, name, email,
                    affiliation='', password=None, con='false', **kws):
         """add person: arguments are
         name, email with affiliation and password optional
-        returns Person instance"""
-        person = self.addrow('person', email=email, name=name,
-                             affiliation=affiliation,
-                             confirmed=con, **kws)
+        returns id"""
+        person_id = self.addrow('person', email=email, name=name,
+                                affiliation=affiliation,
+                                confirmed=con, **kws)
 
         if password is not None:
             self.set_person_password(email, password)
+        return person_id
 
     def get_person(self, val, key='email'):
         """get person by email"""
@@ -587,19 +1191,18 @@ class XASDataLibrary(object):
 
     def add_sample(self, name, person_id, notes='', **kws):
         """add sample: name required
-        returns Sample instance"""
+        returns id"""
 
         kws['name'] = name
         kws['person_id'] = person_id
         kws['notes'] = notes
         #if crystal_structure is not None:
         #    kws['crystal_structure_id'] = crystal_structure
-        tab = self.tables['sample']
-        tab.insert().execute(**kws)
+        return self.addrow('sample', **kws)
 
     def add_suite(self, name, notes='', person_id=None, **kws):
         """add suite: name required
-        returns Suite instance"""
+        returns id"""
         return self.addrow('suite', name=name, notes=notes,
                             person_id=person_id, **kws)
 
@@ -609,7 +1212,7 @@ class XASDataLibrary(object):
         table = self.tables['spectrum_suite']
         table.delete().where(table.c.suite_id==suite_id).execute()
         table = self.tables['suite_rating']
-        table.delete().where(table.c.id==suite_id).execute()
+        table.delete().where(table.c.suite_id==suite_id).execute()
         self.set_mod_time()
         self.session.commit()
 
@@ -624,141 +1227,178 @@ class XASDataLibrary(object):
         self.session.commit()
 
     def del_spectrum(self, sid):
+        for tablename in ('spectrum_data', 'spectrum_derived',
+                          'spectrum_xanes'):
+            if tablename in self.tables:
+                table = self.tables[tablename]
+                table.delete().where(table.c.spectrum_id==sid).execute()
         table = self.tables['spectrum']
         table.delete().where(table.c.id==sid).execute()
         table = self.tables['spectrum_suite']
         table.delete().where(table.c.spectrum_id==sid).execute()
         table = self.tables['spectrum_rating']
-        table.delete().where(table.c.id==sid).execute()
+        table.delete().where(table.c.spectrum_id==sid).execute()
 
         self.set_mod_time()
         self.session.commit()
 
     def set_suite_rating(self, person_id, suite_id, score, comments=None):
-        """add a score to a suite:"""
-        kws = {'score': valid_score(score),
-               'person_id': person_id, 'suite_id': suite_id,
-               'datetime': datetime.now(), 'comments': ''}
-        if comments is not None:
-            kws['comments'] = comments
+        """add a score to a suite, returns id of the rating"""
+        return self._set_rating('suite', person_id, suite_id, score,
+                                comments=comments)
 
-        tab = self.tables['suite_rating']
-        rowid = None
-        for row in tab.select(tab.c.suite_id==suite_id).execute().fetchall():
-            if row.person_id == person_id:
-                rowid = row.id
-
-        if rowid is None:
-            tab.insert().execute(**kws)
-        else:
-            tab.update(whereclause="id='%i'" % rowid).execute(**kws)
+    def set_spectrum_rating(self, person_id, spectrum_id, score, comments=None):
+        """add a score to a spectrum: person_id, spectrum_id, score, comment
+        score is an integer value 0 to 5
+        returns id of the rating"""
+        return self._set_rating('spectrum', person_id, spectrum_id, score,
+                                comments=comments)
+
+    def del_suite_rating(self, person_id, suite_id):
+        """remove a person's rating of a suite"""
+        self._del_ratings('suite', suite_id, person_id=person_id)
+        self.set_mod_time()
         self.session.commit()
 
-        sum = 0
-        rows = tab.select(tab.c.suite_id==suite_id).execute().fetchall()
-        for row in rows:
-            sum += 1.0*row.score
-
-        rating = 'No ratings'
-        if len(rows) > 0:
-            rating = '%.1f (%i ratings)' % (sum/len(rows), len(rows))
-
-        stab = self.tables['suite']
-        stab.update(whereclause="id='%i'" % suite_id).execute(rating_summary=rating)
-
+    def del_spectrum_rating(self, person_id, spectrum_id):
+        """remove a person's rating of a spectrum"""
+        self._del_ratings('spectrum', spectrum_id, person_id=person_id)
+        self.set_mod_time()
+        self.session.commit()
 
-    def set_spectrum_rating(self, person_id, spectrum_id, score, comments=None):
-        """add a score to a spectrum: person_id, spectrum_id, score, comment
-        score is an integer value 0 to 5"""
+    def _set_rating(self, tablename, person_id, item_id, score,
+                    comments=None):
+        """add or replace the rating of a spectrum or suite (tablename)
+        by a person, and update its rating totals, in one transaction.
+        returns id of the rating"""
+        rtab = self.tables['%s_rating' % tablename]
+        item = rtab.c['%s_id' % tablename]
         kws = {'score': valid_score(score),
-               'person_id': person_id, 'spectrum_id': spectrum_id,
+               'person_id': person_id, item.name: item_id,
                'datetime': datetime.now(), 'comments': ''}
         if comments is not None:
             kws['comments'] = comments
 
-
-        tab = self.tables['spectrum_rating']
-        rowid = None
-        for row in tab.select(tab.c.spectrum_id==spectrum_id).execute().fetchall():
-            if row.person_id == person_id:
-                rowid = row.id
-
-        if rowid is None:
-            tab.insert().execute(**kws)
-        else:
-            tab.update(whereclause="id='%i'" % rowid).execute(**kws)
-
+        with self.engine.begin() as conn:
+            self._lock_rated(conn, tablename, item_id)
+            old = conn.execute(select([rtab.c.id, rtab.c.score]).where(
+                and_(rtab.c.person_id==person_id, item==item_id))).fetchone()
+            if old is None:
+                rowid = conn.execute(rtab.insert().values(
+                    **kws)).inserted_primary_key[0]
+                self._add_rating_totals(conn, tablename, item_id,
+                                        kws['score'], 1)
+            else:
+                rowid = old.id
+                conn.execute(rtab.update().where(rtab.c.id==rowid).values(
+                    **kws))
+                self._add_rating_totals(conn, tablename, item_id,
+                                        kws['score'] - old.score, 0)
+        self.set_mod_time()
         self.session.commit()
+        return rowid
 
-        sum = 0
-        rows = tab.select(tab.c.spectrum_id==spectrum_id).execute().fetchall()
-        for row in rows:
-            sum += 1.0*row.score
-
-        rating = 'No ratings'
-        if len(rows) > 0:
-            rating = '%.1f (%i ratings)' % (sum/len(rows), len(rows))
-
-        stab = self.tables['spectrum']
-        stab.update(whereclause="id='%i'" % spectrum_id).execute(rating_summary=rating)
-
-
+    def _del_ratings(self, tablename, item_id, person_id=None):
+        """remove the ratings of a spectrum or suite (tablename), or only
+        those by person_id, and update its rating totals"""
+        rtab = self.tables['%s_rating' % tablename]
+        which = rtab.c['%s_id' % tablename] == item_id
+        if person_id is not None:
+            which = and_(which, rtab.c.person_id==person_id)
+        with self.engine.begin() as conn:
+            self._lock_rated(conn, tablename, item_id)
+            total, count = conn.execute(select([
+                func.sum(rtab.c.score), func.count(rtab.c.id)]).where(
+                    which)).fetchone()
+            if count > 0:
+                conn.execute(rtab.delete().where(which))
+                self._add_rating_totals(conn, tablename, item_id,
+                                        -total, -count)
+
+    def _lock_rated(self, conn, tablename, item_id):
+        """take the write lock on a spectrum or suite (tablename) before
+        its ratings are read, with an update that changes nothing, so
+        that changes to its ratings and totals are made one at a time:
+        a row lock where there are row locks, and the database write
+        lock for sqlite"""
+        tab = self.tables[tablename]
+        conn.execute(tab.update().where(tab.c.id==item_id).values(
+            id=tab.c.id))
+
+    def _add_rating_totals(self, conn, tablename, item_id, score, count):
+        """add score and count to the rating totals of a spectrum or
+        suite (tablename), and remake its average, after a change to its
+        ratings made on conn.  For a library without rating_sum (see
+        upgrade()), the totals and rating summary are remade from the
+        ratings instead."""
+        tab = self.tables[tablename]
+        if 'rating_sum' not in tab.c:
+            rtab = self.tables['%s_rating' % tablename]
+            total, count = conn.execute(select([
+                func.sum(rtab.c.score), func.count(rtab.c.id)]).where(
+                    rtab.c['%s_id' % tablename] == item_id)).fetchone()
+            values = {'rating_summary': rating_summary(total, count)}
+            if 'rating_avg' in tab.c:
+                values['rating_count'] = count
+                values['rating_avg'] = total/float(count) if count else None
+        else:
+            # totals may be NULL for items of libraries upgraded
+            # before the rating columns defaulted to 0
+            total = func.coalesce(tab.c.rating_sum, 0) + score
+            count = func.coalesce(tab.c.rating_count, 0) + count
+            values = {'rating_sum': total, 'rating_count': count,
+                      'rating_avg': cast(total, Float)/func.nullif(count, 0)}
+        conn.execute(tab.update().where(tab.c.id==item_id).values(**values))
 
     def update(self, tablename, where, use_id=True, **kws):
         """update a row (by id) in a table (by name) using keyword args
         db.update('spectrum', 5, **kws)
 
+        returns the number of rows updated.  The update is committed
+        and visible to any following read.  For spectra, modify_date
+        is set to the current time.
         """
         table = self.tables[tablename]
+        rowid = where
         if use_id:
-            where ="id='%i'" % where
-        table.update(whereclause=where).execute(**kws)
+            where ="id='%i'" % rowid
+        if tablename == 'spectrum' and 'modify_date' in table.c:
+            kws['modify_date'] = datetime.now()
+        result = table.update(whereclause=text(where)).execute(**kws)
+        if tablename == 'spectrum' and use_id:
+            self.refresh_derived(rowid)
+        self.clear_cache(tablename)
         self.set_mod_time()
         self.session.commit()
+        return result.rowcount
 
-    def add_spectrum(self, name, notes='', d_spacing=-1, energy_notes='',
-                     i0_notes='', itrans_notes='', ifluor_notes='',
-                     irefer_notes='', submission_date=None,
-                     collection_date=None, temperature='', energy=None,
-                     i0=None, itrans=None, ifluor=None, irefer=None,
-                     energy_stderr=None, i0_stderr=None,
-                     itrans_stderr=None, ifluor_stderr=None,
-                     irefer_stderr=None, energy_units=None, person=None,
-                     edge=None, element=None, sample=None, beamline=None,
-                     data_format=None, citation=None, reference_used=0,
-                     reference_mode=None, reference_sample=None, **kws):
-
-        """add spectrum: name required
-        returns Spectrum instance"""
-
-        stab = self.tables['spectrum']
-        spectrum_names = [s.name for s in stab.select().execute()]
-
-        if name in spectrum_names:
-            raise XASDBException("A spectrum named '%s' already exists" % name)
-
-        dlocal = locals()
+    def _spectrum_rows(self, args, kws=None):
+        """build the values for the spectrum and spectrum_data rows of a
+        new spectrum from a dictionary of add_spectrum() arguments,
+        returning (spectrum_values, spectrum_data_values)
+        """
+        kws = {} if kws is None else dict(kws)
         # simple values
-
-        for attr in ('notes', 'energy_notes', 'i0_notes', 'itrans_notes',
-                     'ifluor_notes', 'irefer_notes', 'temperature',
-                     'd_spacing', 'reference_used'):
-            kws[attr] = dlocal.get(attr, '')
+        for attr, default in (('notes', ''), ('energy_notes', ''),
+                              ('i0_notes', ''), ('itrans_notes', ''),
+                              ('ifluor_notes', ''), ('irefer_notes', ''),
+                              ('temperature', ''), ('d_spacing', -1),
+                              ('reference_used', 0)):
+            kws[attr] = args.get(attr, default)
 
         # arrays
-        for attr in ('energy', 'i0', 'itrans', 'ifluor', 'irefer',
-                     'energy_stderr', 'i0_stderr', 'itrans_stderr',
-                     'ifluor_stderr', 'irefer_stderr'):
+        for attr in SPECTRUM_ARRAYS:
             val = ''
-            if dlocal[attr] is not None:
-                val = json_encode(dlocal.get(attr, ''))
+            if args.get(attr, None) is not None:
+                val = encode_array(args[attr], self.array_format)
             kws[attr] = val
 
         # dates
+        submission_date = args.get('submission_date', None)
         if submission_date is None:
             submission_date = datetime.now()
         for attr, val in (('submission_date', submission_date),
-                          ('collection_date', collection_date)):
+                          ('collection_date', args.get('collection_date'))):
             if isinstance(val, str):
                 try:
                     val = isotime2datetime(val)
@@ -767,29 +1407,172 @@ class XASDataLibrary(object):
             if val is None:
                 val = datetime(1,1,1)
             kws[attr] = val
+        if 'modify_date' in self.tables['spectrum'].c:
+            kws['modify_date'] = datetime.now()
 
         # foreign keys, pointers to other tables
-        kws['beamline_id'] = self.get_beamline(beamline).id # beamline
-        kws['person_id'] = person
-        kws['edge_id'] = self.get_edge(edge.decode("utf-8")).id
-        kws['element_z'] = self.get_element(element.decode("utf-8")).z
-        kws['energy_units_id'] = self.filtered_query('energy_units', name=energy_units)[0].id
-
-        kws['sample_id'] = sample
-        kws['citation_id'] = citation
-        kws['reference_id'] = reference_sample
-        kws['reference_mode_id'] = reference_mode
-
-        self.addrow('spectrum', name=name, **kws)
-        table = self.tables['spectrum']
-        return self.query(table).filter(table.c.name == name).one()
+        edge, element = args.get('edge'), args.get('element')
+        if isinstance(edge, bytes):
+            edge = edge.decode('utf-8')
+        if isinstance(element, bytes):
+            element = element.decode('utf-8')
+        beamline = self.get_beamline(args.get('beamline'))
+        if beamline is None:
+            raise XASDBException("unknown beamline '%s'" % args.get('beamline'))
+        edge = self.get_edge(edge)
+        if edge is None:
+            raise XASDBException("unknown edge '%s'" % args.get('edge'))
+        element = self.get_element(element)
+        if element is None:
+            raise XASDBException("unknown element '%s'" % args.get('element'))
+        eunits = self.filtered_query('energy_units', units=args.get('energy_units'))
+        if len(eunits) < 1:
+            eunits = self.filtered_query('energy_units')
+
+        kws['beamline_id'] = beamline.id
+        kws['person_id'] = args.get('person')
+        kws['edge_id'] = edge.id
+        kws['element_z'] = element.z
+        kws['energy_units_id'] = eunits[0].id
+
+        # array summary: e0 and edge_step are set with the derived data
+        summary = args.get('summary', None)
+        if summary is None:
+            energy, mu_refer = None, None
+            if args.get('energy', None) is not None:
+                energy, mu, mu_refer = spectrum_mu(
+                    args['energy'], itrans=args.get('itrans'),
+                    irefer=args.get('irefer'), energy_units=eunits[0].units)
+            summary = summarize_spectrum(energy, mu_refer)
+        stab = self.tables['spectrum']
+        for name, value in summary.items():
+            if name in stab.c:
+                kws[name] = value
+
+        kws['sample_id'] = args.get('sample')
+        kws['citation_id'] = args.get('citation')
+        kws['reference_id'] = args.get('reference_sample')
+        kws['reference_mode_id'] = args.get('reference_mode')
+        kws['name'] = args['name']
+
+        data = {}
+        for attr in SPECTRUM_DATA:
+            data[attr] = kws.pop(attr, None)
+        if 'spectrum_data' not in self.tables:
+            kws.update(data)
+        return kws, data
+
+    def convert_arrays(self, array_format='binary', batch_size=100):
+        """convert the array data for all spectra in the library to
+        array_format ('json' or 'binary'), in place.
+        """
+        if array_format not in ARRAY_FORMATS:
+            raise XASDBException("unknown array format '%s'" % array_format)
+
+        tab, key = self.data_table, self.data_key
+        postgres = (self.engine.dialect.name == 'postgresql' and
+                    array_format != self.array_format)
+        if postgres and array_format == 'binary':
+            for attr in SPECTRUM_ARRAYS:
+                self.engine.execute(text("""ALTER TABLE %s ALTER COLUMN
+                %s TYPE bytea USING convert_to(%s, 'UTF8')""" % (tab.name,
+                                                                 attr, attr)))
+
+        cols = [getattr(tab.c, attr) for attr in SPECTRUM_ARRAYS]
+        ids = [row[0] for row in select([key]).order_by(key).execute()]
+        for i in range(0, len(ids), batch_size):
+            with self.engine.begin() as conn:
+                query = select([key] + cols).where(
+                    key.in_(ids[i:i+batch_size]))
+                for row in conn.execute(query).fetchall():
+                    kws = {}
+                    for attr in SPECTRUM_ARRAYS:
+                        val = decode_array(getattr(row, attr))
+                        if val is None:
+                            continue
+                        val = encode_array(val, array_format)
+                        if postgres and isinstance(val, str):
+                            val = val.encode('utf-8')
+                        kws[attr] = val
+                    if len(kws) > 0:
+                        conn.execute(tab.update().where(key==row[0]), **kws)
+
+        if postgres and array_format == 'json':
+            for attr in SPECTRUM_ARRAYS:
+                self.engine.execute(text("""ALTER TABLE %s ALTER COLUMN
+                %s TYPE text USING convert_from(%s, 'UTF8')""" % (tab.name,
+                                                                  attr, attr)))
+
+        self.set_info('array_format', array_format)
+        changed = array_format != self.array_format
+        self.array_format = array_format
+
+        # normalized spectra are recomputed, rather than converted
+        if changed and 'spectrum_derived' in self.tables:
+            dtab = self.tables['spectrum_derived']
+            if self.engine.dialect.name == 'postgresql':
+                self.engine.execute(dtab.update().values(norm=None))
+                ctype = 'bytea' if array_format == 'binary' else 'text'
+                self.engine.execute(text("""ALTER TABLE spectrum_derived
+                ALTER COLUMN norm TYPE %s USING NULL""" % ctype))
+            self.recompute_derived(stale_only=False)
+        self.set_mod_time()
+        self.session.commit()
+
+    def upgrade(self):
+        """upgrade an older library in place, applying any pending
+        schema migrations.  returns list of (version, description)
+        for the migrations applied.
+        """
+        applied = migrate(self)
+        self.session.commit()
+        return applied
+
+    def check_query_plans(self):
+        """raise an XASDBException if any of the frequently used queries
+        would need a full table scan or sort, as for a missing index"""
+        failed = check_query_plans(self)
+        if len(failed) > 0:
+            msg = ['%s: %s' % (desc, plan) for desc, plan in failed]
+            raise XASDBException('queries not using an index:\n  %s' %
+                                 '\n  '.join(msg))
+
+    def add_spectrum(self, name, notes='', d_spacing=-1, energy_notes='',
+                     i0_notes='', itrans_notes='', ifluor_notes='',
+                     irefer_notes='', submission_date=None,
+                     collection_date=None, temperature='', energy=None,
+                     i0=None, itrans=None, ifluor=None, irefer=None,
+                     energy_stderr=None, i0_stderr=None,
+                     itrans_stderr=None, ifluor_stderr=None,
+                     irefer_stderr=None, energy_units=None, person=None,
+                     edge=None, element=None, sample=None, beamline=None,
+                     data_format=None, citation=None, reference_used=0,
+                     reference_mode=None, reference_sample=None, **kws):
+
+        """add spectrum: name required
+        returns spectrum row (without array data)"""
+
+        stab = self.tables['spectrum']
+        if self.name_exists('spectrum', name):
+            raise XASDBException("A spectrum named '%s' already exists" % name)
+
+        row, data = self._spectrum_rows(locals(), kws)
+        spid = stab.insert().execute(**row).inserted_primary_key[0]
+        if 'spectrum_data' in self.tables:
+            self.data_table.insert().execute(spectrum_id=spid, **data)
+        self.refresh_derived(spid)
+        self._index_xanes([spid])
+        self.set_mod_time()
+        self.session.commit()
+        return self.get_spectrum(spid)
 
 
-    def get_beamlines(self, facility=None, orderby='id'):
+    def get_beamlines(self, facility=None, orderby='id', reverse=False):
         """get all beamlines for a facility
         Parameters
         --------
         facility  id, name, or Facility instance for facility
+        orderby   column to sort by, descending with reverse=True
 
         Returns
         -------
@@ -812,7 +1595,7 @@ class XASDataLibrary(object):
         else:
             query = tab.select()
 
-        query = apply_orderby(query, tab, orderby)
+        query = apply_orderby(query, tab, orderby, reverse=reverse)
         return query.execute().fetchall()
 
 
@@ -825,23 +1608,869 @@ class XASDataLibrary(object):
         raise NotImplementedError
 
     def set_spectrum_mode(self, spectrum_id, mode_id):
-        """set a mode for a spectrum"""
-        self.addrow('spectrum_mode',
-                     spectrum_id=spectrum_id, mode_id=mode_id)
+        """set a mode for a spectrum, returns id"""
+        rowid = self.addrow('spectrum_mode',
+                            spectrum_id=spectrum_id, mode_id=mode_id)
+        self.refresh_derived(spectrum_id)
+        return rowid
 
     def get_spectrum_mode(self,id):
         """get mode for a spectrum"""
         tab = self.tables['spectrum_mode']
         return tab.select().where(tab.c.spectrum_id == id).execute().fetchall()
 
-    def get_spectrum(self, id):
-        """ get spectrum by id"""
+    def get_spectrum_mu(self, spectrum):
+        """energy (in eV), mu and reference mu for a spectrum, given as
+        an id or a row from get_spectrum(id, arrays=True), using its
+        first collection mode.
+
+        returns (energy, mu, mu_refer, mode), with mu_refer None if there
+        is no reference channel, and energy None if the energy units
+        cannot be converted to eV.
+        """
+        if not hasattr(spectrum, 'energy'):
+            spectrum = self.get_spectrum(int(spectrum), arrays=True)
+        mode = 'transmission'
+        modes = self.get_spectrum_mode(spectrum.id)
+        if len(modes) > 0:
+            mode = self.filtered_query('mode', id=modes[0].mode_id)[0].name
+        eunits = 'eV'
+        rows = self.filtered_query('energy_units', id=spectrum.energy_units_id)
+        if len(rows) > 0:
+            eunits = rows[0].units
+        arrays = {}
+        for attr in ('energy', 'i0', 'itrans', 'ifluor', 'irefer'):
+            arrays[attr] = decode_array(getattr(spectrum, attr))
+        energy, mu, mu_refer = spectrum_mu(mode=mode, energy_units=eunits,
+                                           **arrays)
+        return energy, mu, mu_refer, mode
+
+    def _insert_derived(self, conn, spectrum_id, derived, params=None):
+        """replace stored normalized spectra for a spectrum.  With no
+        normalized spectra, a NOT_NORMALIZED row is stored for params."""
+        tab = self.tables.get('spectrum_derived', None)
+        if tab is None:
+            return
+        conn.execute(tab.delete().where(tab.c.spectrum_id==spectrum_id))
+        if len(derived) == 0:
+            conn.execute(tab.insert().values(
+                spectrum_id=spectrum_id, channel=NOT_NORMALIZED,
+                version=PREEDGE_VERSION,
+                params=json.dumps(params or {}, sort_keys=True)))
+        for channel, vals in derived.items():
+            vals = dict(vals)
+            vals['params'] = json.dumps(vals['params'], sort_keys=True)
+            vals['pre_coefs'] = json_encode(vals['pre_coefs'])
+            vals['norm_coefs'] = json_encode(vals['norm_coefs'])
+            vals['norm'] = encode_array(vals['norm'], self.array_format)
+            conn.execute(tab.insert().values(spectrum_id=spectrum_id,
+                                             channel=channel, **vals))
+
+    def set_derived(self, spectrum_id, params=None):
+        """compute and store the normalized spectra for a spectrum,
+        using preedge() with params (default: those of the library, see
+        get_normalize_params()).  returns a dictionary as for
+        get_derived()"""
+        if params is None:
+            params = self.get_normalize_params()
+        spectrum = self.get_spectrum(int(spectrum_id), arrays=True)
+        energy, mu, mu_refer, mode = self.get_spectrum_mu(spectrum)
+        derived = normalize_channels(energy, mu, mu_refer, mode=mode,
+                                     params=params)
+        xanes = self._xanes_vector(spectrum, energy, derived)
+        summary = summarize_spectrum(energy, mu_refer, derived)
+        previous = self._stored_derived(spectrum.id)[0]
+        with self.engine.begin() as conn:
+            self._insert_derived(conn, spectrum.id, derived, params=params)
+            self._insert_xanes(conn, spectrum.id, xanes)
+            if not same_derived(previous, derived):
+                self._touch_spectrum(conn, spectrum.id, summary)
+        return derived
+
+    def _stored_derived(self, spectrum_id):
+        """stored normalized spectra for a spectrum, as for get_derived(),
+        and a list of (version, params) for the stored rows, including
+        any NOT_NORMALIZED row"""
+        tab = self.tables.get('spectrum_derived', None)
+        out, made = {}, []
+        if tab is None:
+            return out, made
+        query = tab.select().where(tab.c.spectrum_id==spectrum_id)
+        for row in query.execute().fetchall():
+            params = json.loads(row.params)
+            made.append((row.version, params))
+            if row.channel == NOT_NORMALIZED:
+                continue
+            out[row.channel] = {'version': row.version, 'params': params,
+                                'e0': row.e0, 'edge_step': row.edge_step,
+                                'pre_coefs': json.loads(row.pre_coefs),
+                                'norm_coefs': json.loads(row.norm_coefs),
+                                'norm': decode_array(row.norm)}
+        return out, made
+
+    def _xanes_vector(self, spectrum, energy, derived):
+        """normalized XANES of a spectrum row on the similarity grid,
+        from the energy and results of normalize_channels()"""
+        if energy is None or 'sample' not in derived:
+            return None
+        eref = derived['sample']['e0']
+        edge = self.get_edge(spectrum.edge_id)
+        if edge is not None:
+            eref = reference_energy(int(spectrum.element_z), edge.name, eref)
+        return xanes_vector(energy, derived['sample']['norm'], eref)
+
+    def _insert_xanes(self, conn, spectrum_id, xanes):
+        """replace stored normalized XANES vector for a spectrum"""
+        tab = self.tables.get('spectrum_xanes', None)
+        if tab is None:
+            return
+        conn.execute(tab.delete().where(tab.c.spectrum_id==spectrum_id))
+        conn.execute(tab.insert().values(spectrum_id=spectrum_id,
+                                         grid=XANES_GRID_NAME,
+                                         xanes=encode_vector(xanes)))
+        self.clear_cache('spectrum_xanes')
+        self.clear_cache('xanes_ids')
+
+    def _touch_spectrum(self, conn, spectrum_id, summary=None):
+        """set modify_date of a spectrum to the current time, and the
+        summary columns from a dictionary made by summarize_spectrum()"""
         tab = self.tables['spectrum']
-        return tab.select().where(tab.c.id == id).execute().fetchone()
+        values = {}
+        if summary is not None:
+            values = dict([(name, value) for name, value in summary.items()
+                           if name in tab.c])
+        if 'modify_date' in tab.c:
+            values['modify_date'] = datetime.now()
+        if len(values) > 0:
+            conn.execute(tab.update().where(tab.c.id==spectrum_id).values(
+                **values))
+
+    def refresh_derived(self, spectrum_id):
+        """recompute normalized spectra for a spectrum that has changed,
+        keeping the parameters used before"""
+        params = None
+        tab = self.tables.get('spectrum_derived', None)
+        if tab is None:
+            return {}
+        query = select([tab.c.params]).where(
+            tab.c.spectrum_id==spectrum_id).limit(1)
+        row = query.execute().first()
+        if row is not None:
+            params = json.loads(row.params)
+        try:
+            return self.set_derived(spectrum_id, params=params)
+        except Exception:
+            logging.getLogger('xasdb').exception(
+                'could not normalize spectrum %i' % spectrum_id)
+            with self.engine.begin() as conn:
+                self._insert_derived(conn, spectrum_id, {}, params=params)
+                self._insert_xanes(conn, spectrum_id, None)
+                self._touch_spectrum(conn, spectrum_id)
+        return {}
+
+    def get_derived(self, spectrum_id, params=None):
+        """normalized spectra for a spectrum, as a dictionary with keys
+        'sample' and (if there is a reference channel) 'reference', each
+        a dictionary of e0, edge_step, norm, pre_coefs, norm_coefs,
+        params and version.
+
+        params defaults to those of the library (see
+        get_normalize_params()).  Stored results are used if they were
+        made with the same params and the current PREEDGE_VERSION, as is the NOT_NORMALIZED row
+        of a spectrum that could not be normalized: {} is returned for
+        it.  Otherwise the results are computed and stored, and if they
+        were made with an older version of preedge(),
+        recompute_derived() is started in the background for all other
+        spectra.  modify_date of the spectrum is only changed if the
+        results differ from those stored.
+        """
+        if params is None:
+            params = self.get_normalize_params()
+        tab = self.tables.get('spectrum_derived', None)
+        if tab is None:
+            energy, mu, mu_refer, mode = self.get_spectrum_mu(spectrum_id)
+            return normalize_channels(energy, mu, mu_refer, mode=mode,
+                                      params=params)
+        out, made = self._stored_derived(spectrum_id)
+        current = True
+        for version, made_params in made:
+            if version != PREEDGE_VERSION:
+                self.start_recompute_derived()
+                current = False
+            elif made_params != params:
+                current = False
+        if current and len(made) > 0:
+            return out
+        return self.set_derived(spectrum_id, params=params)
+
+    def recompute_derived(self, stale_only=True, params=None,
+                          batch_size=200):
+        """recompute stored normalized spectra made with an older version
+        of preedge() (or all of them, with stale_only=False), keeping
+        their parameters.  With params given, all spectra in the library
+        are normalized with those parameters instead, and they become
+        the parameters of the library (see set_normalize_params()).
+
+        Spectra are normalized batch_size at a time with preedge_batch()
+        and each batch is written in one transaction.  returns the number
+        of spectra recomputed."""
+        tab = self.tables.get('spectrum_derived', None)
+        if tab is None:
+            return 0
+        todo = {}
+        if params is not None:
+            self.set_normalize_params(params)
+            stab = self.tables['spectrum']
+            key = json.dumps(params, sort_keys=True)
+            todo[key] = [row.id for row in
+                         select([stab.c.id]).execute().fetchall()]
+        else:
+            query = select([tab.c.spectrum_id, tab.c.params]).distinct()
+            if stale_only:
+                query = query.where(tab.c.version != PREEDGE_VERSION)
+            keys = {}
+            for row in query.execute().fetchall():
+                keys[row.spectrum_id] = json.dumps(json.loads(row.params),
+                                                   sort_keys=True)
+            for spectrum_id in sorted(keys):
+                todo.setdefault(keys[spectrum_id], []).append(spectrum_id)
+
+        count = 0
+        for key, spectrum_ids in todo.items():
+            count += self._normalize_spectra(spectrum_ids, json.loads(key),
+                                             batch_size=batch_size)
+        if count > 0:
+            self.set_mod_time()
+        return count
+
+    def _normalize_spectra(self, spectrum_ids, params, batch_size=200):
+        """normalize spectra with params, batch_size at a time with
+        preedge_batch(), and store the results, writing each batch in
+        one transaction.  returns the number of spectra normalized."""
+        count = 0
+        log = logging.getLogger('xasdb')
+        for i in range(0, len(spectrum_ids), batch_size):
+            rows, spectra = [], []
+            for spectrum_id in spectrum_ids[i:i+batch_size]:
+                try:
+                    row = self.get_spectrum(spectrum_id, arrays=True)
+                    spectra.append(self.get_spectrum_mu(row))
+                    rows.append(row)
+                except Exception:
+                    log.exception('could not read spectrum %i' % spectrum_id)
+            derived = normalize_batch(spectra, params=params)
+            previous = [self._stored_derived(row.id)[0] for row in rows]
+            with self.engine.begin() as conn:
+                for row, spectrum, values, prev in zip(rows, spectra,
+                                                       derived, previous):
+                    xanes = self._xanes_vector(row, spectrum[0], values)
+                    summary = summarize_spectrum(spectrum[0], spectrum[2],
+                                                 values)
+                    self._insert_derived(conn, row.id, values, params=params)
+                    self._insert_xanes(conn, row.id, xanes)
+                    if not same_derived(prev, values):
+                        self._touch_spectrum(conn, row.id, summary)
+            count += len(rows)
+            claim = self._derived_claim
+            if (claim is not None and
+                threading.current_thread() is self._derived_thread):
+                self._derived_claim = self.claim_job('recompute_derived',
+                                                     claim=claim)
+        return count
+
+    def update_summary(self, stale_only=True, batch_size=200):
+        """fill in the summary columns of the spectrum table (see
+        SUMMARY_COLUMNS) for spectra without them (or for all spectra,
+        with stale_only=False), as for libraries made before they were
+        added.  e0 and edge_step are taken from the stored derived data,
+        normalizing spectra that have none.  returns the number of
+        spectra updated."""
+        stab = self.tables['spectrum']
+        query = select([stab.c.id]).order_by(stab.c.id)
+        if stale_only:
+            query = query.where(stab.c.npts==None)
+        spectrum_ids = [row.id for row in query.execute().fetchall()]
+        dtab = self.tables.get('spectrum_derived', None)
+        log = logging.getLogger('xasdb')
+        count = 0
+        for i in range(0, len(spectrum_ids), batch_size):
+            batch = spectrum_ids[i:i+batch_size]
+            stored = {}
+            if dtab is not None:
+                query = select([dtab.c.spectrum_id, dtab.c.channel,
+                                dtab.c.e0, dtab.c.edge_step]).where(
+                                    and_(dtab.c.spectrum_id.in_(batch),
+                                         dtab.c.channel.in_(
+                                             ['sample', NOT_NORMALIZED])))
+                for row in query.execute().fetchall():
+                    stored[row.spectrum_id] = {}
+                    if row.channel == 'sample':
+                        stored[row.spectrum_id]['sample'] = {
+                            'e0': row.e0, 'edge_step': row.edge_step}
+            ids, spectra = [], []
+            for spectrum_id in batch:
+                try:
+                    spectra.append(self.get_spectrum_mu(spectrum_id))
+                    ids.append(spectrum_id)
+                except Exception:
+                    log.exception('could not read spectrum %i' % spectrum_id)
+            todo = [j for j, spid in enumerate(ids) if spid not in stored]
+            derived = normalize_batch([spectra[j] for j in todo])
+            for j, values in zip(todo, derived):
+                stored[ids[j]] = values
+            with self.engine.begin() as conn:
+                for spectrum_id, spectrum in zip(ids, spectra):
+                    summary = summarize_spectrum(spectrum[0], spectrum[2],
+                                                 stored[spectrum_id])
+                    conn.execute(stab.update().where(
+                        stab.c.id==spectrum_id).values(**summary))
+            count += len(ids)
+        if count > 0:
+            self.set_mod_time()
+        return count
+
+    def claim_job(self, name, claim=None, timeout=JOB_CLAIM_TIMEOUT):
+        """claim a background job for this thread among all processes
+        using the library, with a compare-and-set on the info row 'job
+        <name>'.  With claim (as returned before) given, the claim is
+        renewed.  A claim not renewed for timeout seconds may be taken
+        over.  returns the new claim, or None if the job is claimed
+        elsewhere."""
+        table = self.tables['info']
+        key = 'job %s' % name
+        now = time.time()
+        new = '%.3f %s %i %i' % (now, socket.gethostname(), os.getpid(),
+                                 threading.get_ident())
+        if claim is None:
+            row = table.select(table.c.key==key).execute().fetchone()
+            if row is None:
+                try:
+                    table.insert().execute(key=key, value=new)
+                    return new
+                except IntegrityError:
+                    return None
+            claim = row.value
+            if len(claim) > 0 and now - float(claim.split()[0]) < timeout:
+                return None
+        result = table.update().where(and_(table.c.key==key,
+                                           table.c.value==claim)).execute(
+                                               value=new)
+        return new if result.rowcount == 1 else None
+
+    def release_job(self, name, claim):
+        """release a claim on a background job made by claim_job()"""
+        table = self.tables['info']
+        table.update().where(and_(table.c.key=='job %s' % name,
+                                  table.c.value==claim)).execute(value='')
+
+    def _recompute_derived_job(self):
+        """recompute_derived() for stale spectra, unless another process
+        or thread has claimed the job"""
+        claim = self.claim_job('recompute_derived')
+        if claim is None:
+            return
+        self._derived_claim = claim
+        try:
+            self.recompute_derived()
+        finally:
+            claim, self._derived_claim = self._derived_claim, None
+            if claim is not None:
+                self.release_job('recompute_derived', claim)
+
+    def start_recompute_derived(self):
+        """run recompute_derived() in a background thread, unless it is
+        already running in this or another process using the library"""
+        with self._derived_lock:
+            thread = self._derived_thread
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=self._recompute_derived_job,
+                                      name='recompute_derived')
+            thread.daemon = True
+            self._derived_thread = thread
+            thread.start()
+
+    def update_xanes(self, element, edge):
+        """store normalized XANES vectors for spectra of an element (z)
+        and edge (id) that do not have them for the current grid, as for
+        spectra added before the spectrum_xanes table existed.  returns
+        the number of spectra updated."""
+        stab, xtab = self.tables['spectrum'], self.tables['spectrum_xanes']
+        query = select([stab.c.id]).select_from(
+            stab.outerjoin(xtab, xtab.c.spectrum_id==stab.c.id)).where(
+                and_(stab.c.element_z==element, stab.c.edge_id==edge,
+                     or_(xtab.c.spectrum_id==None,
+                         xtab.c.grid!=XANES_GRID_NAME)))
+        ids = [row.id for row in query.execute().fetchall()]
+        for spectrum_id in ids:
+            row = self.get_spectrum(spectrum_id, arrays=True)
+            xanes = None
+            try:
+                energy, mu, mu_refer, mode = self.get_spectrum_mu(row)
+                xanes = self._xanes_vector(row, energy,
+                                           self.get_derived(spectrum_id))
+            except Exception:
+                logging.getLogger('xasdb').exception(
+                    'could not normalize spectrum %i' % spectrum_id)
+            with self.engine.begin() as conn:
+                self._insert_xanes(conn, spectrum_id, xanes)
+        return len(ids)
+
+    def _xanes_group(self, element, edge, *names):
+        """select the named columns of spectrum_xanes for the spectra of
+        an element (z) and edge (id) with normalized XANES, making
+        missing vectors with update_xanes() first"""
+        if 'spectrum_xanes' not in self.tables:
+            raise XASDBException('library has no spectrum_xanes table: '
+                                 'use upgrade() first')
+        self.update_xanes(element, edge)
+        stab, xtab = self.tables['spectrum'], self.tables['spectrum_xanes']
+        return select([xtab.c[name] for name in names]).where(
+            and_(xtab.c.spectrum_id==stab.c.id,
+                 stab.c.element_z==element, stab.c.edge_id==edge,
+                 xtab.c.xanes!=None)).order_by(xtab.c.spectrum_id)
+
+    def get_xanes_matrix(self, element, edge):
+        """normalized XANES of all spectra of an element (z) and edge (id)
+        on the similarity grid (see similarity.py), as (spectrum_ids,
+        matrix) with one float32 row per spectrum.  Spectra that could
+        not be normalized are left out.
+
+        Missing vectors are made with update_xanes() first.  Matrices are
+        cached in-process, and dropped when the library changes."""
+        self._check_cache()
+        key = (element, edge)
+        matrices = self._cache.get('spectrum_xanes', {})
+        if key not in matrices:
+            query = self._xanes_group(element, edge, 'spectrum_id', 'xanes')
+            rows = query.execute().fetchall()
+            ids = np.array([row.spectrum_id for row in rows], dtype=int)
+            matrix = np.array([decode_vector(row.xanes) for row in rows],
+                              dtype=np.float32)
+            matrices = self._cache.setdefault('spectrum_xanes', {})
+            matrices[key] = (ids, matrix.reshape((len(ids), len(XANES_GRID))))
+        return matrices[key]
+
+    def get_xanes_ids(self, element, edge):
+        """ids of the spectra of an element (z) and edge (id) with
+        normalized XANES, sorted, as for get_xanes_matrix() but without
+        reading the vectors.  Cached in-process in the same way."""
+        self._check_cache()
+        key = (element, edge)
+        matrices = self._cache.get('spectrum_xanes', {})
+        if key in matrices:
+            return matrices[key][0]
+        groups = self._cache.get('xanes_ids', {})
+        if key not in groups:
+            query = self._xanes_group(element, edge, 'spectrum_id')
+            ids = np.array([row.spectrum_id for row in
+                            query.execute().fetchall()], dtype=int)
+            groups = self._cache.setdefault('xanes_ids', {})
+            groups[key] = ids
+        return groups[key]
+
+    def get_xanes_vectors(self, spectrum_ids, batch_size=500):
+        """normalized XANES of some spectra (by id), as (spectrum_ids,
+        matrix) for get_xanes_matrix(), read batch_size at a time and
+        not cached.  Spectra without them are left out."""
+        xtab = self.tables['spectrum_xanes']
+        spectrum_ids = sorted(set([int(spid) for spid in spectrum_ids]))
+        # one expanding parameter compiles much faster than a long in_()
+        query = select([xtab.c.spectrum_id, xtab.c.xanes]).where(
+            and_(xtab.c.spectrum_id.in_(bindparam('ids', expanding=True)),
+                 xtab.c.xanes!=None)).order_by(xtab.c.spectrum_id)
+        rows = []
+        for i in range(0, len(spectrum_ids), batch_size):
+            rows.extend(query.execute(
+                ids=spectrum_ids[i:i+batch_size]).fetchall())
+        ids = np.array([row.spectrum_id for row in rows], dtype=int)
+        matrix = np.array([decode_vector(row.xanes) for row in rows],
+                          dtype=np.float32)
+        return ids, matrix.reshape((len(ids), len(XANES_GRID)))
+
+    def find_similar(self, spectrum=None, energy=None, mu=None,
+                     element=None, edge=None, k=10, metric='cosine',
+                     window=(-20, 80), approximate=None, probes=1):
+        """find the k spectra of the same element and edge most similar
+        to a spectrum in the library (by id), or to arrays of energy (in
+        eV) and mu(E) for an element and edge.
+
+        Spectra are compared by normalized XANES over window, (emin, emax)
+        in eV relative to the tabulated edge energy, with metric 'l2',
+        'cosine' or 'pearson' (see similarity.py).
+
+        With approximate=True, only the candidates from the approximate
+        index (see get_xanes_index()) are compared, looking in buckets up
+        to probes bits away (0 to 2: more is slower, with higher recall),
+        and only their vectors are read.  All spectra are compared if
+        there are fewer than k candidates.  By default, the index is used
+        for groups of INDEX_MIN_SPECTRA or more spectra.
+
+        returns list of (spectrum_id, score), most similar first.
+        """
+        row = None
+        if spectrum is not None:
+            row = self.get_spectrum(int(spectrum))
+            if row is None:
+                raise XASDBException("no spectrum with id '%s'" % spectrum)
+            element, edge = row.element_z, row.edge_id
+        elif energy is None or mu is None:
+            raise XASDBException('must give a spectrum, or energy and mu')
+        else:
+            elem, edge = self.get_element(element), self.get_edge(edge)
+            if elem is None or edge is None:
+                raise XASDBException("unknown element or edge '%s %s'" %
+                                     (element, edge))
+            energy = np.asarray(energy, dtype=np.float64)
+            group = preedge(energy, np.asarray(mu, dtype=np.float64))
+            eref = reference_energy(elem.z, edge.name, group['e0'])
+            vector = xanes_vector(energy, group['norm'], eref)
+            if vector is None:
+                raise XASDBException('energy does not cover the XANES')
+            element, edge = elem.z, edge.id
+
+        ids = self.get_xanes_ids(element, edge)
+        nself = 0
+        if row is not None:
+            found, vectors = self.get_xanes_vectors([row.id])
+            if len(found) == 0:
+                raise XASDBException('spectrum %i could not be normalized'
+                                     % row.id)
+            vector, nself = vectors[0], 1
+        if approximate is None:
+            approximate = len(ids) >= INDEX_MIN_SPECTRA
+        # the group's matrix, if it is cached: otherwise the approximate
+        # search reads only the candidates' vectors
+        cached = self._cache.get('spectrum_xanes', {}).get((element, edge))
+        try:
+            if approximate and cached is not None:
+                index = self.get_xanes_index(element, edge)
+                found, scores = index.search(vector, cached[0], cached[1],
+                                             k=k+nself, metric=metric,
+                                             window=window, probes=probes)
+            else:
+                found = []
+                if approximate:
+                    index = self.get_xanes_index(element, edge)
+                    found = index.candidates(vector, probes=probes)
+                if len(found) >= k+nself:
+                    ids, matrix = self.get_xanes_vectors(found)
+                else:
+                    ids, matrix = self.get_xanes_matrix(element, edge)
+                found, scores = rank_similar(matrix, vector, k=k+nself,
+                                             metric=metric, window=window)
+                found = ids[found]
+        except ValueError as exc:
+            raise XASDBException(str(exc))
+        out = [(int(spid), float(score)) for spid, score in zip(found, scores)
+               if not np.isnan(score) and (row is None or spid != row.id)]
+        return out[:k]
+
+    def _normalized_spectrum(self, spectrum_id):
+        "(energy, norm, e0) for a spectrum, or None if it cannot be normalized"
+        try:
+            energy, mu, mu_refer, mode = self.get_spectrum_mu(spectrum_id)
+            derived = self.get_derived(spectrum_id)
+        except Exception:
+            return None
+        if energy is None or 'sample' not in derived:
+            return None
+        sample = derived['sample']
+        return np.asarray(energy), np.asarray(sample['norm']), sample['e0']
+
+    def lcf(self, unknown, candidates=None, max_components=3,
+            window=(-20, 80), nresults=10, workers=None):
+        """fit the normalized XANES of an unknown spectrum as a
+        non-negative linear combination of library spectra, trying all
+        subsets of up to max_components candidates: see lcf.py.
+
+        Parameters
+        ----------
+        unknown         spectrum id, or (energy, mu) arrays, with energy
+                        in eV and mu not yet normalized
+        candidates      suite id, list of spectrum ids, or None for all
+                        spectra of the same element and edge as unknown
+        max_components  most spectra in one fit
+        window          (emin, emax) fit range, in eV relative to the
+                        unknown's e0
+        nresults        number of fits to return
+        workers         number of processes for large searches
+                        (default: one per cpu)
+
+        Returns
+        -------
+        list of LCFResult(spectrum_ids, weights, rfactor, chi_square),
+        best (lowest R-factor) first
+        """
+        unknown_id = None
+        if isinstance(unknown, (tuple, list)):
+            energy = np.asarray(unknown[0], dtype=np.float64)
+            group = preedge(energy, np.asarray(unknown[1], dtype=np.float64))
+            norm, e0 = group['norm'], group['e0']
+        else:
+            unknown_id = int(unknown)
+            row = self.get_spectrum(unknown_id)
+            if row is None:
+                raise XASDBException("no spectrum with id '%s'" % unknown)
+            found = self._normalized_spectrum(unknown_id)
+            if found is None:
+                raise XASDBException('spectrum %i could not be normalized'
+                                     % unknown_id)
+            energy, norm, e0 = found
+
+        if candidates is None:
+            if unknown_id is None:
+                raise XASDBException('must give candidates for arrays')
+            candidates = [c.id for c in self.get_spectra(
+                element=row.element_z, edge=row.edge_id)]
+        elif isinstance(candidates, int):
+            candidates = [c.id for c in
+                          self.list_spectra_summary(suite=candidates)]
+        candidates = [int(c) for c in candidates if c != unknown_id]
+
+        inside = (energy >= e0 + window[0]) & (energy <= e0 + window[1])
+        if inside.sum() < 3:
+            raise XASDBException('too few points between %g and %g eV '
+                                 'from the edge' % window)
+        energy, norm = energy[inside], norm[inside]
+
+        # standards on the unknown's energies, for those that cover them
+        spectrum_ids, columns = [], []
+        for spectrum_id in candidates:
+            found = self._normalized_spectrum(spectrum_id)
+            if found is None:
+                continue
+            cen, cnorm, ce0 = found
+            if cen.min() > energy[0] or cen.max() < energy[-1]:
+                continue
+            order = np.argsort(cen)
+            spectrum_ids.append(spectrum_id)
+            columns.append(np.interp(energy, cen[order], cnorm[order]))
+        if len(columns) == 0:
+            raise XASDBException('no candidate spectra cover the fit range')
+
+        fits = lcf_fit(norm, np.array(columns).T,
+                       max_components=max_components, nbest=nresults,
+                       workers=workers)
+        return [LCFResult([spectrum_ids[c] for c in cols], weights,
+                          rfactor, chisq)
+                for cols, weights, rfactor, chisq in fits]
+
+    def _spectrum_stamps(self, spectra):
+        """[(id, element_z, edge_id, modify_date)] for a suite id or a
+        list of spectrum ids, sorted by id"""
+        tab = self.tables['spectrum']
+        if isinstance(spectra, int):
+            rows = self.list_spectra_summary(suite=spectra)
+        else:
+            ids = [int(spid) for spid in spectra]
+            rows = select(self.spectrum_cols).where(
+                tab.c.id.in_(ids)).execute().fetchall()
+        return sorted([(row.id, row.element_z, row.edge_id,
+                        getattr(row, 'modify_date', None)) for row in rows])
+
+    def pca(self, spectra, window=(-20, 80)):
+        """principal component analysis of normalized XANES for a suite
+        (by id) or list of spectrum ids, all of one element and edge,
+        over window (emin, emax) in eV relative to the edge energy: see
+        pca.py.
+
+        Results are cached by the spectrum ids, their modify dates and
+        window, so repeating the analysis of an unchanged suite is fast.
+
+        returns PCAResult(spectrum_ids, element, edge, energy, mean,
+        components, eigenvalues, variance, scores, ind, ncomps), with
+        energy relative to the edge, and one row of scores per spectrum.
+        Spectra that cannot be normalized are left out.
+        """
+        stamps = self._spectrum_stamps(spectra)
+        groups = set([(z, edge_id) for spid, z, edge_id, mdate in stamps])
+        if len(groups) != 1:
+            raise XASDBException('PCA needs spectra of one element and '
+                                 'edge, not %i' % len(groups))
+        try:
+            mask = grid_window(window)
+        except ValueError as exc:
+            raise XASDBException(str(exc))
+        key = (tuple(stamps), tuple(window), XANES_GRID_NAME)
+        with self._pca_lock:
+            if key in self._pca_cache:
+                self._pca_cache.move_to_end(key)
+                return self._pca_cache[key]
+
+        element, edge = groups.pop()
+        self.update_xanes(element, edge)
+        xtab = self.tables['spectrum_xanes']
+        ids = [spid for spid, z, edge_id, mdate in stamps]
+        query = select([xtab.c.spectrum_id, xtab.c.xanes]).where(
+            and_(xtab.c.spectrum_id.in_(ids), xtab.c.xanes!=None)
+            ).order_by(xtab.c.spectrum_id)
+        rows = query.execute().fetchall()
+        if len(rows) < 2:
+            raise XASDBException('PCA needs at least 2 normalized spectra')
+        matrix = np.array([decode_vector(row.xanes)[mask] for row in rows])
+        result = pca_decompose([row.spectrum_id for row in rows], element,
+                               edge, XANES_GRID[mask], matrix)
+        with self._pca_lock:
+            self._pca_cache[key] = result
+            while len(self._pca_cache) > PCA_CACHE_SIZE:
+                self._pca_cache.popitem(last=False)
+        return result
+
+    def pca_target(self, pca, target, ncomps=None):
+        """target transformation: fit a spectrum with the mean and first
+        ncomps components of a pca() result (default: pca.ncomps, the
+        minimum of the indicator function).
+
+        target is a spectrum id, or (energy, mu) arrays with energy in
+        eV and mu not yet normalized, for the element and edge of pca.
+
+        returns TargetResult(ncomps, weights, fit, rfactor, chi_square)
+        """
+        if isinstance(target, (tuple, list)):
+            energy = np.asarray(target[0], dtype=np.float64)
+            group = preedge(energy, np.asarray(target[1], dtype=np.float64))
+            eref = group['e0']
+            edge = self.get_edge(pca.edge)
+            if edge is not None:
+                eref = reference_energy(int(pca.element), edge.name, eref)
+            vector = xanes_vector(energy, group['norm'], eref)
+        else:
+            row = self.get_spectrum(int(target), arrays=True)
+            if row is None:
+                raise XASDBException("no spectrum with id '%s'" % target)
+            energy, mu, mu_refer, mode = self.get_spectrum_mu(row)
+            vector = self._xanes_vector(row, energy,
+                                        self.get_derived(row.id))
+        if vector is None:
+            raise XASDBException('target could not be normalized')
+        mask = (XANES_GRID >= pca.energy[0]) & (XANES_GRID <= pca.energy[-1])
+        return target_transform(pca, vector[mask], ncomps=ncomps)
+
+    def _xanes_index_path(self, element, edge):
+        "file for the approximate index of an element and edge, or None"
+        if self.xanes_index_folder is None:
+            return None
+        return os.path.join(self.xanes_index_folder,
+                            'xanes_%i_%i.npz' % (element, edge))
+
+    def _load_xanes_index(self, element, edge):
+        """approximate index for an element and edge, as already loaded
+        or from xanes_index_folder: None if there is none"""
+        index = self._xanes_indexes.get((element, edge), None)
+        path = self._xanes_index_path(element, edge)
+        if index is None and path is not None and os.path.exists(path):
+            try:
+                index = XANESIndex.load(path)
+            except Exception:
+                logging.getLogger('xasdb').exception(
+                    'could not read XANES index %s' % path)
+            else:
+                if index.grid != XANES_GRID_NAME:
+                    index = None
+        if index is not None:
+            self._xanes_indexes[(element, edge)] = index
+        return index
+
+    def _save_xanes_index(self, element, edge, index):
+        """keep an approximate index, and write it to xanes_index_folder:
+        an index that cannot be written is rebuilt when next needed"""
+        self._xanes_indexes[(element, edge)] = index
+        path = self._xanes_index_path(element, edge)
+        if path is None:
+            return
+        try:
+            if not os.path.isdir(self.xanes_index_folder):
+                os.makedirs(self.xanes_index_folder)
+            index.save(path)
+        except (IOError, OSError):
+            logging.getLogger('xasdb').exception(
+                'could not write XANES index %s' % path)
+
+    def get_xanes_index(self, element, edge, rebuild=False, **kws):
+        """approximate nearest-neighbour index of the XANES vectors of
+        an element (z) and edge (id): see xanes_index.py.
+
+        The index is read from xanes_index_folder (by default next to
+        the library file for sqlite, in memory only for postgresql), or
+        built and saved there, then brought up to date with spectra
+        added or removed since.  With rebuild=True, the index is built
+        afresh, with keyword arguments for XANESIndex (ntables, nbits).
+        Only building reads all vectors of the group: bringing it up to
+        date reads the ids, and the vectors of the spectra added.
+        """
+        key = (element, edge)
+        # indexes are searched without the lock: a changed index is a
+        # changed copy, put in place of the one being searched
+        with self._xanes_lock:
+            ids = self.get_xanes_ids(element, edge)
+            index = None if rebuild else self._load_xanes_index(element,
+                                                                edge)
+            if index is None:
+                ids, matrix = self.get_xanes_matrix(element, edge)
+                index = XANESIndex(**kws)
+                index.build(ids, matrix)
+            elif self._xanes_synced.get(key, None) is ids:
+                return index
+            else:
+                new = ids[~np.isin(ids, index.ids)]
+                gone = index.ids[~np.isin(index.ids, ids)]
+                if len(new) == 0 and len(gone) == 0:
+                    self._xanes_synced[key] = ids
+                    return index
+                index = index.copy()
+                index.remove(gone)
+                if len(new) > 0:
+                    index.add(*self.get_xanes_vectors(new))
+            self._save_xanes_index(element, edge, index)
+            self._xanes_synced[key] = ids
+        return index
+
+    def _index_xanes(self, spectrum_ids):
+        """add XANES vectors of new spectra to the approximate indexes
+        that exist for their element and edge: other indexes are made
+        on the first search that needs them"""
+        if 'spectrum_xanes' not in self.tables or len(spectrum_ids) == 0:
+            return
+        stab, xtab = self.tables['spectrum'], self.tables['spectrum_xanes']
+        query = select([stab.c.id, stab.c.element_z, stab.c.edge_id,
+                        xtab.c.xanes]).where(
+                            and_(xtab.c.spectrum_id==stab.c.id,
+                                 stab.c.id.in_(spectrum_ids),
+                                 xtab.c.xanes!=None))
+        groups = {}
+        for row in query.execute().fetchall():
+            groups.setdefault((row.element_z, row.edge_id), []).append(row)
+        with self._xanes_lock:
+            for (element, edge), rows in groups.items():
+                index = self._load_xanes_index(element, edge)
+                if index is not None:
+                    index = index.copy()
+                    index.add([row.id for row in rows],
+                              [decode_vector(row.xanes) for row in rows])
+                    self._save_xanes_index(element, edge, index)
+
+    def get_spectrum(self, id, arrays=False):
+        """ get spectrum by id
+
+        with arrays=True, the array data (as stored, see decode_array)
+        and file text are included, otherwise they are not fetched.
+        """
+        tab = self.tables['spectrum']
+        if not arrays:
+            query = select(self.spectrum_cols)
+        elif 'spectrum_data' in self.tables:
+            dtab = self.data_table
+            query = select(self.spectrum_cols +
+                           [getattr(dtab.c, attr) for attr in SPECTRUM_DATA])
+            query = query.select_from(tab.outerjoin(dtab,
+                                                    dtab.c.spectrum_id==tab.c.id))
+        else:
+            query = tab.select()
+        return query.where(tab.c.id == id).execute().fetchone()
 
     def get_spectra(self, edge=None, element=None, beamline=None,
-                    person=None, mode=None, sample=None, facility=None,
-                    suite=None, citation=None, ligand=None, orderby='id'):
+                    person=None, orderby='id', reverse=False, **filters):
         """get all spectra matching some set of criteria
 
         Parameters
@@ -850,219 +2479,454 @@ class XASDataLibrary(object):
         element    by Z, Symbol, or Name
         person     by email
         beamline   by name
-        facility
-        mode
-        sample
-        citation
-        ligand
-        suite
+        facility, mode, sample, citation, ligand, suite
+                   each by row, id or name
+
+        and ranges of the summary columns, each as (min, max) with None
+        for no limit, or a single value to match:
+        npts           number of points
+        emin, emax     first and last energy, in eV
+        estep          median energy step, in eV
+        e0, edge_step  e0 (in eV) and edge step of the sample channel
+        has_reference  1 for spectra with a reference channel, 0 without
+        kmax           (min, max) of k (in 1/Angstrom) at emax, from e0
+
+        as in get_spectra(element='Fe', edge='K', kmax=(14, None)),
+        sorted by the column orderby, descending with reverse=True.
+
+        All matching rows are fetched at once: use iter_spectra() or
+        page_spectra() for large libraries.
         """
-        edge_id, element_z, person_id, beamline_id = None, None, None, None
-
-        tab = self.tables['spectrum']
-        query = tab.select()
-
-        # edge
-        if isinstance(edge, Edge):
-            edge_id = edge.id
-        elif edge is not None:
-            edge_id = self.get_edge(edge).id
-        if edge_id is not None:
-            query = query.where(tab.c.edge_id==edge_id)
-
-        # element
-        if isinstance(element, Element):
-            element_z = element.z
-        elif element is not None:
-            element_z = self.get_element(element).z
-        if element_z is not None:
-            query = query.where(tab.c.element_z==element_z)
-
-        # beamline
-        if isinstance(beamline, Beamline):
-            beamline_id = beamline.id
-        elif beamline is not None:
-            beamline_id = self.get_beamline(name=beamline).id
-        if beamline_id is not None:
-            query = query.where(tab.c.beamline_id==beamline_id)
-
-        # person
-        if isinstance(person, Person):
-            person_id = person.id
-        elif person is not None:
-            person_id = self.get_person(person).id
-        if person_id is not None:
-            query = query.where(tab.c.person_id==person_id)
-
-        query = apply_orderby(query, tab, orderby)
+        query = self._filter_spectra(select(self.spectrum_cols), edge=edge,
+                                     element=element, beamline=beamline,
+                                     person=person, **filters)
+        query = apply_orderby(query, self.tables['spectrum'], orderby,
+                              reverse=reverse)
         return query.execute().fetchall()
 
-    def add_xdifile(self, fname, person=None, create_sample=True, **kws):
+    def _filter_spectra(self, query, edge=None, element=None, beamline=None,
+                        person=None, mode=None, sample=None, facility=None,
+                        suite=None, citation=None, ligand=None, npts=None,
+                        emin=None, emax=None, estep=None, e0=None,
+                        edge_step=None, has_reference=None, kmax=None):
+        """restrict a query on the spectrum table with the criteria of
+        get_spectra()"""
+        tab = self.tables['spectrum']
+        if edge is not None:
+            if not hasattr(edge, 'id'):
+                edge = self.get_edge(edge)
+            query = query.where(tab.c.edge_id==edge.id)
+        if element is not None:
+            if not hasattr(element, 'z'):
+                element = self.get_element(element)
+            query = query.where(tab.c.element_z==element.z)
+        if beamline is not None:
+            if not hasattr(beamline, 'id'):
+                beamline = self.get_beamline(beamline)
+            query = query.where(tab.c.beamline_id==beamline.id)
+        if person is not None:
+            if not hasattr(person, 'id'):
+                person = self.get_person(person)
+            query = query.where(tab.c.person_id==person.id)
+
+        query = self._where_spectra(query, mode=mode, sample=sample,
+                                    facility=facility, suite=suite,
+                                    citation=citation, ligand=ligand)
+
+        # array summary
+        ranges = (('npts', npts), ('emin', emin), ('emax', emax),
+                  ('estep', estep), ('e0', e0), ('edge_step', edge_step),
+                  ('has_reference', has_reference))
+        for name, value in ranges:
+            if value is None:
+                continue
+            if name not in tab.c:
+                raise XASDBException("no column '%s': use upgrade()" % name)
+            query = range_filter(query, tab.c[name], value)
+        if kmax is not None:
+            if 'e0' not in tab.c:
+                raise XASDBException("no column 'e0': use upgrade()")
+            kmax = [None if k is None else KTOE*k*k for k in kmax]
+            query = range_filter(query, tab.c.emax - tab.c.e0, kmax)
+        return query
+
+    def _filter_ids(self, tablename, value):
+        "ids of rows of a table for a filter value: a row, an id, or a name"
+        if hasattr(value, 'id'):
+            return [value.id]
+        if isinstance(value, int):
+            return [value]
+        return [row.id for row in
+                self.filtered_query(tablename, name=str(value))]
+
+    def _where_spectra(self, query, mode=None, sample=None, facility=None,
+                       suite=None, citation=None, ligand=None):
+        """restrict a query on the spectrum table to spectra with a
+        collection mode, sample, facility, suite, citation and ligand,
+        each given as a row, an id or a name.  Links through other tables
+        are IN subqueries, so that no spectrum is repeated."""
+        tab = self.tables['spectrum']
+        if sample is not None:
+            query = query.where(tab.c.sample_id.in_(
+                self._filter_ids('sample', sample)))
+        if citation is not None:
+            query = query.where(tab.c.citation_id.in_(
+                self._filter_ids('citation', citation)))
+        if facility is not None:
+            btab = self.tables['beamline']
+            query = query.where(tab.c.beamline_id.in_(
+                select([btab.c.id]).where(btab.c.facility_id.in_(
+                    self._filter_ids('facility', facility)))))
+        for tablename, value in (('mode', mode), ('suite', suite),
+                                 ('ligand', ligand)):
+            if value is not None:
+                ltab = self.tables['spectrum_%s' % tablename]
+                query = query.where(tab.c.id.in_(
+                    select([ltab.c.spectrum_id]).where(
+                        ltab.c['%s_id' % tablename].in_(
+                            self._filter_ids(tablename, value)))))
+        return query
+
+    def list_spectra_summary(self, element=None, edge=None, beamline=None,
+                             person=None, orderby='id', reverse=False,
+                             **filters):
+        """get compact summary rows for all spectra matching some set of
+        criteria, in a single query joining the spectrum, element, edge,
+        person, beamline and facility tables.  No array data is fetched.
 
-        try:
-            fh  = open(fname, 'r')
-            filetext  = fh.read()
-        except:
-            filetext = ''
-        finally:
-            fh.close()
+        Parameters
+        ----------
+        element    by Z, Symbol, or Name
+        edge       by Name or id
+        beamline   by Name or id
+        person     by email or id
+        citation, suite, mode, sample, facility, ligand
+                   by id or name, see get_spectra()
+        orderby    spectrum column to sort by, descending with reverse=True
 
-        xfile = XDIFile(fname)
-        path, fname = os.path.split(fname)
+        and the ranges of summary columns of get_spectra().
 
-        now = fmttime()
+        Returns
+        -------
+        list of rows with attributes
+           id, name, element_z, elem_sym, edge, person_id, person_email,
+           person_name, beamline_id, beamline_name, facility_name,
+           citation_id, rating_summary, edge_id, modify_date,
+           rating_avg, rating_count and rating_sum
+        """
+        query = self._filter_spectra(self._summary_select(), edge=edge,
+                                     element=element, beamline=beamline,
+                                     person=person, **filters)
+        query = apply_orderby(query, self.tables['spectrum'], orderby,
+                              reverse=reverse)
+        return query.execute().fetchall()
 
-        spectrum_name = fname
-        if spectrum_name.endswith('.xdi'):
-            spectrum_name = spectrum_name[:-4]
+    def _summary_select(self):
+        "select of the summary rows of list_spectra_summary()"
+        tab = self.tables['spectrum']
+        etab = self.tables['element']
+        gtab = self.tables['edge']
+        ptab = self.tables['person']
+        btab = self.tables['beamline']
+        ftab = self.tables['facility']
+
+        cols = [tab.c.id, tab.c.name, tab.c.element_z,
+                etab.c.symbol.label('elem_sym'),
+                gtab.c.name.label('edge'),
+                tab.c.person_id,
+                ptab.c.email.label('person_email'),
+                ptab.c.name.label('person_name'),
+                tab.c.beamline_id,
+                btab.c.name.label('beamline_name'),
+                ftab.c.name.label('facility_name'),
+                tab.c.citation_id, tab.c.rating_summary, tab.c.edge_id]
+        for name in ('modify_date', 'rating_avg', 'rating_count',
+                     'rating_sum'):
+            if name in tab.c:
+                cols.append(tab.c[name])
+
+        join = tab.outerjoin(etab, etab.c.z==tab.c.element_z)
+        join = join.outerjoin(gtab, gtab.c.id==tab.c.edge_id)
+        join = join.outerjoin(ptab, ptab.c.id==tab.c.person_id)
+        join = join.outerjoin(btab, btab.c.id==tab.c.beamline_id)
+        join = join.outerjoin(ftab, ftab.c.id==btab.c.facility_id)
+        return select(cols).select_from(join)
+
+    def count_spectra(self, **filters):
+        "number of spectra matching the criteria of get_spectra()"
+        tab = self.tables['spectrum']
+        query = self._filter_spectra(select([func.count(tab.c.id)]),
+                                     **filters)
+        return query.execute().scalar()
 
+    def sort_columns(self):
+        "names of the spectrum columns that page_spectra() can sort by"
+        tab = self.tables['spectrum']
+        return sorted(set(['id'] + [list(ix.columns)[0].name
+                                    for ix in tab.indexes]))
 
-        stab = self.tables['spectrum']
+    def page_spectra(self, after=None, limit=100, orderby='id',
+                     reverse=False, summary=False, **filters):
+        """one page of the spectra matching the criteria of get_spectra(),
+        sorted by orderby and then by id, descending with reverse=True.
+        orderby is an indexed spectrum column (see sort_columns()), so
+        that the sort is done by walking the index.  NULL values sort
+        as in the database: first, except in postgresql.
 
-        _s_names = [s.name for s in stab.select().execute()]
-        spectrum_name = unique_name(spectrum_name, _s_names)
+        Parameters
+        ----------
+        after      id of the last spectrum of the previous page, or None
+                   for the first page
+        limit      maximum number of rows
+        summary    return the rows of list_spectra_summary() instead of
+                   those of get_spectra()
 
-        try:
-            c_date = xfile.attrs['scan']['start_time']
-        except:
-            c_date = 'collection date unknown'
-        d_spacing = xfile.dspacing
-        edge      = xfile.edge
-        element   = xfile.element
-        energy    = xfile.energy
-        comments  = ''
-        if hasattr(xfile, 'comments'):
-            comments = xfile.comments
-
-        if hasattr(xfile, 'i0'):
-            i0 = xfile.i0
-
-        #
-        modes = []
-        ifluor = itrans = irefer = None
-        if hasattr(xfile, 'itrans'):
-            itrans = xfile.itrans
-            modes.append('transmission')
-        elif hasattr(xfile, 'i1'):
-            itrans = xfile.i1
-            modes.append('transmission')
-
-        if hasattr(xfile, 'ifluor'):
-            ifluor= xfile.ifluor
-            modes.append('fluorescence')
-
-        elif hasattr(xfile, 'ifl'):
-            ifluor= xfile.ifl
-            modes.append('fluorescence')
-
-        # special case: mutrans given,
-        # itrans not available,
-        # and maybe i0 not available
-        if (hasattr(xfile, 'mutrans') and
-            not hasattr(xfile, 'itrans')):
-            if not hasattr(xfile, 'i0'):
-                i0 = np.ones(len(xfile.mutrans))*1.0
-                itrans = np.exp(-xfile.mutrans)
-            modes.append('transmission')
-
-        if (hasattr(xfile, 'mufluor') and
-            not hasattr(xfile, 'ifluor')):
-            if not hasattr(xfile, 'i0'):
-                i0 = np.ones(len(xfile.mufluor))*1.0
-                ifluor = xfile.mufluor
-            modes.append('fluorescence')
-
-
-        if (hasattr(xfile, 'munorm')):
-            i0 = np.ones(len(xfile.munorm))*1.0
-            ifluor = xfile.munorm
-            modes.append('fluorescence, unitstep')
-
-        refer_used = 0
-        if hasattr(xfile, 'irefer'):
-            refer_used = 1
-            irefer= xfile.irefer
-        elif hasattr(xfile, 'i2'):
-            refer_used = 1
-            irefer= xfile.i2
-
-        en_units = 'eV'
-        for index, value in xfile.attrs['column'].items():
-            words = value.split()
-            if len(words) > 1:
-                if (value.lower().startswith('energy') or
-                    value.lower().startswith('angle') ):
-                    en_units = words[1]
+        Returns
+        -------
+        rows, next_after: next_after is the id to pass as `after` for the
+        next page, or None for the last page.
 
+        Pages are found by the values of (orderby, id) of the `after`
+        spectrum (keyset pagination), not by an offset, so that each page
+        costs the same however deep it is, and spectra added or removed
+        elsewhere in the order do not shift the pages.
+        """
+        tab = self.tables['spectrum']
+        if summary:
+            query = self._summary_select()
+        else:
+            query = select(self.spectrum_cols)
+        query = self._filter_spectra(query, **filters)
+
+        key = orderby_column(tab, orderby)
+        if key is None or key is tab.c.id:
+            key = None
+        elif key.name not in self.sort_columns():
+            raise XASDBException("cannot sort spectra by '%s': "
+                                 "not an indexed column" % orderby)
+        order = [tab.c.id]
+        if key is not None:
+            order = [key, tab.c.id]
+        if reverse:
+            order = [col.desc() for col in order]
+
+        if after is not None:
+            after = int(after)
+            if reverse:
+                beyond = tab.c.id < after
+            else:
+                beyond = tab.c.id > after
+            if key is not None:
+                value = select([key]).where(tab.c.id==after).execute()
+                value = value.fetchone()
+                if value is None:
+                    raise XASDBException('no spectrum with id %i' % after)
+                value = value[0]
+                # NULLs sort first, except in postgresql, where they
+                # sort last: nulls_ahead is whether they come first here
+                nulls_ahead = (self.engine.dialect.name != 'postgresql')
+                if reverse:
+                    nulls_ahead = not nulls_ahead
+                    after_value = tuple_(key, tab.c.id) < tuple_(value, after)
+                else:
+                    after_value = tuple_(key, tab.c.id) > tuple_(value, after)
+                if value is None and nulls_ahead:
+                    beyond = or_(key.isnot(None), beyond)
+                elif value is None:
+                    beyond = and_(key.is_(None), beyond)
+                elif nulls_ahead:
+                    beyond = after_value
+                else:
+                    beyond = or_(key.is_(None), after_value)
+            query = query.where(beyond)
+
+        rows = query.order_by(*order).limit(limit+1).execute().fetchall()
+        if len(rows) > limit:
+            return rows[:limit], rows[limit-1].id
+        return rows, None
+
+    def iter_spectra(self, batch_size=500, orderby='id', reverse=False,
+                     summary=False, **filters):
+        """generate the spectra matching the criteria of get_spectra(),
+        as for page_spectra(), fetching batch_size rows at a time.
+
+        Each batch is a separate query, so memory use does not grow
+        with the size of the library, and no cursor or transaction is
+        held open while the caller works on the rows."""
+        after = None
+        while True:
+            rows, after = self.page_spectra(after=after, limit=batch_size,
+                                            orderby=orderby, reverse=reverse,
+                                            summary=summary, **filters)
+            for row in rows:
+                yield row
+            if after is None:
+                break
+
+    def add_xdirecords(self, records, person=None, create_sample=True,
+                       batch_size=100):
+        """add spectra from a sequence of (filename, record, error) tuples
+        as made by read_xdirecord(), writing batch_size records per
+        transaction.
+
+        returns a list of XDIResult(filename, spectrum_id, error), with
+        spectrum_id=None and a message for error for each file that
+        could not be read or added.
+
+        Records are normalized with the default parameters when read:
+        if the library uses others (see get_normalize_params()), the
+        added spectra are normalized again with those.
+        """
         if isinstance(person, Person):
             person_id = person.id
         else:
             person_id = self.get_person(person).id
 
-        sample_id = None
-        if create_sample:
-            try:
-                sattrs  = xfile.attrs['sample']
-            except:
-                sattrs = {'name': 'unknown',
-                          'prep': 'unknown'}
-
-            formula, prep, notes = '', '', ''
-            notes = "sample for '%s', uploaded %s" % (fname, now)
-            if 'name' in sattrs:
-                sname = sattrs.pop('name')
-            if 'prep' in sattrs:
-                prep = sattrs.pop('prep')
-            if 'formula' in sattrs:
-                formula = sattrs.pop('formula')
-            if len(sattrs) > 0:
-                notes  = '%s\n%s' % (notes, json_encode(sattrs))
-            self.add_sample(sname, person_id, formula=formula,
-                            preparation=prep, notes=notes)
-
-            stab = self.tables['sample']
-            sample = self.query(stab).filter(stab.c.name==sname).all()
-            # if len(sample) > 1:
-                # print( 'Warning: multiple (%i) samples name %s' % (len(sample), sname))
-            sample = sample[0]
-
-            sample_id = sample.id
-            sample_ref_id = None
-            if 'reference' in sattrs:
-                rname = sattrs['reference']
-                note = "reference for '%s', uploaded %s" % (fname, now)
+        modes = {}
+        for row in self.get_cache('mode').rows:
+            modes[row.name] = row.id
+        opts = dict(person_id=person_id, modes=modes,
+                    create_sample=create_sample)
+
+        results, batch = [], []
+        for rec in records:
+            batch.append(rec)
+            if len(batch) >= batch_size:
+                results.extend(self._write_xdi_batch(batch, **opts))
+                batch = []
+        if len(batch) > 0:
+            results.extend(self._write_xdi_batch(batch, **opts))
+        params = self.get_normalize_params()
+        if len(params) > 0:
+            self._normalize_spectra([r.spectrum_id for r in results
+                                     if r.spectrum_id is not None], params,
+                                    batch_size=batch_size)
+        return results
+
+    def add_xdifiles(self, paths, person=None, create_sample=True,
+                     batch_size=100):
+        """add a sequence of XDI files, writing batch_size
+        files per transaction.
+
+        returns a list of XDIResult(filename, spectrum_id, error)
+        """
+        return self.add_xdirecords(map(read_xdirecord, paths),
+                                   person=person, batch_size=batch_size,
+                                   create_sample=create_sample)
+
+    def ingest_directory(self, path, person=None, workers=None,
+                         pattern='*.xdi', create_sample=True,
+                         batch_size=100, exclude=None):
+        """add all XDI files matching pattern in a directory, parsing
+        files in a pool of worker processes (default: one per cpu) while
+        this process writes the parsed records in batches.  Files with
+        names containing any of the strings in exclude are skipped.
+
+        returns a list of XDIResult(filename, spectrum_id, error)
+        """
+        paths = sorted(glob.glob(os.path.join(path, pattern)))
+        if exclude is not None:
+            paths = [p for p in paths
+                     if not any([x in os.path.basename(p) for x in exclude])]
+        return self.add_xdirecords(read_xdirecords(paths, workers=workers,
+                                                   window=2*batch_size),
+                                   person=person, batch_size=batch_size,
+                                   create_sample=create_sample)
+
+    def add_xdifile(self, fname, person=None, create_sample=True, **kws):
+        """add a single XDI file, returns the spectrum id"""
+        result = self.add_xdifiles([fname], person=person,
+                                   create_sample=create_sample)[0]
+        if result.error is not None:
+            raise XASDBException(result.error)
+        return result.spectrum_id
+
+    def _write_xdi_batch(self, batch, person_id=None, modes=None,
+                         create_sample=True):
+        """write one batch of XDI records in a single transaction.
+
+        Records that cannot be resolved (unknown beamline, element, ...)
+        are reported as errors without being written.  If the transaction
+        itself fails, the batch is retried one record per transaction so
+        that only the bad records are lost.
+        """
+        results, rows = {}, []
+        for index, (fname, rec, error) in enumerate(batch):
+            if error is None:
                 try:
-                    rsample = self.query(stab).filter(stab.c.name==rname).one()
-                except:
-                    self.add_sample(rname, person_id, formula='',
-                                    preparation='', notes=notes)
-                    rsample = self.query(stab).filter(stab.c.name==rname).one()
-                sample_ref_id = rsample.id
-
-
-        beamline = None
-        beamline_name  = xfile.attrs['beamline']['name']
-        notes = json_encode(xfile.attrs)
-        spectrum_name = "%s (%s)" % (sname, spectrum_name)
-        
-        print(spectrum_name,modes)
-        spec  = self.add_spectrum(spectrum_name, d_spacing=d_spacing,
-                                  collection_date=c_date, person=person_id,
-                                  beamline=beamline_name, edge=edge, element=element,
-                                  energy=energy, energy_units=en_units,
-                                  i0=i0,itrans=itrans, ifluor=ifluor,
-                                  irefer=irefer,
-                                  sample=sample_id,
-                                  comments=comments,
-                                  notes=notes,
-                                  filetext=filetext,
-                                  reference_sample=sample_ref_id)
-
-
-        modes_map = {}
-        for row in self.tables['mode'].select().execute().fetchall():
-            modes_map[row.name] = row.id
-        for mode in modes:
-            mode_id = modes_map.get(mode, None)
+                    row, data = self._spectrum_rows(rec, {
+                        'comments': rec['comments'],
+                        'filetext': rec['filetext']})
+                    rows.append((index, fname, rec, row, data))
+                except Exception as exc:
+                    error = _errmsg(exc)
+            if error is not None:
+                results[index] = XDIResult(fname, None, error)
+
+        try:
+            with self.engine.begin() as conn:
+                for index, fname, rec, row, data in rows:
+                    spid = self._insert_xdirecord(conn, rec, row, data,
+                                                  person_id, modes,
+                                                  create_sample)
+                    results[index] = XDIResult(fname, spid, None)
+        except Exception as exc:
+            for index, fname, rec, row, data in rows:
+                if len(rows) == 1:
+                    results[index] = XDIResult(fname, None, _errmsg(exc))
+                else:
+                    results[index] = self._write_xdi_batch(
+                        [(fname, rec, None)], person_id=person_id,
+                        modes=modes, create_sample=create_sample)[0]
+        else:
+            if len(rows) > 0:
+                self._index_xanes([results[index].spectrum_id
+                                   for index, fname, rec, row, data in rows])
+                self.set_mod_time()
+        return [results[i] for i in range(len(batch))]
+
+    def _insert_xdirecord(self, conn, rec, row, data, person_id, modes,
+                          create_sample=True):
+        """insert sample, spectrum, and spectrum mode rows for an XDI
+        record on an open connection, returning the spectrum id"""
+        tables = self.tables
+        sample = rec['sample']
+        sname = sample['name']
+        if create_sample:
+            query = tables['sample'].insert().values(
+                name=sname, person_id=person_id, formula=sample['formula'],
+                preparation=sample['preparation'], notes=sample['notes'])
+            row['sample_id'] = conn.execute(query).inserted_primary_key[0]
+
+            rname = sample.get('reference', None)
+            if rname is not None:
+                samptab = tables['sample']
+                query = select([samptab.c.id]).where(samptab.c.name==rname)
+                rsample = conn.execute(query.limit(1)).first()
+                if rsample is not None:
+                    row['reference_id'] = rsample.id
+                else:
+                    query = samptab.insert().values(
+                        name=rname, person_id=person_id, formula='',
+                        preparation='', notes=sample['reference_notes'])
+                    rsample = conn.execute(query)
+                    row['reference_id'] = rsample.inserted_primary_key[0]
+
+        row['name'] = self.get_unique_name('spectrum',
+                                           "%s (%s)" % (sname, rec['name']),
+                                           conn=conn)
+        row['person_id'] = person_id
+        query = tables['spectrum'].insert().values(**row)
+        spid = conn.execute(query).inserted_primary_key[0]
+
+        if 'spectrum_data' in tables:
+            conn.execute(self.data_table.insert().values(spectrum_id=spid,
+                                                         **data))
+        for mode in rec['modes']:
+            mode_id = modes.get(mode, None)
             if mode_id is not None:
-                self.set_spectrum_mode(spec.id, mode_id)
+                conn.execute(tables['spectrum_mode'].insert().values(
+                    spectrum_id=spid, mode_id=mode_id))
+        self._insert_derived(conn, spid, rec.get('derived', {}))
+        self._insert_xanes(conn, spid, rec.get('xanes', None))
+        return spid